@@ -4,26 +4,340 @@
 #
 
 import os
+import io
 import csv
+import json
+import hashlib
+import tempfile
 
+from ansible import constants as C
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleError
 from ansible.utils.vars import merge_hash
 
+IOCLASS_VALIDATION_CACHE_FILE = "opencas-ioclass-validation.json"
 
-def validate_ioclass_file(ioclass_file):
-    if ioclass_file is None:
-        return
 
-    file_path = "roles/opencas-deploy/files/{0}".format(ioclass_file)
-    if not os.path.exists(file_path):
-        raise AnsibleError(
-            "{0} io class file wasn't found in opencas-deploy files".format(
-                ioclass_file
+def get_validator_version():
+    """
+    SHA-256 of this plugin source, so results stored by validator with
+    different checks aren't reused
+    """
+    path = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+IOCLASS_VALIDATOR_VERSION = get_validator_version()
+
+# Results of IO class files validation ({"error": error message or None if
+# file is valid, "warnings": [...]}) keyed by validator version, file path,
+# mtime and SHA-256 of its contents
+ioclass_validation_cache = {}
+
+
+def load_ioclass_validation_cache(cache_file):
+    try:
+        with open(cache_file, "r") as f:
+            ioclass_validation_cache.update(json.load(f))
+    except (IOError, OSError, ValueError):
+        pass
+
+
+def store_ioclass_validation_cache(cache_file):
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    # Results of other validator versions won't be used anymore
+    prefix = "{0}:".format(IOCLASS_VALIDATOR_VERSION)
+    results = dict(
+        (key, result)
+        for key, result in ioclass_validation_cache.items()
+        if key.startswith(prefix)
+    )
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(results, f)
+        os.rename(tmp_path, cache_file)
+    except (IOError, OSError):
+        pass
+
+
+def validate_ioclass_file(file_path, ioclass_file, cache_file=None):
+    """ Validate IO class file, returns list of warnings """
+    with open(file_path, "rb") as f:
+        contents = f.read()
+
+    key = "{0}:{1}:{2}:{3}".format(
+        IOCLASS_VALIDATOR_VERSION,
+        os.path.realpath(file_path),
+        os.path.getmtime(file_path),
+        hashlib.sha256(contents).hexdigest(),
+    )
+
+    # Results can't be safely shared between runs without known version
+    if IOCLASS_VALIDATOR_VERSION is None:
+        cache_file = None
+
+    if key not in ioclass_validation_cache and cache_file:
+        load_ioclass_validation_cache(cache_file)
+
+    if key not in ioclass_validation_cache:
+        try:
+            warnings = validate_ioclass(contents.decode("utf-8"), ioclass_file)
+        except AnsibleError as e:
+            result = {"error": e.message, "warnings": []}
+        else:
+            result = {"error": None, "warnings": warnings}
+        ioclass_validation_cache[key] = result
+
+        if cache_file:
+            store_ioclass_validation_cache(cache_file)
+
+    result = ioclass_validation_cache[key]
+    if result["error"] is not None:
+        raise AnsibleError(result["error"])
+
+    return list(result["warnings"])
+
+
+# Open CAS classification rule conditions and their argument types. Rules
+# with conditions not listed here are only reported with warning and left for
+# Open CAS to check.
+IOCLASS_CONDITIONS = {
+    "unclassified": None,
+    "metadata": None,
+    "direct": None,
+    "done": None,
+    "directory": "path",
+    "extension": "string",
+    "file_name_prefix": "string",
+    "process_name": "string",
+    "file_size": "numeric",
+    "request_size": "numeric",
+    "file_offset": "numeric",
+    "lba": "numeric",
+    "pid": "numeric",
+    "core_id": "numeric",
+    "io_class": "numeric",
+    "io_direction": "direction",
+    "wlth": "numeric",
+}
+IOCLASS_NUMERIC_OPERATORS = ["eq", "ne", "lt", "le", "gt", "ge"]
+IOCLASS_DIRECTIONS = ["read", "write"]
+IOCLASS_MAX_NUMERIC_VALUE = 2 ** 64 - 1
+
+
+class IoclassRuleError(Exception):
+    def __init__(self, message, position):
+        super(IoclassRuleError, self).__init__(message)
+        self.message = message
+        self.position = position
+
+
+def parse_ioclass_condition(term, position):
+    """ Parse single rule condition, returns (name, operator, value) """
+    name, _, arg = term.partition(":")
+    if name not in IOCLASS_CONDITIONS:
+        return (name, None, arg or None)
+
+    arg_type = IOCLASS_CONDITIONS[name]
+    arg_position = position + len(name) + 1
+    if arg_type is None:
+        if ":" in term:
+            raise IoclassRuleError(
+                "condition '{0}' doesn't take arguments".format(name),
+                arg_position,
             )
+        return (name, None, None)
+
+    if not arg:
+        raise IoclassRuleError(
+            "condition '{0}' requires an argument".format(name), arg_position
+        )
+
+    if arg_type == "path" and not arg.startswith("/"):
+        raise IoclassRuleError(
+            "directory '{0}' isn't an absolute path".format(arg), arg_position
+        )
+
+    if arg_type == "direction" and arg not in IOCLASS_DIRECTIONS:
+        raise IoclassRuleError(
+            "unknown IO direction '{0}' (expected one of: {1})".format(
+                arg, ", ".join(IOCLASS_DIRECTIONS)
+            ),
+            arg_position,
         )
 
-    with open(file_path, "r") as f:
+    if arg_type != "numeric":
+        return (name, "eq", arg)
+
+    operator, _, value = arg.partition(":")
+    if operator not in IOCLASS_NUMERIC_OPERATORS:
+        raise IoclassRuleError(
+            "unknown operator '{0}' (expected one of: {1})".format(
+                operator, ", ".join(IOCLASS_NUMERIC_OPERATORS)
+            ),
+            arg_position,
+        )
+
+    value_position = arg_position + len(operator) + 1
+    if not value.isdigit() or int(value) > IOCLASS_MAX_NUMERIC_VALUE:
+        raise IoclassRuleError(
+            "invalid numeric value '{0}'".format(value), value_position
+        )
+
+    return (name, operator, int(value))
+
+
+def parse_ioclass_rule(rule):
+    """
+    Parse IO class rule (conditions joined with '&' and '|' operators).
+    Returns list of (operator, condition) tuples, where operator of first
+    condition is None. Raises IoclassRuleError with 1-based position of error.
+    """
+    conditions = []
+    position = 0
+    operator = None
+    while True:
+        ends = [rule.find(op, position) for op in "&|"]
+        ends = [end for end in ends if end != -1]
+        end = min(ends) if ends else len(rule)
+
+        term = rule[position:end]
+        if not term:
+            raise IoclassRuleError("missing condition", position + 1)
+        conditions += [(operator, parse_ioclass_condition(term, position + 1))]
+
+        if end == len(rule):
+            break
+
+        operator = rule[end]
+        position = end + 1
+
+    names = [name for op, (name, _, _) in conditions]
+    if "unclassified" in names and len(names) != 1:
+        raise IoclassRuleError(
+            "'unclassified' can't be combined with other conditions", 1
+        )
+
+    return conditions
+
+
+def get_ioclass_rule_constraints(conditions):
+    """
+    Get constraints of rule consisting only of conditions joined with '&' as
+    {condition name: set of values or (min, max) range}. Returns None when
+    rule can't be analyzed this way.
+    """
+    constraints = {}
+    for operator, (name, condition_operator, value) in conditions:
+        if operator == "|" or condition_operator == "ne":
+            return None
+
+        if name not in IOCLASS_CONDITIONS:
+            return None
+
+        if name == "done":
+            continue
+
+        if IOCLASS_CONDITIONS[name] != "numeric":
+            constraints.setdefault(name, set()).add(value)
+            continue
+
+        low, high = constraints.get(name, (0, IOCLASS_MAX_NUMERIC_VALUE))
+        if condition_operator in ["eq", "ge"]:
+            low = max(low, value)
+        if condition_operator in ["eq", "le"]:
+            high = min(high, value)
+        if condition_operator == "gt":
+            low = max(low, value + 1)
+        if condition_operator == "lt":
+            high = min(high, value - 1)
+        constraints[name] = (low, high)
+
+    return constraints
+
+
+def is_ioclass_rule_implied(constraints, by_constraints):
+    """ Check if every IO matching by_constraints also matches constraints """
+    for name, constraint in constraints.items():
+        if name not in by_constraints:
+            return False
+
+        by_constraint = by_constraints[name]
+        if isinstance(constraint, tuple):
+            if not (
+                constraint[0] <= by_constraint[0]
+                and by_constraint[1] <= constraint[1]
+            ):
+                return False
+        elif not constraint <= by_constraint:
+            return False
+
+    return True
+
+
+def validate_ioclass_rules(ioclasses, ioclass_file):
+    """
+    Check for rules which never match and rules shadowed by rules ending
+    classification ('done') with higher priority (lower eviction priority
+    value). Rule covered by such rule with equal priority is only reported
+    in returned list of warnings, as it depends on order in which Open CAS
+    evaluates classes with equal priority.
+    """
+    warnings = []
+    evaluated = []
+    for priority, id, name, conditions in sorted(ioclasses):
+        constraints = get_ioclass_rule_constraints(conditions)
+        if constraints is None or name == "unclassified":
+            continue
+
+        for low, high in [c for c in constraints.values() if type(c) is tuple]:
+            if low > high:
+                raise AnsibleError(
+                    "IO-class rule({0}) of IO class {1} never matches "
+                    "in {2}".format(name, id, ioclass_file)
+                )
+
+        for shadowing in evaluated:
+            (
+                shadowing_priority,
+                shadowing_id,
+                shadowing_name,
+                shadowing_constraints,
+            ) = shadowing
+            if not is_ioclass_rule_implied(shadowing_constraints, constraints):
+                continue
+
+            if shadowing_priority < priority:
+                raise AnsibleError(
+                    "IO-class rule({0}) of IO class {1} is unreachable, it's "
+                    "shadowed by rule({2}) of IO class {3} with higher "
+                    "priority in {4}".format(
+                        name, id, shadowing_name, shadowing_id, ioclass_file
+                    )
+                )
+            warnings += [
+                "IO-class rule({0}) of IO class {1} may be unreachable, it's "
+                "covered by rule({2}) of IO class {3} with the same "
+                "priority in {4}".format(
+                    name, id, shadowing_name, shadowing_id, ioclass_file
+                )
+            ]
+
+        if "done" in [c[0] for op, c in conditions]:
+            evaluated += [(priority, id, name, constraints)]
+
+    return warnings
+
+
+def validate_ioclass(contents, ioclass_file):
+    """ Validate IO class file contents, returns list of warnings """
+    warnings = []
+    with io.StringIO(contents) as f:
         reader = csv.DictReader(f, restkey="unnamed fields")
 
         required = set(
@@ -35,6 +349,7 @@ def validate_ioclass_file(ioclass_file):
             )
 
         ioclass_ids = []
+        ioclasses = []
         for ioclass in reader:
             if "unnamed fields" in ioclass:
                 raise AnsibleError(
@@ -121,22 +436,253 @@ def validate_ioclass_file(ioclass_file):
                     )
                 )
 
+            try:
+                conditions = parse_ioclass_rule(name)
+            except IoclassRuleError as e:
+                raise AnsibleError(
+                    "Invalid IO-class rule({0}) found in {1}: {2} at "
+                    "position {3}\n  {0}\n  {4}^".format(
+                        name,
+                        ioclass_file,
+                        e.message,
+                        e.position,
+                        " " * (e.position - 1),
+                    )
+                )
+
+            for condition in set(c[0] for op, c in conditions):
+                if condition not in IOCLASS_CONDITIONS:
+                    warnings += [
+                        "Unknown condition '{0}' in IO-class rule({1}) found "
+                        "in {2}, it's left for Open CAS to check".format(
+                            condition, name, ioclass_file
+                        )
+                    ]
+
+            ioclasses += [(priority, id, name, conditions)]
+
+        warnings += validate_ioclass_rules(ioclasses, ioclass_file)
+
+    return warnings
+
+
+def recommend_ioclass_priorities(ioclasses, cache_id):
+    """
+    Reassign eviction priorities of IO classes in order of their observed hit
+    density. Unclassified class and classes with priority 0 keep their
+    priorities. Classes ending classification ('done') stay behind classes
+    whose rules they cover, so that no rule gets shadowed.
+    """
+    tunable = []
+    for ioclass in ioclasses:
+        if ioclass["id"] == 0 or ioclass["priority"] == 0:
+            continue
+
+        try:
+            conditions = parse_ioclass_rule(ioclass["name"])
+        except IoclassRuleError:
+            conditions = []
+        constraints = get_ioclass_rule_constraints(conditions)
+        done = "done" in [c[0] for op, c in conditions]
+        tunable += [(ioclass, constraints if done else None)]
+
+    def is_covering(covering, covered):
+        return (
+            covering[1] is not None
+            and covered[1] is not None
+            and is_ioclass_rule_implied(covering[1], covered[1])
+        )
+
+    remaining = sorted(
+        tunable, key=lambda c: (-c[0]["hit_density"], c[0]["id"])
+    )
+    ordered = []
+    while remaining:
+        for candidate in remaining:
+            if not any(
+                is_covering(candidate, other)
+                for other in remaining
+                if other is not candidate
+            ):
+                break
+        else:
+            candidate = remaining[0]
+
+        remaining.remove(candidate)
+        ordered += [candidate[0]]
+
+    priorities = sorted(ioclass["priority"] for ioclass, _ in tunable)
+    recommended = dict(
+        (ioclass["id"], priority)
+        for ioclass, priority in zip(ordered, priorities)
+    )
+
+    recommendation = {
+        "changed": False,
+        "io_classes": [],
+        "contents": "IO class id,IO class name,Eviction priority,Allocation\n",
+    }
+    for ioclass in sorted(ioclasses, key=lambda c: c["id"]):
+        priority = recommended.get(ioclass["id"], ioclass["priority"])
+        try:
+            allocation = "{0:g}".format(float(ioclass["allocation"]))
+        except ValueError:
+            allocation = ioclass["allocation"]
+
+        recommendation["changed"] |= priority != ioclass["priority"]
+        recommendation["io_classes"] += [
+            {
+                "id": ioclass["id"],
+                "name": ioclass["name"],
+                "priority": ioclass["priority"],
+                "recommended_priority": priority,
+                "hit_density": ioclass["hit_density"],
+            }
+        ]
+        recommendation["contents"] += "{0},{1},{2},{3}\n".format(
+            ioclass["id"], ioclass["name"], priority, allocation
+        )
+
+    try:
+        validate_ioclass(
+            recommendation["contents"],
+            "recommendation for cache {0}".format(cache_id),
+        )
+    except AnsibleError as e:
+        recommendation["error"] = e.message
+
+    return recommendation
+
 
 class ActionModule(ActionBase):
+    # Options with cache configuration (possibly list of them) which may
+    # reference IO class file
+    IOCLASS_OPTIONS = {
+        "check_cache_config": None,
+        "configure_cache_device": None,
+        "configure_devices": "caches",
+        "desired_state": "caches",
+        "apply_io_class": None,
+    }
+
+    def find_ioclass_file(self, ioclass_file):
+        try:
+            return self._find_needle("files", ioclass_file)
+        except AnsibleError:
+            pass
+
+        roles_paths = [os.path.join(self._loader.get_basedir(), "roles")]
+        roles_paths += C.DEFAULT_ROLES_PATH
+        for roles_path in roles_paths:
+            file_path = os.path.join(
+                roles_path, "opencas-deploy", "files", ioclass_file
+            )
+            if os.path.exists(file_path):
+                return file_path
+
+        raise AnsibleError(
+            "{0} io class file wasn't found in opencas-deploy files".format(
+                ioclass_file
+            )
+        )
+
+    def get_ioclass_configs(self):
+        for option, list_key in self.IOCLASS_OPTIONS.items():
+            arg = self._task.args.get(option)
+            if not arg:
+                continue
+
+            configs = (arg.get(list_key) or []) if list_key else [arg]
+            for config in configs:
+                if config.get("io_class"):
+                    yield (option, config)
+
+    def run_generate_io_class(self, tmp, task_vars):
+        """
+        Generate IO class file on target without writing it, validate it and
+        only then let target write it
+        """
+        args = self._task.args["generate_io_class"]
+        generated = {}
+        contents = args.get("contents")
+        if contents is None:
+            results = self._execute_module(
+                module_args={"generate_io_class": dict(args, write=False)},
+                tmp=tmp,
+                task_vars=task_vars,
+            )
+            if results.get("failed"):
+                return results
+
+            generated = results["generated_io_class"]
+            contents = generated["contents"]
+
+        try:
+            warnings = validate_ioclass(
+                contents, generated.get("file", args["io_class"])
+            )
+        except AnsibleError as e:
+            return {
+                "failed": True,
+                "msg": e.message,
+                "generated_io_class": generated,
+            }
+
+        results = self._execute_module(
+            module_args={"generate_io_class": dict(args, contents=contents)},
+            tmp=tmp,
+            task_vars=task_vars,
+        )
+        if "generated_io_class" in results:
+            generated.update(results["generated_io_class"])
+            results["generated_io_class"] = generated
+        if warnings:
+            results["warnings"] = results.get("warnings", []) + warnings
+
+        return results
+
     def run(self, tmp=None, task_vars=None):
-        if (
-            "check_cache_config" in self._task.args
-            and "io_class" in self._task.args["check_cache_config"]
-            and self._task.args["check_cache_config"]["io_class"]
-        ):
-            validate_ioclass_file(
-                self._task.args["check_cache_config"]["io_class"]
+        cache_file = (task_vars or {}).get("opencas_ioclass_validation_cache")
+        if cache_file:
+            cache_file = os.path.expanduser(cache_file)
+        else:
+            cache_file = os.path.join(
+                C.DEFAULT_LOCAL_TMP, IOCLASS_VALIDATION_CACHE_FILE
             )
-            del self._task.args["check_cache_config"]["io_class"]
+
+        warnings = []
+        for option, config in list(self.get_ioclass_configs()):
+            for warning in validate_ioclass_file(
+                self.find_ioclass_file(config["io_class"]),
+                config["io_class"],
+                cache_file,
+            ):
+                if warning not in warnings:
+                    warnings += [warning]
+
+            # Validation of cache config on target can't rely on IO class file
+            # presence as it's copied over only before devices configuration
+            if option == "check_cache_config":
+                del config["io_class"]
 
         results = super(ActionModule, self).run(tmp, task_vars)
-        results = merge_hash(
-            results, self._execute_module(tmp=tmp, task_vars=task_vars)
+        if self._task.args.get("generate_io_class"):
+            module_results = self.run_generate_io_class(tmp, task_vars)
+        else:
+            module_results = self._execute_module(tmp=tmp, task_vars=task_vars)
+        results = merge_hash(results, module_results)
+        if warnings:
+            results["warnings"] = warnings + results.get("warnings", [])
+
+        ioclass_stats = results.get("ansible_facts", {}).get(
+            "opencas_ioclass_stats"
         )
+        if ioclass_stats and self._task.args["gather_ioclass_stats"].get(
+            "recommend"
+        ):
+            for cache in ioclass_stats["caches"]:
+                cache["recommendation"] = recommend_ioclass_priorities(
+                    cache["io_classes"], cache["id"]
+                )
 
         return results
@@ -3,8 +3,20 @@
 # SPDX-License-Identifier: BSD-3-Clause
 #
 
+import os
+import re
 import sys
-from copy import deepcopy
+import csv
+import stat
+import json
+import zlib
+import hashlib
+import time
+import timeit
+import subprocess
+import fcntl
+import tempfile
+import threading
 
 try:
     sys.path.append("/usr/lib/opencas/")
@@ -26,6 +38,10 @@ short_description: Manage Open CAS software
 
 description:
   - Deploy Open CAS configuration
+  - In check mode only read-only queries (casadm listings, statistics and
+    parameters) are run, operations which would change devices are reported
+    in operations and files aren't written. With diff mode changes of
+    opencas.conf and generated io classification files are reported too
 
 options:
   gather_facts:
@@ -33,6 +49,30 @@ options:
       - gathers facts about Open CAS configuration on host
     required: False
 
+  gather_stats:
+    description:
+      - gathers also statistics of running caches and cores as opencas_stats
+        fact (hit ratios, occupancy, dirty data, requests and blocks
+        counters). IO counters of exported objects are read from sysfs
+    required: False
+    default: False
+
+  gather_ioclass_stats:
+    description:
+      - gathers per IO class statistics of running caches as
+        opencas_ioclass_stats fact
+    required: False
+    suboptions:
+      cache_id:
+        description:
+          - id of cache to gather statistics of (all running caches if not
+            set)
+      recommend:
+        description:
+          - recommend eviction priorities of IO classes ordered by their hit
+            density (hits per occupied 4KiB block)
+        default: False
+
   zap:
     description:
       - empties Open CAS device configuration file
@@ -45,7 +85,83 @@ options:
       flush:
         description:
           - Should data from cache devices be flushed to primary storage
+      parallel:
+        description:
+          - Flush and stop each cache in separate worker thread. Flush
+            duration and amount of flushed data is reported for each cache
+        default: False
+      max_workers:
+        description:
+          - Maximum number of caches flushed and stopped at the same time
+            (only with parallel). All caches are stopped at once if not set
+    required: False
+
+  flush:
+    description:
+      - starts flushing dirty data of all caches in background and returns
+        without waiting for flush to finish
+    required: False
+
+  flush_status:
+    description:
+      - reports amount of dirty data left in each cache and core and flush
+        progress since flush was started with flush option
+    required: False
+
+  drain:
+    description:
+      - temporarily switches cleaning policy to aggressive ALRU settings and
+        waits until dirty data drops below given target. Original cleaning
+        policy and its parameters are restored afterwards
+    required: False
+    suboptions:
+      cache_id:
+        description:
+          - id of cache to be drained (all running caches if not set)
+      target_percent:
+        description:
+          - dirty data percentage (of cache occupancy) considered drained
+        default: 0
+      target_bytes:
+        description:
+          - amount of dirty data in bytes considered drained
+      timeout:
+        description:
+          - maximum time to wait for dirty data to drain [s]
+        default: 600
+      poll_interval:
+        description:
+          - interval between dirty data checks [s]
+        default: 5
+
+  stats_sample:
+    description:
+      - samples statistics of running caches and cores count times every
+        interval seconds and reports rates of IO, throughput, hit ratio and
+        dirty data growth. Core rates are computed from IO counters of
+        exported objects read from sysfs
     required: False
+    suboptions:
+      interval:
+        description:
+          - time between samples [s]
+        default: 1
+      count:
+        description:
+          - number of sampling intervals
+        default: 1
+
+  check_health:
+    description:
+      - checks if all caches and cores from Open CAS configuration file are
+        running and reports hit ratio of each cache
+    required: False
+    suboptions:
+      min_hit_ratio:
+        description:
+          - minimal hit ratio [%] of each cache for it to be considered
+            healthy
+        default: 0
 
   check_cache_config:
     description:
@@ -81,6 +197,15 @@ options:
       io_class:
         description:
           - name of io classification file (located in /etc/opencas/)
+      load:
+        description:
+          - Whether cache should be started with metadata loaded from cache
+            device. With auto metadata is loaded only if cache is already
+            configured in opencas.conf with the same device, force isn't set
+            and valid Open CAS metadata is found on the device, otherwise
+            cache is initialized
+        choices: ['auto', 'always', 'never']
+        default: auto
 
   configure_cache_device:
     description:
@@ -116,6 +241,15 @@ options:
       io_class:
         description:
           - name of io classification file (located in /etc/opencas/)
+      load:
+        description:
+          - Whether cache should be started with metadata loaded from cache
+            device. With auto metadata is loaded only if cache is already
+            configured in opencas.conf with the same device, force isn't set
+            and valid Open CAS metadata is found on the device, otherwise
+            cache is initialized
+        choices: ['auto', 'always', 'never']
+        default: auto
 
   check_core_config:
     description:
@@ -146,6 +280,121 @@ options:
       cached_volume:
         description:
           - path to device to be cached
+
+  configure_devices:
+    description:
+      - configure and start all cache devices and add all cores in single run
+      - opencas.conf is parsed and written only once for whole batch
+    required: False
+    suboptions:
+      caches:
+        description:
+          - list of cache devices configurations (same as for
+            configure_cache_device)
+      cores:
+        description:
+          - list of core devices configurations (same as for
+            configure_core_device)
+      parallel:
+        description:
+          - Start caches in separate worker threads and add cores of each
+            cache as soon as it is started, without waiting for other caches
+        default: False
+      max_workers:
+        description:
+          - Maximum number of caches started at the same time (only with
+            parallel). All caches are started at once if not set
+
+  desired_state:
+    description:
+      - compares given caches and cores with Open CAS configuration file and
+        running devices and applies only the differences. Cache mode,
+        cleaning and promotion policies and io classification are changed
+        on running cache, other changes require restarting it
+      - planned operations are returned in plan, devices already in desired
+        state are left untouched
+    required: False
+    suboptions:
+      caches:
+        description:
+          - list of cache devices configurations (same as for
+            configure_cache_device)
+      cores:
+        description:
+          - list of core devices configurations (same as for
+            configure_core_device)
+      prune:
+        description:
+          - stop caches and remove cores which aren't listed in caches and
+            cores (also from configuration file)
+        default: False
+      recreate:
+        description:
+          - allow restarting caches (with metadata reinitialized) and
+            reattaching cores when their device or cache line size changes.
+            When not set such change fails before anything is modified
+        default: False
+      parallel:
+        description:
+          - Start and change caches in separate worker threads and change
+            cores of each cache as soon as it is started. Caches and cores
+            are stopped and removed before that one by one
+        default: False
+      max_workers:
+        description:
+          - Maximum number of caches changed at the same time (only with
+            parallel). All caches are changed at once if not set
+
+  apply_io_class:
+    description:
+      - loads IO classification configuration on running cache without
+        stopping it. Configuration is loaded only if it differs from the one
+        currently used by cache
+    required: False
+    suboptions:
+      cache_id:
+        description:
+          - id of running cache
+      io_class:
+        description:
+          - name of io classification file (located in /etc/opencas/)
+
+  generate_io_class:
+    description:
+      - generates io classification file with file size ranges and eviction
+        priorities derived from files found on given filesystem. Files are
+        split into ranges holding similar number of files, ranges with
+        larger part of recently accessed data get higher priority
+    required: False
+    suboptions:
+      path:
+        description:
+          - mount point of filesystem on cached volume
+      io_class:
+        description:
+          - name of generated io classification file (in /etc/opencas/)
+      buckets:
+        description:
+          - maximal number of file size ranges
+        default: 10
+      sample:
+        description:
+          - fraction of files taken into account (0 - 1]
+        default: 1
+      max_files:
+        description:
+          - stop scanning after this number of files (0 - no limit)
+        default: 0
+      write:
+        description:
+          - write generated file. Action plugin generates contents with
+            write disabled and writes them with contents only after they
+            pass validation on controller
+        default: True
+      contents:
+        description:
+          - write given io classification instead of generating it (path
+            isn't needed then)
 ...
 """
 
@@ -177,6 +426,72 @@ EXAMPLES = """
       cache_id: 2
       core_id: 3
 
+- name: Configure all CAS caches and cores in single run
+  cas:
+    configure_devices:
+      caches:
+        - cache_device: /dev/nvme0n1
+          id: 2
+          cache_mode: wb
+      cores:
+        - cached_volume: /dev/sda
+          cache_id: 2
+          id: 3
+
+- name: Start CAS caches concurrently, four at the time
+  cas:
+    configure_devices:
+      caches:
+        - cache_device: /dev/nvme0n1
+          id: 1
+        - cache_device: /dev/nvme1n1
+          id: 2
+      cores:
+        - cached_volume: /dev/sda
+          cache_id: 1
+          id: 1
+        - cached_volume: /dev/sdb
+          cache_id: 2
+          id: 1
+      parallel: True
+      max_workers: 4
+
+- name: Converge CAS devices to desired state, removing unlisted ones
+  cas:
+    desired_state:
+      caches:
+        - cache_device: /dev/nvme0n1
+          id: 2
+          cache_mode: wb
+      cores:
+        - cached_volume: /dev/sda
+          cache_id: 2
+          id: 3
+      prune: True
+
+- name: Apply new IO classification to running cache
+  cas:
+    apply_io_class:
+      cache_id: 2
+      io_class: default.csv
+
+- name: Gather Open CAS facts with statistics of caches and cores
+  cas:
+    gather_facts: True
+    gather_stats: True
+
+- name: Gather IO class statistics with eviction priorities recommendation
+  cas:
+    gather_ioclass_stats:
+      recommend: True
+
+- name: Generate IO classification from files on cached volume
+  cas:
+    generate_io_class:
+      path: /mnt/data
+      io_class: data.csv
+      sample: 0.1
+
 - name: Remove Open CAS devices configuration
   cas:
     zap: True
@@ -185,9 +500,977 @@ EXAMPLES = """
   cas:
     stop:
       flush: True
+
+- name: Start flushing all Open CAS devices in background
+  cas:
+    flush: True
+
+- name: Wait until all Open CAS devices are flushed
+  cas:
+    flush_status: True
+  register: result
+  until: result.flush_status.dirty_blocks == 0
+  retries: 360
+  delay: 10
+
+- name: Bring dirty data of all caches below 1% before maintenance
+  cas:
+    drain:
+      target_percent: 1
+      timeout: 1800
+
+- name: Measure IO rates of all caches and cores over 10s
+  cas:
+    stats_sample:
+      interval: 2
+      count: 5
+  register: result
+
+- name: Wait until all configured devices are running with hit ratio >= 60%
+  cas:
+    check_health:
+      min_hit_ratio: 60
+  register: result
+  until: result.health.healthy
+  retries: 30
+  delay: 10
+
+- name: Flush and stop all Open CAS devices, two caches at the time
+  cas:
+    stop:
+      flush: True
+      parallel: True
+      max_workers: 2
+"""
+
+RETURN = """
+ansible_facts:
+  description: Facts gathered (gather_facts and gather_ioclass_stats only)
+  returned: when gather_facts or gather_ioclass_stats is set
+  type: dict
+  sample:
+    opencas_installed: True
+    opencas_installed_version:
+      Open CAS Kernel Module: 20.03.00.00000000
+      Open CAS Disk Kernel Module: 20.03.00.00000000
+      Open CAS CLI Utility: 20.03.00.00000000
+    opencas_config_nonempty: True
+    opencas_devices_started: True
+    opencas_stats:
+      caches:
+        - id: 1
+          occupancy_blocks: 1310720
+          occupancy_bytes: 5368709120
+          occupancy_percent: 50.0
+          dirty_blocks: 2560
+          dirty_bytes: 10485760
+          dirty_percent: 0.2
+          hit_ratio: 87.5
+          read_hit_ratio: 90.0
+          write_hit_ratio: 80.0
+          read_requests: 1200
+          write_requests: 400
+          serviced_requests: 1600
+          total_requests: 1650
+          pass_through_requests: 50
+          blocks:
+            reads_from_core: 300
+            writes_to_core: 100
+            reads_from_cache: 2700
+            writes_to_cache: 900
+            reads_from_exported_object: 3000
+            writes_to_exported_object: 1000
+          cores:
+            - id: 1
+              hit_ratio: 87.5
+              io:
+                reads: 1200
+                writes: 400
+                read_bytes: 12288000
+                write_bytes: 4096000
+                in_flight: 0
+                io_time_ms: 5321
+    opencas_ioclass_stats:
+      caches:
+        - id: 1
+          io_classes:
+            - id: 11
+              name: file_size:le:4096&done
+              priority: 9
+              allocation: "1.00"
+              occupancy_blocks: 2048
+              occupancy_bytes: 8388608
+              dirty_blocks: 16
+              dirty_bytes: 65536
+              read_hits: 9000
+              write_hits: 1000
+              hits: 10000
+              misses: 2500
+              hit_ratio: 80.0
+              hit_density: 4.8828
+          recommendation:
+            changed: True
+            io_classes:
+              - id: 11
+                name: file_size:le:4096&done
+                priority: 9
+                recommended_priority: 10
+                hit_density: 4.8828
+            contents: "IO class id,IO class name,Eviction priority,..."
+stopped_caches:
+  description: Per-cache flush and stop report (stop with parallel only)
+  returned: when caches were stopped
+  type: list
+  sample:
+    - id: 1
+      bytes_flushed: 1073741824
+      flush_duration: 12.37
+      stop_duration: 0.42
+flush_status:
+  description: Dirty data left in caches and cores (flush_status only)
+  returned: when flush_status is set
+  type: dict
+  sample:
+    dirty_blocks: 1024
+    percent_complete: 99.9
+    flushing: True
+    caches:
+      - id: 1
+        dirty_blocks: 1024
+        dirty_bytes: 4194304
+        initial_dirty_blocks: 1048576
+        percent_complete: 99.9
+        flushing: True
+        cores:
+          - id: 1
+            dirty_blocks: 1024
+            dirty_bytes: 4194304
+            initial_dirty_blocks: 1048576
+            percent_complete: 99.9
+drained_caches:
+  description: Dirty data before and after drain (drain only)
+  returned: when drain is set
+  type: list
+  sample:
+    - id: 1
+      initial_dirty_bytes: 53687091200
+      dirty_bytes: 4096
+      duration: 73.5
+stats_sample:
+  description:
+    - Rates over whole sampling time and over each interval (stats_sample
+      only). Throughputs and dirty data growth rates are in bytes/s
+  returned: when stats_sample is set
+  type: dict
+  sample:
+    duration: 10.012
+    caches:
+      - id: 1
+        iops: 5210.3
+        read_iops: 4100.1
+        write_iops: 1100.2
+        read_throughput: 16794009.6
+        write_throughput: 4506419.2
+        hit_ratio: 92.11
+        dirty_growth_rate: -409.6
+        cores:
+          - id: 1
+            iops: 5210.3
+            read_iops: 4100.1
+            write_iops: 1100.2
+            read_throughput: 16794009.6
+            write_throughput: 4506419.2
+    samples:
+      - duration: 2.002
+        caches: []
+health:
+  description: Health of configured caches and cores (check_health only)
+  returned: when check_health is set
+  type: dict
+  sample:
+    healthy: False
+    caches:
+      - id: 1
+        status: Running
+        hit_ratio: 42.1
+        healthy: False
+        cores:
+          - id: 1
+            status: Active
+            healthy: True
+started_caches:
+  description:
+    - Caches started in this run and whether their metadata was loaded or
+      initialized (configure_cache_device and configure_devices only)
+  returned: when caches were started
+  type: list
+  sample:
+    - id: 1
+      device: /dev/nvme0n1
+      start: load
+operations:
+  description:
+    - Operations changing devices run in this task, or which would be run
+      in check mode. Operations undone by rollback (also of journal left by
+      interrupted run) are listed with "roll back:" prefix
+  returned: when any operation was run or planned
+  type: list
+  sample:
+    - start cache 1 (/dev/nvme0n1) initializing metadata
+    - configure cache 1
+    - add core 1 (/dev/sda) to cache 1
+timings:
+  description:
+    - Start time [s] (since the task started) and duration [s] of each run
+      operation, overlapping with parallel configure_devices and
+      desired_state
+  returned: when any operation was run (not in check mode)
+  type: list
+  sample:
+    - operation: start cache 1 (/dev/nvme0n1) initializing metadata
+      start: 0.021
+      duration: 4.812
+    - operation: start cache 2 (/dev/nvme1n1) initializing metadata
+      start: 0.022
+      duration: 5.107
+    - operation: configure cache 1
+      start: 4.834
+      duration: 0.013
+plan:
+  description:
+    - Caches and cores grouped by planned action with changed settings and
+      operations executed to apply them (desired_state only)
+  returned: when desired_state is set
+  type: dict
+  sample:
+    create:
+      - type: core
+        id: 3
+        cache_id: 2
+        device: /dev/sda
+        operations:
+          - add core 3 (/dev/sda) to cache 2
+    change:
+      - type: cache
+        id: 2
+        device: /dev/nvme0n1
+        changes:
+          cache_mode:
+            from: wt
+            to: wb
+        operations:
+          - set cache mode of cache 2 to wb
+    remove: []
+    noop: []
+io_class_hash:
+  description:
+    - SHA-256 of IO classification loaded on cache (apply_io_class only),
+      null in check mode when IO class file isn't copied to host yet
+  returned: when apply_io_class is set
+  type: str
+generated_io_class:
+  description: Generated io classification (generate_io_class only)
+  returned: when generate_io_class is set
+  type: dict
+  sample:
+    file: /etc/opencas/ansible/data.csv
+    contents: "IO class id,IO class name,Eviction priority,Allocation\n..."
+    scanned_files: 120422
+    classes:
+      - id: 11
+        name: file_size:le:4096&done
+        priority: 9
+        files: 60210
+        bytes: 98213376
+        hit_density: 0.8731
 """
 
-RETURN = """ # """
+CAS_BLOCK_SIZE = 4096
+IOCLASS_FILE_PATH = "/etc/opencas/ansible/{0}"
+FLUSH_STATE_FILE = "/var/run/opencas-ansible-flush.json"
+CONFIG_LOCK_TIMEOUT = 300
+SYSFS_PATH = "/sys"
+SECTOR_SIZE = 512
+
+# Fields of /sys/block/<dev>/stat (Documentation/block/stat.rst)
+BLOCK_STAT_FIELDS = [
+    "read_ios",
+    "read_merges",
+    "read_sectors",
+    "read_ticks",
+    "write_ios",
+    "write_merges",
+    "write_sectors",
+    "write_ticks",
+    "in_flight",
+    "io_ticks",
+    "time_in_queue",
+]
+
+# casadm --get-param names of ALRU parameters mapped to --set-param options
+ALRU_PARAMS = {
+    "Wake up time [s]": "wake_up",
+    "Stale buffer time [s]": "staleness_time",
+    "Flush max buffers": "flush_max_buffers",
+    "Activity threshold [ms]": "activity_threshold",
+}
+DRAIN_ALRU_PARAMS = {
+    "wake_up": 0,
+    "staleness_time": 1,
+    "flush_max_buffers": 10000,
+    "activity_threshold": 0,
+}
+
+
+def is_cas_module_loaded():
+    return os.path.isdir(os.path.join(SYSFS_PATH, "module", "cas_cache"))
+
+
+def get_block_stat(device):
+    with open(os.path.join(SYSFS_PATH, "block", device, "stat"), "r") as f:
+        values = [int(value) for value in f.read().split()]
+
+    return dict(zip(BLOCK_STAT_FIELDS, values))
+
+
+def get_exported_objects_stats():
+    """
+    Read IO counters of Open CAS exported objects (casX-Y block devices)
+    from sysfs as {(cache_id, core_id): block stat}
+    """
+    stats = {}
+    try:
+        devices = os.listdir(os.path.join(SYSFS_PATH, "block"))
+    except OSError:
+        return stats
+
+    for device in devices:
+        match = re.match(r"^cas([0-9]+)-([0-9]+)$", device)
+        if not match:
+            continue
+
+        try:
+            stat = get_block_stat(device)
+        except (IOError, OSError, ValueError):
+            continue
+
+        stats[(int(match.group(1)), int(match.group(2)))] = stat
+
+    return stats
+
+
+def get_io_facts(stat):
+    return {
+        "reads": stat["read_ios"],
+        "writes": stat["write_ios"],
+        "read_bytes": stat["read_sectors"] * SECTOR_SIZE,
+        "write_bytes": stat["write_sectors"] * SECTOR_SIZE,
+        "in_flight": stat["in_flight"],
+        "io_time_ms": stat["io_ticks"],
+    }
+
+
+class DevicesState(object):
+    """
+    Snapshot of running Open CAS devices.
+
+    Whole state is retrieved with single casadm listing and indexed by ids and
+    device paths, so all idempotency checks within one module run are answered
+    without spawning any further casadm processes.
+    """
+
+    def __init__(self, devices_list):
+        self.devices = list(devices_list)
+        self.caches = {}
+        self.cores = {}
+        self.paths = {}
+
+        cache_id = None
+        for dev in devices_list:
+            if dev.get("type") == "cache":
+                cache_id = int(dev["id"])
+                self.caches[cache_id] = dev
+            elif dev.get("type") == "core":
+                self.cores[(cache_id, int(dev["id"]))] = dev
+            else:
+                continue
+
+            self.paths[os.path.realpath(dev["disk"])] = dev
+
+    @classmethod
+    def query(cls):
+        # No cache can be running without kernel module loaded
+        if not is_cas_module_loaded():
+            return cls([])
+
+        return cls(cas_util.get_caches_list())
+
+    def is_empty(self):
+        return len(self.devices) == 0
+
+    def get_device_by_path(self, path):
+        return self.paths.get(os.path.realpath(path))
+
+    def is_cache_started(self, cache_config):
+        if cache_config.cache_id in self.caches:
+            return True
+
+        dev = self.get_device_by_path(cache_config.device)
+        if dev is not None:
+            raise Exception(
+                "Device {0} is already used by Open CAS as {1} {2}".format(
+                    cache_config.device, dev["type"], dev["id"]
+                )
+            )
+
+        return False
+
+    def is_core_added(self, core_config):
+        if (core_config.cache_id, core_config.core_id) in self.cores:
+            return True
+
+        dev = self.get_device_by_path(core_config.device)
+        if dev is not None:
+            raise Exception(
+                "Device {0} is already used by Open CAS as {1} {2}".format(
+                    core_config.device, dev["type"], dev["id"]
+                )
+            )
+
+        return False
+
+    def add_cache(self, cache_config):
+        dev = {
+            "type": "cache",
+            "id": str(cache_config.cache_id),
+            "disk": cache_config.device,
+        }
+        self.devices += [dev]
+        self.caches[cache_config.cache_id] = dev
+        self.paths[os.path.realpath(cache_config.device)] = dev
+
+    def add_core(self, core_config):
+        dev = {
+            "type": "core",
+            "id": str(core_config.core_id),
+            "disk": core_config.device,
+        }
+        self.devices += [dev]
+        self.cores[(core_config.cache_id, core_config.core_id)] = dev
+        self.paths[os.path.realpath(core_config.device)] = dev
+
+    def remove_cache(self, cache_id):
+        for core in [core for core in self.cores if core[0] == cache_id]:
+            self.remove_core(*core)
+
+        dev = self.caches.pop(cache_id, None)
+        if dev is not None:
+            self.devices.remove(dev)
+            self.paths.pop(os.path.realpath(dev["disk"]), None)
+
+    def remove_core(self, cache_id, core_id):
+        dev = self.cores.pop((cache_id, core_id), None)
+        if dev is not None:
+            self.devices.remove(dev)
+            self.paths.pop(os.path.realpath(dev["disk"]), None)
+
+
+def get_stat_key(name):
+    """
+    Convert casadm statistic name to snake_case key, e.g.:
+    "Dirty [4KiB Blocks]" -> "dirty_4kib_blocks", "Read hits [%]" ->
+    "read_hits_percent"
+    """
+    name = name.replace("(s)", "s").replace("%", "percent")
+
+    return "_".join(re.findall(r"[a-z0-9]+", name.lower()))
+
+
+def get_stat_value(value):
+    value = value.strip()
+    if re.match(r"^-?[0-9]+$", value):
+        return int(value)
+    if re.match(r"^-?[0-9]*\.[0-9]+$", value):
+        return float(value)
+
+    return value
+
+
+def get_stats(cache_id, core_id=None, io_class_id=None):
+    cmd = [cas_util.casadm.casadm_path, "--stats", "--cache-id", str(cache_id)]
+    if core_id is not None:
+        cmd += ["--core-id", str(core_id)]
+    if io_class_id is not None:
+        cmd += ["--io-class-id", str(io_class_id)]
+    cmd += ["--output-format", "csv"]
+
+    result = cas_util.casadm.run_cmd(cmd)
+    rows = list(csv.DictReader(result.stdout.split("\n")))
+    if not rows:
+        raise Exception(
+            "Couldn't parse statistics of cache {0}".format(cache_id)
+        )
+
+    return dict(
+        (get_stat_key(name), get_stat_value(value))
+        for name, value in rows[0].items()
+        if name
+    )
+
+
+def get_params(namespace, cache_id):
+    result = cas_util.casadm.run_cmd(
+        [
+            cas_util.casadm.casadm_path,
+            "--get-param",
+            "--name",
+            namespace,
+            "--cache-id",
+            str(cache_id),
+            "--output-format",
+            "csv",
+        ]
+    )
+
+    return dict(
+        (row["Parameter name"], row["Value"])
+        for row in csv.DictReader(result.stdout.split("\n"))
+    )
+
+
+def set_params(namespace, cache_id, **params):
+    cmd = [
+        cas_util.casadm.casadm_path,
+        "--set-param",
+        "--name",
+        namespace,
+        "--cache-id",
+        str(cache_id),
+    ]
+    for name, value in sorted(params.items()):
+        cmd += ["--{0}".format(name.replace("_", "-")), str(value)]
+
+    cas_util.casadm.run_cmd(cmd)
+
+
+def run_parallel(tasks, max_workers=None):
+    """
+    Run callables from tasks list on at most max_workers threads.
+    Returns list of (result, exception) tuples in order of tasks.
+    """
+    results = [(None, None)] * len(tasks)
+    pending = list(enumerate(tasks))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, task = pending.pop(0)
+
+            try:
+                results[index] = (task(), None)
+            except Exception as e:
+                results[index] = (None, e)
+
+    workers_count = min(max_workers or len(tasks), len(tasks))
+    threads = [threading.Thread(target=worker) for i in range(workers_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def run_chains(transaction, chains, max_workers=None):
+    """
+    Run chains of operations (functions taking transaction) on at most
+    max_workers threads. Operations of each chain depend on previous ones, so
+    they are run in order, one right after another, while chains run
+    independently. After any operation fails, operations which haven't been
+    started yet are skipped. Returns list of results of each chain.
+    """
+    failed = threading.Event()
+
+    def run_chain(chain):
+        results = []
+        for operation in chain:
+            if failed.is_set():
+                break
+
+            try:
+                results += [operation(transaction)]
+            except:
+                failed.set()
+                raise
+
+        return results
+
+    results = run_parallel(
+        [lambda chain=chain: run_chain(chain) for chain in chains], max_workers
+    )
+
+    errors = [e for _, e in results if e is not None]
+    if len(errors) == 1:
+        raise errors[0]
+    if errors:
+        raise Exception(
+            "Operations failed ({0})".format(
+                "; ".join(get_error_message(e) for e in errors)
+            )
+        )
+
+    return [result for result, _ in results]
+
+
+def write_atomic(path, write):
+    """
+    Write file with write(tmp_path) to temporary file in the same directory,
+    fsync it and rename it over path, so path is never left partially written
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=".{0}.".format(os.path.basename(path))
+    )
+    os.close(fd)
+    try:
+        write(tmp_path)
+        with open(tmp_path, "r+") as f:
+            os.fsync(f.fileno())
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except (IOError, OSError):
+            mode = 0o644
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+    # Make rename itself durable
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def write_text_atomic(path, text):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write(text)
+
+    write_atomic(path, write)
+
+
+def get_config_text(config):
+    """ Render config as it would be written to opencas.conf """
+    fd, path = tempfile.mkstemp(prefix="opencas.conf.")
+    os.close(fd)
+    try:
+        config.write(path)
+        with open(path, "r") as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+
+class Operations(object):
+    """
+    Operations changing devices and files run by the module. In check mode
+    operations are only recorded and files aren't written, so planned changes
+    can be reported without touching devices. With diff enabled changes of
+    written files are recorded too. Start time (since module run started) and
+    duration of each operation run are recorded in timings.
+    """
+
+    def __init__(self, check_mode=False, diff=False):
+        self.check_mode = check_mode
+        self.diff = diff
+        self.operations = []
+        self.timings = []
+        self.started = timeit.default_timer()
+        self.diffs = []
+        self.config_text = None
+        self.config_lock = None
+        self.lock = threading.Lock()
+
+    def run(self, description, action, *args, **kwargs):
+        with self.lock:
+            self.operations += [description]
+
+        if self.check_mode:
+            return None
+
+        start = timeit.default_timer()
+        try:
+            return action(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.timings += [
+                    {
+                        "operation": description,
+                        "start": round(start - self.started, 3),
+                        "duration": round(timeit.default_timer() - start, 3),
+                    }
+                ]
+
+    def lock_config(self):
+        """
+        Take lock on opencas.conf (held until unlock_config()) to serialize
+        changes with other module runs
+        """
+        if self.check_mode or self.config_lock is not None:
+            return
+
+        lock = open(cas_util.cas_config.default_location + ".lock", "a")
+        start = time.time()
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                if time.time() - start >= CONFIG_LOCK_TIMEOUT:
+                    lock.close()
+                    raise Exception(
+                        "Timed out waiting for lock on {0}".format(
+                            cas_util.cas_config.default_location
+                        )
+                    )
+                time.sleep(0.1)
+
+        self.config_lock = lock
+
+    def unlock_config(self):
+        if self.config_lock is not None:
+            self.config_lock.close()
+            self.config_lock = None
+
+    def read_config(self):
+        self.lock_config()
+        config = cas_util.cas_config.from_file(
+            cas_util.cas_config.default_location
+        )
+        if self.check_mode or self.diff:
+            self.config_text = get_config_text(config)
+
+        return config
+
+    def write_config(self, config):
+        if self.config_text is not None:
+            self.add_diff(
+                cas_util.cas_config.default_location,
+                self.config_text,
+                get_config_text(config),
+            )
+
+        if not self.check_mode:
+            write_atomic(cas_util.cas_config.default_location, config.write)
+
+    def write_file(self, path, before, after):
+        if self.check_mode or self.diff:
+            self.add_diff(path, before, after)
+
+        if not self.check_mode:
+            write_text_atomic(path, after)
+
+    def add_diff(self, path, before, after):
+        self.diffs += [
+            {
+                "before_header": path,
+                "after_header": path,
+                "before": before,
+                "after": after,
+            }
+        ]
+
+
+def read_text(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def get_error_message(error):
+    if isinstance(error, cas_util.casadm.CasadmError):
+        return error.result.stderr
+
+    return str(error)
+
+
+class Transaction(object):
+    """
+    Changes of opencas.conf and devices applied together. Before anything is
+    changed opencas.conf text snapshot is saved in journal next to it, each
+    operation is recorded there with operation undoing it. On failure applied
+    operations are undone in reverse order and opencas.conf is restored.
+    Journal left by interrupted run is rolled back by next transaction before
+    it reads configuration. Operations may be run from several threads.
+    """
+
+    def __init__(self, ops):
+        self.ops = ops
+        self.path = cas_util.cas_config.default_location + ".journal"
+        self.config_text = None
+        self.steps = []
+        self.lock = threading.Lock()
+
+    def read_config(self):
+        self.ops.lock_config()
+        self.recover()
+
+        config = self.ops.read_config()
+        self.config_text = read_text(cas_util.cas_config.default_location)
+
+        return config
+
+    def write_config(self, config):
+        self.save()
+        self.ops.write_config(config)
+
+    def run(self, description, undo, action, *args, **kwargs):
+        """ Run operation, undo is [name, args...] of undo_operation() """
+        step = {"operation": description, "undo": undo, "done": False}
+        with self.lock:
+            self.steps += [step]
+            self.save()
+
+        try:
+            result = self.ops.run(description, action, *args, **kwargs)
+        except:
+            with self.lock:
+                self.steps.remove(step)
+            raise
+
+        with self.lock:
+            step["done"] = True
+            self.save()
+
+        return result
+
+    def commit(self):
+        self.steps = []
+        self.remove()
+
+    def rollback(self, state=None):
+        """
+        Undo operations in reverse order and restore opencas.conf. With
+        devices state given, undo operations whose result it already shows
+        are skipped
+        """
+        errors = []
+        for step in list(reversed(self.steps)):
+            if step["undo"] is not None and not (
+                state is not None and is_undo_applied(state, step["undo"])
+            ):
+                try:
+                    self.ops.run(
+                        "roll back: {0}".format(step["operation"]),
+                        undo_operation,
+                        *step["undo"]
+                    )
+                except Exception as e:
+                    # Operation interrupted by crash might not be applied
+                    if step["done"]:
+                        errors += [
+                            "{0}: {1}".format(
+                                step["operation"], get_error_message(e)
+                            )
+                        ]
+                        continue
+
+            self.steps.remove(step)
+            self.save()
+
+        if self.config_text is not None and not self.ops.check_mode:
+            write_text_atomic(
+                cas_util.cas_config.default_location, self.config_text
+            )
+
+        if errors:
+            raise Exception(
+                "Couldn't roll back operations ({0}), journal kept in "
+                "{1}".format("; ".join(errors), self.path)
+            )
+
+        self.remove()
+
+    def recover(self):
+        """
+        Roll back journal left by interrupted run. Devices might have been
+        changed since then (e.g. stopped by teardown), so only operations
+        whose effect is still visible are undone
+        """
+        journal = read_text(self.path)
+        if journal is None:
+            return
+
+        try:
+            journal = json.loads(journal)
+        except ValueError:
+            raise Exception("Corrupted journal {0}".format(self.path))
+
+        self.config_text = journal["config"]
+        self.steps = journal["steps"]
+        self.rollback(DevicesState.query())
+        self.config_text = None
+
+    def save(self):
+        if self.ops.check_mode:
+            return
+
+        write_text_atomic(
+            self.path,
+            json.dumps({"config": self.config_text, "steps": self.steps}),
+        )
+
+    def remove(self):
+        if self.ops.check_mode:
+            return
+
+        try:
+            os.unlink(self.path)
+        except (IOError, OSError):
+            pass
+
+
+def is_undo_applied(state, undo):
+    """ Check if devices state already is what undo operation would bring """
+    name, args = undo[0], undo[1:]
+    if name == "stop_cache":
+        return args[0] not in state.caches
+    if name == "load_cache":
+        return args[0] in state.caches
+    if name == "add_core":
+        return (args[0], args[1]) in state.cores
+    if name == "remove_core":
+        return (args[0], args[1]) not in state.cores
+
+    # Parameters can't be restored on cache which isn't running anymore
+    return args[0 if name == "set_cache_mode" else 1] not in state.caches
+
+
+def undo_operation(name, *args):
+    if name == "stop_cache":
+        cas_util.casadm.stop_cache(cache_id=args[0], no_flush=False)
+    elif name == "load_cache":
+        cas_util.start_cache(
+            cas_util.cas_config.cache_config(*args), load=True, force=False
+        )
+    elif name == "add_core":
+        cas_util.add_core(cas_util.cas_config.core_config(*args), False)
+    elif name == "remove_core":
+        remove_core(*args)
+    elif name == "set_cache_mode":
+        set_cache_mode(*args)
+    elif name == "set_params":
+        set_params(args[0], args[1], **args[2])
+    else:
+        raise Exception("Unknown undo operation ({0})".format(name))
 
 
 def gather_facts():
@@ -212,16 +1495,96 @@ def gather_facts():
     else:
         ret["opencas_config_nonempty"] = not config.is_empty()
 
-    ret["opencas_devices_started"] = len(cas_util.get_caches_list()) != 0
+    ret["opencas_devices_started"] = not DevicesState.query().is_empty()
 
     return ret
 
 
-def zap():
+def get_ratio(part, total):
+    if total == 0:
+        return 0.0
+
+    return round(100.0 * part / total, 2)
+
+
+def get_stats_facts(stats):
+    """ Pick typed usage, request and block statistics from get_stats() """
+    read_total = stats.get("read_total_requests", 0)
+    write_total = stats.get("write_total_requests", 0)
+
+    return {
+        "occupancy_blocks": stats.get("occupancy_4kib_blocks", 0),
+        "occupancy_bytes": stats.get("occupancy_4kib_blocks", 0)
+        * CAS_BLOCK_SIZE,
+        "occupancy_percent": float(stats.get("occupancy_percent", 0)),
+        "dirty_blocks": stats.get("dirty_4kib_blocks", 0),
+        "dirty_bytes": stats.get("dirty_4kib_blocks", 0) * CAS_BLOCK_SIZE,
+        "dirty_percent": float(stats.get("dirty_percent", 0)),
+        "hit_ratio": get_ratio(
+            stats.get("read_hits_requests", 0)
+            + stats.get("write_hits_requests", 0),
+            read_total + write_total,
+        ),
+        "read_hit_ratio": get_ratio(
+            stats.get("read_hits_requests", 0), read_total
+        ),
+        "write_hit_ratio": get_ratio(
+            stats.get("write_hits_requests", 0), write_total
+        ),
+        "read_requests": read_total,
+        "write_requests": write_total,
+        "serviced_requests": stats.get("serviced_requests_requests", 0),
+        "total_requests": stats.get("total_requests_requests", 0),
+        "pass_through_requests": stats.get("pass_through_reads_requests", 0)
+        + stats.get("pass_through_writes_requests", 0),
+        "blocks": {
+            "reads_from_core": stats.get("reads_from_cores_4kib_blocks", 0),
+            "writes_to_core": stats.get("writes_to_cores_4kib_blocks", 0),
+            "reads_from_cache": stats.get("reads_from_cache_4kib_blocks", 0),
+            "writes_to_cache": stats.get("writes_to_cache_4kib_blocks", 0),
+            "reads_from_exported_object": stats.get(
+                "reads_from_exported_objects_4kib_blocks", 0
+            ),
+            "writes_to_exported_object": stats.get(
+                "writes_to_exported_objects_4kib_blocks", 0
+            ),
+        },
+    }
+
+
+def gather_stats():
+    state = DevicesState.query()
+    io_stats = get_exported_objects_stats()
+
+    caches = []
+    for cache_id in sorted(state.caches.keys()):
+        cache = {"id": cache_id}
+        cache.update(get_stats_facts(get_stats(cache_id)))
+        cache["cores"] = []
+        for core_cache_id, core_id in sorted(state.cores.keys()):
+            if core_cache_id != cache_id:
+                continue
+
+            core = {"id": core_id}
+            core.update(get_stats_facts(get_stats(cache_id, core_id)))
+            if (cache_id, core_id) in io_stats:
+                core["io"] = get_io_facts(io_stats[(cache_id, core_id)])
+            cache["cores"] += [core]
+
+        caches += [cache]
+
+    return {"caches": caches}
+
+
+def zap(ops):
+    transaction = Transaction(ops)
+
+    # Only missing or unparsable configuration means there is nothing to zap,
+    # lock timeout and journal rollback failures are reported
+    ops.lock_config()
+    transaction.recover()
     try:
-        original_config = cas_util.cas_config.from_file(
-            cas_util.cas_config.default_location
-        )
+        original_config = transaction.read_config()
     except:
         return False
 
@@ -230,23 +1593,537 @@ def zap():
 
     empty_config = cas_util.cas_config(version_tag=original_config.version_tag)
 
-    empty_config.write(cas_util.cas_config.default_location)
+    try:
+        transaction.write_config(empty_config)
+    except:
+        transaction.rollback()
+        raise
+
+    transaction.commit()
 
     return True
 
 
-def stop(flush):
-    if len(cas_util.get_caches_list()) == 0:
+def stop(ops, flush):
+    state = DevicesState.query()
+    if state.is_empty():
         return False
 
-    cas_util.stop(flush)
+    ops.run(
+        "stop caches {0}{1}".format(
+            ", ".join(str(cache_id) for cache_id in sorted(state.caches)),
+            " (flush dirty data)" if flush else "",
+        ),
+        cas_util.stop,
+        flush,
+    )
 
-    if len(cas_util.get_caches_list()) != 0:
+    if not ops.check_mode and not DevicesState.query().is_empty():
         raise Exception("Couldn't stop all cache devices")
 
     return True
 
 
+def flush_and_stop_cache(ops, cache_id, flush):
+    report = {"id": cache_id, "bytes_flushed": 0, "flush_duration": 0.0}
+
+    if flush:
+        dirty = get_stats(cache_id)["dirty_4kib_blocks"]
+
+        start = time.time()
+        ops.run(
+            "flush cache {0}".format(cache_id),
+            cas_util.casadm.run_cmd,
+            [
+                cas_util.casadm.casadm_path,
+                "--flush-cache",
+                "--cache-id",
+                str(cache_id),
+            ],
+        )
+        report["flush_duration"] = round(time.time() - start, 3)
+        report["bytes_flushed"] = dirty * CAS_BLOCK_SIZE
+
+    start = time.time()
+    ops.run(
+        "stop cache {0}".format(cache_id),
+        cas_util.casadm.stop_cache,
+        cache_id=cache_id,
+        no_flush=not flush,
+    )
+    report["stop_duration"] = round(time.time() - start, 3)
+
+    return report
+
+
+def stop_parallel(ops, flush, max_workers=None):
+    state = DevicesState.query()
+    cache_ids = sorted(state.caches.keys())
+    if not cache_ids:
+        return []
+
+    results = run_parallel(
+        [
+            (
+                lambda cache_id=cache_id: flush_and_stop_cache(
+                    ops, cache_id, flush
+                )
+            )
+            for cache_id in cache_ids
+        ],
+        max_workers,
+    )
+
+    errors = []
+    for cache_id, (report, error) in zip(cache_ids, results):
+        if isinstance(error, cas_util.casadm.CasadmError):
+            errors += ["cache {0}: {1}".format(cache_id, error.result.stderr)]
+        elif error is not None:
+            errors += ["cache {0}: {1}".format(cache_id, error)]
+
+    if errors:
+        raise Exception(
+            "Couldn't stop all cache devices ({0})".format("; ".join(errors))
+        )
+
+    if not ops.check_mode and not DevicesState.query().is_empty():
+        raise Exception("Couldn't stop all cache devices")
+
+    return [report for report, error in results]
+
+
+def is_flush_running(pid):
+    try:
+        with open("/proc/{0}/cmdline".format(pid), "rb") as f:
+            cmdline = f.read().split(b"\0")
+    except (IOError, OSError):
+        return False
+
+    return b"--flush-cache" in cmdline
+
+
+def load_flush_state():
+    try:
+        with open(FLUSH_STATE_FILE, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {"caches": {}}
+
+
+def start_flush(cache_id):
+    """ Start flushing cache in background process, returns its pid """
+    with open(os.devnull, "r+") as devnull:
+        process = subprocess.Popen(
+            [
+                cas_util.casadm.casadm_path,
+                "--flush-cache",
+                "--cache-id",
+                str(cache_id),
+            ],
+            stdin=devnull,
+            stdout=devnull,
+            stderr=devnull,
+            close_fds=True,
+            preexec_fn=os.setsid,
+        )
+
+    return process.pid
+
+
+def flush(ops):
+    state = DevicesState.query()
+    flush_state = load_flush_state()
+
+    changed = False
+    for cache_id in sorted(state.caches.keys()):
+        cache_state = flush_state["caches"].get(str(cache_id))
+        if cache_state and is_flush_running(cache_state["pid"]):
+            continue
+
+        dirty = get_stats(cache_id)["dirty_4kib_blocks"]
+        if dirty == 0:
+            continue
+
+        cores_dirty = {}
+        for cache, core_id in state.cores.keys():
+            if cache == cache_id:
+                cores_dirty[str(core_id)] = get_stats(cache_id, core_id)[
+                    "dirty_4kib_blocks"
+                ]
+
+        pid = ops.run(
+            "flush cache {0} in background".format(cache_id),
+            start_flush,
+            cache_id,
+        )
+
+        flush_state["caches"][str(cache_id)] = {
+            "pid": pid,
+            "dirty_blocks": dirty,
+            "cores": cores_dirty,
+        }
+        changed = True
+
+    if changed and not ops.check_mode:
+        write_text_atomic(FLUSH_STATE_FILE, json.dumps(flush_state))
+
+    return changed
+
+
+def get_flush_progress(dirty, initial_dirty):
+    if not initial_dirty or dirty == 0:
+        return 100.0 if dirty == 0 else 0.0
+
+    done = max(initial_dirty - dirty, 0)
+
+    return round(100.0 * done / initial_dirty, 1)
+
+
+def flush_status():
+    state = DevicesState.query()
+    flush_state = load_flush_state()
+
+    ret = {"dirty_blocks": 0, "flushing": False, "caches": []}
+    initial_total = 0
+    for cache_id in sorted(state.caches.keys()):
+        cache_state = flush_state["caches"].get(str(cache_id), {})
+        dirty = get_stats(cache_id)["dirty_4kib_blocks"]
+        initial_dirty = cache_state.get("dirty_blocks", dirty)
+
+        cache = {
+            "id": cache_id,
+            "dirty_blocks": dirty,
+            "dirty_bytes": dirty * CAS_BLOCK_SIZE,
+            "initial_dirty_blocks": initial_dirty,
+            "percent_complete": get_flush_progress(dirty, initial_dirty),
+            "flushing": "pid" in cache_state
+            and is_flush_running(cache_state["pid"]),
+            "cores": [],
+        }
+
+        for core_cache_id, core_id in sorted(state.cores.keys()):
+            if core_cache_id != cache_id:
+                continue
+
+            core_dirty = get_stats(cache_id, core_id)["dirty_4kib_blocks"]
+            core_initial_dirty = cache_state.get("cores", {}).get(
+                str(core_id), core_dirty
+            )
+            cache["cores"] += [
+                {
+                    "id": core_id,
+                    "dirty_blocks": core_dirty,
+                    "dirty_bytes": core_dirty * CAS_BLOCK_SIZE,
+                    "initial_dirty_blocks": core_initial_dirty,
+                    "percent_complete": get_flush_progress(
+                        core_dirty, core_initial_dirty
+                    ),
+                }
+            ]
+
+        ret["caches"] += [cache]
+        ret["dirty_blocks"] += dirty
+        ret["flushing"] = ret["flushing"] or cache["flushing"]
+        initial_total += initial_dirty
+
+    ret["percent_complete"] = get_flush_progress(
+        ret["dirty_blocks"], initial_total
+    )
+
+    return ret
+
+
+def is_drained(stats, target_percent, target_bytes):
+    if stats["dirty_percent"] > target_percent:
+        return False
+
+    if target_bytes is None:
+        return True
+
+    return stats["dirty_4kib_blocks"] * CAS_BLOCK_SIZE <= target_bytes
+
+
+def drain(ops, config):
+    try:
+        target_percent = float(config.get("target_percent") or 0)
+        target_bytes = config.get("target_bytes")
+        if target_bytes is not None:
+            target_bytes = int(target_bytes)
+        timeout = float(config.get("timeout") or 600)
+        poll_interval = float(config.get("poll_interval") or 5)
+    except (TypeError, ValueError):
+        raise Exception("Invalid drain parameters")
+
+    if config.get("cache_id") is not None:
+        cache_ids = [int(config["cache_id"])]
+    else:
+        cache_ids = sorted(DevicesState.query().caches.keys())
+
+    reports = {}
+    for cache_id in cache_ids:
+        stats = get_stats(cache_id)
+        reports[cache_id] = {
+            "id": cache_id,
+            "initial_dirty_bytes": stats["dirty_4kib_blocks"] * CAS_BLOCK_SIZE,
+            "dirty_bytes": stats["dirty_4kib_blocks"] * CAS_BLOCK_SIZE,
+            "duration": 0.0,
+        }
+        if is_drained(stats, target_percent, target_bytes):
+            del reports[cache_id]
+
+    original_params = {}
+    start = time.time()
+    try:
+        for cache_id in sorted(reports.keys()):
+            original_params[cache_id] = (
+                list(get_params("cleaning", cache_id).values())[0],
+                get_params("cleaning-alru", cache_id),
+            )
+            ops.run(
+                "set cleaning policy of cache {0} to alru".format(cache_id),
+                set_params,
+                "cleaning",
+                cache_id,
+                policy="alru",
+            )
+            ops.run(
+                "set aggressive alru parameters of cache {0}".format(cache_id),
+                set_params,
+                "cleaning-alru",
+                cache_id,
+                **DRAIN_ALRU_PARAMS
+            )
+
+        # Nothing is going to be drained in check mode
+        pending = set() if ops.check_mode else set(reports.keys())
+        while pending:
+            for cache_id in sorted(pending):
+                stats = get_stats(cache_id)
+                reports[cache_id]["dirty_bytes"] = (
+                    stats["dirty_4kib_blocks"] * CAS_BLOCK_SIZE
+                )
+                reports[cache_id]["duration"] = round(time.time() - start, 3)
+                if is_drained(stats, target_percent, target_bytes):
+                    pending.remove(cache_id)
+
+            if not pending:
+                break
+
+            if time.time() - start >= timeout:
+                raise Exception(
+                    "Timed out waiting for dirty data to drain in caches: "
+                    "{0}".format(", ".join(str(i) for i in sorted(pending)))
+                )
+
+            time.sleep(poll_interval)
+    finally:
+        for cache_id, (policy, alru_params) in original_params.items():
+            ops.run(
+                "restore alru parameters of cache {0}".format(cache_id),
+                set_params,
+                "cleaning-alru",
+                cache_id,
+                **dict(
+                    (ALRU_PARAMS[name], value)
+                    for name, value in alru_params.items()
+                    if name in ALRU_PARAMS
+                )
+            )
+            ops.run(
+                "set cleaning policy of cache {0} to {1}".format(
+                    cache_id, policy
+                ),
+                set_params,
+                "cleaning",
+                cache_id,
+                policy=policy,
+            )
+
+    return [reports[cache_id] for cache_id in sorted(reports.keys())]
+
+
+def get_hit_ratio(stats):
+    hits = stats["read_hits_requests"] + stats["write_hits_requests"]
+    total = stats["read_total_requests"] + stats["write_total_requests"]
+
+    return get_ratio(hits, total)
+
+
+def check_health(config):
+    try:
+        min_hit_ratio = float(config.get("min_hit_ratio") or 0)
+    except (TypeError, ValueError):
+        raise Exception("Invalid min_hit_ratio parameter")
+
+    opencas_config = cas_util.cas_config.from_file(
+        cas_util.cas_config.default_location
+    )
+    state = DevicesState.query()
+
+    ret = {"healthy": True, "caches": []}
+    for cache_config in sorted(
+        opencas_config.caches.values(), key=lambda c: c.cache_id
+    ):
+        cache_id = cache_config.cache_id
+        dev = state.caches.get(cache_id)
+        cache = {
+            "id": cache_id,
+            "status": dev.get("status", "Running") if dev else "Not running",
+            "hit_ratio": None,
+            "cores": [],
+        }
+        cache["healthy"] = cache["status"] == "Running"
+
+        if dev:
+            cache["hit_ratio"] = get_hit_ratio(get_stats(cache_id))
+            if cache["hit_ratio"] < min_hit_ratio:
+                cache["healthy"] = False
+
+        for core_config in opencas_config.cores:
+            if core_config.cache_id != cache_id:
+                continue
+
+            dev = state.cores.get((cache_id, core_config.core_id))
+            core = {
+                "id": core_config.core_id,
+                "status": dev.get("status", "Active") if dev else "Not added",
+            }
+            core["healthy"] = core["status"] == "Active"
+            cache["healthy"] = cache["healthy"] and core["healthy"]
+            cache["cores"] += [core]
+
+        ret["healthy"] = ret["healthy"] and cache["healthy"]
+        ret["caches"] += [cache]
+
+    return ret
+
+
+def get_stats_snapshot(cache_ids):
+    """
+    Take counters of caches (one casadm call per cache) and of all exported
+    objects (single sysfs pass)
+    """
+    return {
+        "time": time.time(),
+        "caches": dict(
+            (cache_id, get_stats(cache_id)) for cache_id in cache_ids
+        ),
+        "io": get_exported_objects_stats(),
+    }
+
+
+def get_rate(before, after, key, duration, scale=1):
+    return round((after.get(key, 0) - before.get(key, 0)) * scale / duration, 2)
+
+
+def get_cache_rates(before, after, duration):
+    def delta(*keys):
+        return sum(after.get(key, 0) - before.get(key, 0) for key in keys)
+
+    return {
+        "iops": get_rate(before, after, "total_requests_requests", duration),
+        "read_iops": get_rate(before, after, "read_total_requests", duration),
+        "write_iops": get_rate(before, after, "write_total_requests", duration),
+        "read_throughput": get_rate(
+            before,
+            after,
+            "reads_from_exported_objects_4kib_blocks",
+            duration,
+            CAS_BLOCK_SIZE,
+        ),
+        "write_throughput": get_rate(
+            before,
+            after,
+            "writes_to_exported_objects_4kib_blocks",
+            duration,
+            CAS_BLOCK_SIZE,
+        ),
+        "hit_ratio": get_ratio(
+            delta("read_hits_requests", "write_hits_requests"),
+            delta("read_total_requests", "write_total_requests"),
+        ),
+        "dirty_growth_rate": get_rate(
+            before, after, "dirty_4kib_blocks", duration, CAS_BLOCK_SIZE
+        ),
+    }
+
+
+def get_core_rates(before, after, duration):
+    read_iops = get_rate(before, after, "read_ios", duration)
+    write_iops = get_rate(before, after, "write_ios", duration)
+
+    return {
+        "iops": round(read_iops + write_iops, 2),
+        "read_iops": read_iops,
+        "write_iops": write_iops,
+        "read_throughput": get_rate(
+            before, after, "read_sectors", duration, SECTOR_SIZE
+        ),
+        "write_throughput": get_rate(
+            before, after, "write_sectors", duration, SECTOR_SIZE
+        ),
+    }
+
+
+def get_sample_rates(state, before, after):
+    duration = after["time"] - before["time"]
+
+    caches = []
+    for cache_id in sorted(state.caches.keys()):
+        cache = {"id": cache_id}
+        cache.update(
+            get_cache_rates(
+                before["caches"][cache_id], after["caches"][cache_id], duration
+            )
+        )
+        cache["cores"] = []
+        for core in sorted(state.cores.keys()):
+            if core[0] != cache_id:
+                continue
+            if core not in before["io"] or core not in after["io"]:
+                continue
+
+            rates = {"id": core[1]}
+            rates.update(
+                get_core_rates(before["io"][core], after["io"][core], duration)
+            )
+            cache["cores"] += [rates]
+
+        caches += [cache]
+
+    return {"duration": round(duration, 3), "caches": caches}
+
+
+def stats_sample(config):
+    try:
+        interval = float(config.get("interval") or 1)
+        count = int(config.get("count") or 1)
+    except (TypeError, ValueError):
+        raise Exception("Invalid stats sampling parameters")
+
+    if interval <= 0 or count < 1:
+        raise Exception(
+            "Invalid stats sampling parameters (interval: {0}, count: "
+            "{1})".format(interval, count)
+        )
+
+    state = DevicesState.query()
+    cache_ids = sorted(state.caches.keys())
+
+    snapshots = [get_stats_snapshot(cache_ids)]
+    for i in range(count):
+        time.sleep(interval)
+        snapshots += [get_stats_snapshot(cache_ids)]
+
+    ret = get_sample_rates(state, snapshots[0], snapshots[-1])
+    ret["samples"] = [
+        get_sample_rates(state, before, after)
+        for before, after in zip(snapshots, snapshots[1:])
+    ]
+
+    return ret
+
+
 def handle_core_config(config):
     try:
         path = config["cached_volume"]
@@ -266,18 +2143,27 @@ def check_core_config(config):
     core_config.validate_config()
 
 
-def configure_core_device(config):
+def add_core(transaction, core_config):
+    transaction.run(
+        "add core {0} ({1}) to cache {2}".format(
+            core_config.core_id, core_config.device, core_config.cache_id
+        ),
+        ["remove_core", core_config.cache_id, core_config.core_id],
+        cas_util.add_core,
+        core_config,
+        False,
+    )
+
+
+def configure_core_device(ops, config):
     path, core_id, cache_id = handle_core_config(config)
 
+    transaction = Transaction(ops)
     try:
-        config = cas_util.cas_config.from_file(
-            cas_util.cas_config.default_location
-        )
+        config = transaction.read_config()
     except:
         raise
 
-    config_copy = deepcopy(config)
-
     changed = True
     core_config = cas_util.cas_config.core_config(cache_id, core_id, path)
 
@@ -285,22 +2171,24 @@ def configure_core_device(config):
         config.insert_core(core_config)
     except cas_util.cas_config.AlreadyConfiguredException:
         changed = False
-    else:
-        config.write(cas_util.cas_config.default_location)
-
-    if cas_util.is_core_added(core_config):
-        return changed
 
     try:
-        cas_util.add_core(core_config, False)
+        if changed:
+            transaction.write_config(config)
+
+        if not DevicesState.query().is_core_added(core_config):
+            add_core(transaction, core_config)
+            changed = True
     except cas_util.casadm.CasadmError as e:
-        config_copy.write(cas_util.cas_config.default_location)
+        transaction.rollback()
         raise Exception("Internal casadm error({0})".format(e.result.stderr))
     except:
-        config_copy.write(cas_util.cas_config.default_location)
+        transaction.rollback()
         raise
 
-    return True
+    transaction.commit()
+
+    return changed
 
 
 def handle_cache_config(config):
@@ -318,7 +2206,7 @@ def handle_cache_config(config):
 
     io_class = config.get("io_class")
     if io_class:
-        params["ioclass_file"] = "/etc/opencas/ansible/{0}".format(io_class)
+        params["ioclass_file"] = IOCLASS_FILE_PATH.format(io_class)
 
     cleaning_policy = config.get("cleaning_policy")
     if cleaning_policy:
@@ -330,91 +2218,1324 @@ def handle_cache_config(config):
 
     force = config.get("force")
 
-    return (path, cache_id, cache_mode, params, force)
+    load = config.get("load") or "auto"
+    if load not in ["auto", "always", "never"]:
+        raise Exception("Invalid load parameter ({0})".format(load))
+
+    return (path, cache_id, cache_mode, params, force, load)
+
+
+def has_cache_metadata(path):
+    try:
+        result = cas_util.casadm.run_cmd(
+            [
+                cas_util.casadm.casadm_path,
+                "--script",
+                "--check-cache-device",
+                "--cache-device",
+                path,
+                "--output-format",
+                "csv",
+            ]
+        )
+    except cas_util.casadm.CasadmError:
+        return False
+
+    rows = list(csv.DictReader(result.stdout.split("\n")))
+
+    return len(rows) != 0 and rows[0].get("Is cache") == "yes"
+
+
+def get_cache_load(cache_config, force, load, configured):
+    """
+    Resolve load parameter to 'always' or 'never'. With load set to auto
+    metadata is loaded only for cache which was already configured in
+    opencas.conf and isn't forced, metadata found on other devices could be
+    left by different cache (e.g. after teardown)
+    """
+    if load != "auto":
+        return load
+
+    return (
+        "always"
+        if configured and not force and has_cache_metadata(cache_config.device)
+        else "never"
+    )
+
+
+def is_cache_configured(cache_config):
+    """ Check if cache is already configured in opencas.conf """
+    try:
+        config = cas_util.cas_config.from_file(
+            cas_util.cas_config.default_location
+        )
+        config.insert_cache(cache_config)
+    except cas_util.cas_config.AlreadyConfiguredException:
+        return True
+    except:
+        pass
+
+    return False
+
+
+def start_cache(transaction, cache_config, force, load, configured):
+    """ Start and configure cache, returns 'load' or 'init' """
+    load = get_cache_load(cache_config, force, load, configured)
+
+    if load == "always":
+        transaction.run(
+            "start cache {0} ({1}) loading metadata".format(
+                cache_config.cache_id, cache_config.device
+            ),
+            ["stop_cache", cache_config.cache_id],
+            cas_util.start_cache,
+            cache_config,
+            load=True,
+            force=False,
+        )
+    else:
+        transaction.run(
+            "start cache {0} ({1}) initializing metadata".format(
+                cache_config.cache_id, cache_config.device
+            ),
+            ["stop_cache", cache_config.cache_id],
+            cas_util.start_cache,
+            cache_config,
+            load=False,
+            force=force,
+        )
+
+    transaction.run(
+        "configure cache {0}".format(cache_config.cache_id),
+        None,
+        cas_util.configure_cache,
+        cache_config,
+    )
+
+    return "load" if load == "always" else "init"
 
 
 def check_cache_config(config):
-    path, cache_id, cache_mode, params, force = handle_cache_config(config)
+    path, cache_id, cache_mode, params, force, load = handle_cache_config(
+        config
+    )
 
     cache_config = cas_util.cas_config.cache_config(
         cache_id, path, cache_mode, **params
     )
+
+    # Device with metadata which is going to be loaded is not expected to
+    # be empty
+    configured = is_cache_configured(cache_config)
+    if get_cache_load(cache_config, force, load, configured) == "always":
+        force = True
+
     cache_config.validate_config(force)
 
 
-def configure_cache_device(config):
-    path, cache_id, cache_mode, params, force = handle_cache_config(config)
+def configure_cache_device(ops, config):
+    path, cache_id, cache_mode, params, force, load = handle_cache_config(
+        config
+    )
 
+    transaction = Transaction(ops)
     try:
-        config = cas_util.cas_config.from_file(
-            cas_util.cas_config.default_location
-        )
+        config = transaction.read_config()
     except:
         raise
 
-    config_copy = deepcopy(config)
-
     new_cache_config = cas_util.cas_config.cache_config(
         cache_id, path, cache_mode, **params
     )
 
-    changed = True
+    configured = False
     try:
         config.insert_cache(new_cache_config)
     except cas_util.cas_config.AlreadyConfiguredException:
-        changed = False
-    else:
-        config.write(cas_util.cas_config.default_location)
+        configured = True
+    changed = not configured
 
-    if cas_util.is_cache_started(new_cache_config):
-        return changed
+    started_caches = []
+    try:
+        if changed:
+            transaction.write_config(config)
+
+        if not DevicesState.query().is_cache_started(new_cache_config):
+            start = start_cache(
+                transaction, new_cache_config, force, load, configured
+            )
+            started_caches += [{"id": cache_id, "device": path, "start": start}]
+            changed = True
+    except cas_util.casadm.CasadmError as e:
+        transaction.rollback()
+        raise Exception("Internal casadm error({0})".format(e.result.stderr))
+    except:
+        transaction.rollback()
+        raise
 
+    transaction.commit()
+
+    return (changed, started_caches)
+
+
+def get_start_operation(cache_config, force, load, configured, loaded_caches):
+    """
+    Operation starting cache, ids of caches started loading metadata are
+    added to loaded_caches
+    """
+
+    def operation(transaction):
+        start = start_cache(transaction, cache_config, force, load, configured)
+        if start == "load":
+            loaded_caches.add(cache_config.cache_id)
+
+        return {
+            "id": cache_config.cache_id,
+            "device": cache_config.device,
+            "start": start,
+        }
+
+    return operation
+
+
+def get_add_core_operation(core_config, loaded_caches):
+    """
+    Operation adding core to cache. Cores recorded in metadata are attached
+    by Open CAS when cache is loaded, so for cache in loaded_caches running
+    devices are listed again and core is added only if it's still missing.
+    """
+
+    def operation(transaction):
+        if core_config.cache_id in loaded_caches:
+            if DevicesState.query().is_core_added(core_config):
+                return
+        add_core(transaction, core_config)
+
+    return operation
+
+
+def get_devices_chains(state, cache_configs, core_configs, parallel):
+    """
+    Chains of operations starting caches which aren't running yet and adding
+    cores which aren't added. Without parallel single chain starts all caches
+    and then adds all cores, otherwise each cache gets its own chain in which
+    its cores are added right after it is started.
+    """
+    operations = []
+    loaded_caches = set()
+    for cache_config, force, load, configured in cache_configs:
+        if state.is_cache_started(cache_config):
+            continue
+
+        operations += [
+            (
+                cache_config.cache_id,
+                get_start_operation(
+                    cache_config, force, load, configured, loaded_caches
+                ),
+            )
+        ]
+        state.add_cache(cache_config)
+
+    for core_config in core_configs:
+        if state.is_core_added(core_config):
+            continue
+
+        operations += [
+            (
+                core_config.cache_id,
+                get_add_core_operation(core_config, loaded_caches),
+            )
+        ]
+        state.add_core(core_config)
+
+    if not operations:
+        return []
+    if not parallel:
+        return [[operation for _, operation in operations]]
+
+    return group_chains(operations)
+
+
+def group_chains(operations):
+    """ Group (cache_id, operation) list into chains keeping their order """
+    chains = {}
+    order = []
+    for cache_id, operation in operations:
+        if cache_id not in chains:
+            chains[cache_id] = []
+            order.append(cache_id)
+        chains[cache_id] += [operation]
+
+    return [chains[cache_id] for cache_id in order]
+
+
+def configure_devices(ops, config):
+    caches = [handle_cache_config(c) for c in config.get("caches") or []]
+    cores = [handle_core_config(c) for c in config.get("cores") or []]
+    parallel = bool(config.get("parallel"))
+    max_workers = int(config.get("max_workers") or 0) if parallel else 1
+
+    transaction = Transaction(ops)
+    try:
+        config = transaction.read_config()
+    except:
+        raise
+
+    changed = False
+    cache_configs = []
+    for path, cache_id, cache_mode, params, force, load in caches:
+        cache_config = cas_util.cas_config.cache_config(
+            cache_id, path, cache_mode, **params
+        )
+        try:
+            config.insert_cache(cache_config)
+        except cas_util.cas_config.AlreadyConfiguredException:
+            cache_configs += [(cache_config, force, load, True)]
+        else:
+            cache_configs += [(cache_config, force, load, False)]
+            changed = True
+
+    core_configs = []
+    for path, core_id, cache_id in cores:
+        core_config = cas_util.cas_config.core_config(cache_id, core_id, path)
+        core_configs += [core_config]
+
+        try:
+            config.insert_core(core_config)
+        except cas_util.cas_config.AlreadyConfiguredException:
+            pass
+        else:
+            changed = True
+
+    started_caches = []
     try:
-        cas_util.start_cache(new_cache_config, load=False, force=force)
-        cas_util.configure_cache(new_cache_config)
+        if changed:
+            transaction.write_config(config)
+
+        chains = get_devices_chains(
+            DevicesState.query(), cache_configs, core_configs, parallel
+        )
+        for results in run_chains(transaction, chains, max_workers):
+            started_caches += [r for r in results if r is not None]
+            changed = True
     except cas_util.casadm.CasadmError as e:
-        config_copy.write(cas_util.cas_config.default_location)
+        transaction.rollback()
         raise Exception("Internal casadm error({0})".format(e.result.stderr))
     except:
-        config_copy.write(cas_util.cas_config.default_location)
+        transaction.rollback()
         raise
 
-    return True
+    transaction.commit()
+
+    return (changed, started_caches)
+
+
+# Cache parameters kept in opencas.conf which are compared with desired state
+DESIRED_CACHE_PARAMS = [
+    "cache_line_size",
+    "ioclass_file",
+    "cleaning_policy",
+    "promotion_policy",
+]
+
+
+def set_cache_mode(cache_id, cache_mode):
+    cas_util.casadm.run_cmd(
+        [
+            cas_util.casadm.casadm_path,
+            "--set-cache-mode",
+            "--cache-mode",
+            cache_mode,
+            "--cache-id",
+            str(cache_id),
+            "--flush-cache",
+            "yes",
+        ]
+    )
+
+
+def remove_core(cache_id, core_id):
+    cas_util.casadm.run_cmd(
+        [
+            cas_util.casadm.casadm_path,
+            "--remove-core",
+            "--cache-id",
+            str(cache_id),
+            "--core-id",
+            str(core_id),
+        ]
+    )
+
+
+def get_cache_changes(current, desired):
+    """ Differences between two cache configs as {name: {from, to}} """
+    changes = {}
+    if os.path.realpath(current.device) != os.path.realpath(desired.device):
+        changes["device"] = {"from": current.device, "to": desired.device}
+
+    if str(current.cache_mode).lower() != str(desired.cache_mode).lower():
+        changes["cache_mode"] = {
+            "from": str(current.cache_mode).lower(),
+            "to": str(desired.cache_mode).lower(),
+        }
+
+    for name in DESIRED_CACHE_PARAMS:
+        value = current.params.get(name)
+        desired_value = desired.params.get(name)
+        if value != desired_value:
+            changes[name] = {"from": value, "to": desired_value}
+
+    return changes
+
+
+def set_policy(transaction, namespace, cache_id, policy):
+    current = list(get_params(namespace, cache_id).values())[0]
+    transaction.run(
+        "set {0} policy of cache {1} to {2}".format(
+            namespace, cache_id, policy
+        ),
+        ["set_params", namespace, cache_id, {"policy": current}],
+        set_params,
+        namespace,
+        cache_id,
+        policy=policy,
+    )
+
+
+def get_operation(phase, description, undo, action, *args, **kwargs):
+    """ Plan operation run within transaction with given undo operation """
+    return (
+        phase,
+        description,
+        lambda transaction: transaction.run(
+            description, undo, action, *args, **kwargs
+        ),
+    )
+
+
+def find_core_config(config, cache_id, core_id):
+    for core_config in config.cores:
+        if (core_config.cache_id, core_config.core_id) == (cache_id, core_id):
+            return core_config
+
+    return None
+
+
+class DesiredStatePlan(object):
+    """
+    Plan of changes bringing opencas.conf and running devices to desired
+    state. Each plan entry lists operations which will be run to apply it,
+    actions holds functions performing them within transaction in order of
+    execution, together with id of cache they belong to. Ids of caches
+    started loading metadata are collected in loaded_caches.
+    """
+
+    PHASES = ["remove", "restart", "cache", "core"]
+
+    def __init__(self):
+        self.entries = {"create": [], "change": [], "remove": [], "noop": []}
+        self.actions = dict((phase, []) for phase in self.PHASES)
+        self.config_changed = False
+        self.loaded_caches = set()
+
+    def add(self, kind, entry, operations=None):
+        cache_id = entry.get("cache_id", entry["id"])
+        entry["operations"] = []
+        for phase, description, action in operations or []:
+            entry["operations"] += [description]
+            self.actions[phase] += [(cache_id, action)]
+
+        self.entries[kind] += [entry]
+
+    def get_actions(self, phases=None):
+        return [
+            action
+            for phase in phases or self.PHASES
+            for _, action in self.actions[phase]
+        ]
+
+    def get_chains(self, phases):
+        """ Actions of given phases grouped by cache into chains """
+        return group_chains(
+            [a for phase in phases for a in self.actions[phase]]
+        )
+
+    def is_empty(self):
+        return not self.config_changed and not self.get_actions()
+
+
+def plan_cache(plan, config, state, cache_spec, recreate):
+    path, cache_id, cache_mode, params, force, load = cache_spec
+    desired = cas_util.cas_config.cache_config(
+        cache_id, path, cache_mode, **params
+    )
+    entry = {"type": "cache", "id": cache_id, "device": path}
+
+    current = config.caches.get(cache_id)
+    changes = get_cache_changes(current, desired) if current else {}
+    if current is None or changes:
+        config.caches[cache_id] = desired
+        plan.config_changed = True
+    if current is None:
+        changes["configured"] = {"from": False, "to": True}
+
+    live = state.caches.get(cache_id)
+    if live is None:
+        # Metadata may be loaded only from device already configured for
+        # this cache
+        configured = current is not None and not (
+            set(changes.keys()) & set(["device", "cache_line_size"])
+        )
+        state.is_cache_started(desired)
+        state.add_cache(desired)
+        plan.add(
+            "create",
+            entry,
+            [
+                (
+                    "cache",
+                    "start cache {0} ({1})".format(cache_id, path),
+                    get_start_operation(
+                        desired, force, load, configured, plan.loaded_caches
+                    ),
+                )
+            ],
+        )
+        return
+
+    live_mode = live.get("write policy", cache_mode).lower()
+    if live_mode != cache_mode.lower():
+        changes["cache_mode"] = {"from": live_mode, "to": cache_mode.lower()}
+    device_changed = os.path.realpath(live["disk"]) != os.path.realpath(path)
+    if device_changed:
+        changes["device"] = {"from": live["disk"], "to": path}
+
+    if not changes:
+        plan.add("noop", entry)
+        return
+
+    entry["changes"] = changes
+    if device_changed or "cache_line_size" in changes:
+        if not recreate:
+            raise Exception(
+                "Cache {0} has to be restarted to apply changes of {1}, "
+                "set recreate to allow it".format(
+                    cache_id, ", ".join(sorted(changes.keys()))
+                )
+            )
+
+        state.remove_cache(cache_id)
+        state.is_cache_started(desired)
+        state.add_cache(desired)
+        plan.add(
+            "change",
+            entry,
+            [
+                # Metadata is reinitialized, so stopped cache can't be loaded
+                # back on rollback
+                get_operation(
+                    "restart",
+                    "stop cache {0}".format(cache_id),
+                    None,
+                    cas_util.casadm.stop_cache,
+                    cache_id=cache_id,
+                    no_flush=False,
+                ),
+                (
+                    "cache",
+                    "start cache {0} ({1})".format(cache_id, path),
+                    lambda transaction: start_cache(
+                        transaction, desired, True, "never", False
+                    ),
+                ),
+            ],
+        )
+        return
+
+    operations = []
+    if "cache_mode" in changes and live_mode != cache_mode.lower():
+        operations += [
+            get_operation(
+                "cache",
+                "set cache mode of cache {0} to {1}".format(
+                    cache_id, cache_mode.lower()
+                ),
+                ["set_cache_mode", cache_id, live_mode],
+                set_cache_mode,
+                cache_id,
+                cache_mode,
+            )
+        ]
+    for name, namespace in [
+        ("cleaning_policy", "cleaning"),
+        ("promotion_policy", "promotion"),
+    ]:
+        if name in changes and params.get(name):
+            operations += [
+                (
+                    "cache",
+                    "set {0} policy of cache {1} to {2}".format(
+                        namespace, cache_id, params[name]
+                    ),
+                    lambda transaction, namespace=namespace, name=name: (
+                        set_policy(
+                            transaction, namespace, cache_id, params[name]
+                        )
+                    ),
+                )
+            ]
+    if "ioclass_file" in changes and params.get("ioclass_file"):
+        operations += [
+            get_operation(
+                "cache",
+                "load IO classes of cache {0} from {1}".format(
+                    cache_id, params["ioclass_file"]
+                ),
+                None,
+                load_ioclass_config,
+                cache_id,
+                params["ioclass_file"],
+            )
+        ]
+
+    plan.add("change", entry, operations)
+
+
+def plan_core(plan, config, state, core_spec, recreate):
+    path, core_id, cache_id = core_spec
+    desired = cas_util.cas_config.core_config(cache_id, core_id, path)
+    entry = {
+        "type": "core",
+        "id": core_id,
+        "cache_id": cache_id,
+        "device": path,
+    }
+
+    current = find_core_config(config, cache_id, core_id)
+    changes = {}
+    if current is None:
+        changes["configured"] = {"from": False, "to": True}
+    elif os.path.realpath(current.device) != os.path.realpath(path):
+        changes["device"] = {"from": current.device, "to": path}
+        config.cores.remove(current)
+    if changes:
+        config.cores += [desired]
+        plan.config_changed = True
+
+    live = state.cores.get((cache_id, core_id))
+    if live is None:
+        state.is_core_added(desired)
+        state.add_core(desired)
+        plan.add(
+            "create",
+            entry,
+            [
+                (
+                    "core",
+                    "add core {0} ({1}) to cache {2}".format(
+                        core_id, path, cache_id
+                    ),
+                    get_add_core_operation(desired, plan.loaded_caches),
+                )
+            ],
+        )
+        return
+
+    device_changed = os.path.realpath(live["disk"]) != os.path.realpath(path)
+    if device_changed:
+        changes["device"] = {"from": live["disk"], "to": path}
+
+    if not changes:
+        plan.add("noop", entry)
+        return
+
+    entry["changes"] = changes
+    if not device_changed:
+        plan.add("change", entry)
+        return
+
+    if not recreate:
+        raise Exception(
+            "Core {0} of cache {1} has to be removed and added again to "
+            "change its device, set recreate to allow it".format(
+                core_id, cache_id
+            )
+        )
+
+    state.remove_core(cache_id, core_id)
+    state.is_core_added(desired)
+    state.add_core(desired)
+    plan.add(
+        "change",
+        entry,
+        [
+            get_operation(
+                "restart",
+                "remove core {0} from cache {1}".format(core_id, cache_id),
+                ["add_core", cache_id, core_id, live["disk"]],
+                remove_core,
+                cache_id,
+                core_id,
+            ),
+            (
+                "core",
+                "add core {0} ({1}) to cache {2}".format(
+                    core_id, path, cache_id
+                ),
+                lambda transaction: add_core(transaction, desired),
+            ),
+        ],
+    )
+
+
+def plan_removals(plan, config, state, caches, cores):
+    """ Plan removal of caches and cores which are not in desired state """
+    cache_ids = set(config.caches.keys()) | set(state.caches.keys())
+    for cache_id in sorted(cache_ids - set(caches)):
+        if cache_id in config.caches:
+            del config.caches[cache_id]
+            plan.config_changed = True
+
+        operations = []
+        live = state.caches.get(cache_id)
+        if live is not None:
+            state.remove_cache(cache_id)
+            operations += [
+                get_operation(
+                    "remove",
+                    "stop cache {0}".format(cache_id),
+                    [
+                        "load_cache",
+                        cache_id,
+                        live["disk"],
+                        live.get("write policy", "wt"),
+                    ],
+                    cas_util.casadm.stop_cache,
+                    cache_id=cache_id,
+                    no_flush=False,
+                )
+            ]
+        plan.add("remove", {"type": "cache", "id": cache_id}, operations)
+
+    core_ids = set(
+        (core.cache_id, core.core_id) for core in config.cores
+    ) | set(state.cores.keys())
+    for cache_id, core_id in sorted(core_ids - set(cores)):
+        core_config = find_core_config(config, cache_id, core_id)
+        if core_config is not None:
+            config.cores.remove(core_config)
+            plan.config_changed = True
+
+        # Cores of removed caches go away with their cache
+        if cache_id not in caches:
+            continue
+
+        operations = []
+        live = state.cores.get((cache_id, core_id))
+        if live is not None:
+            state.remove_core(cache_id, core_id)
+            operations += [
+                get_operation(
+                    "remove",
+                    "remove core {0} from cache {1}".format(core_id, cache_id),
+                    ["add_core", cache_id, core_id, live["disk"]],
+                    remove_core,
+                    cache_id,
+                    core_id,
+                )
+            ]
+        plan.add(
+            "remove",
+            {"type": "core", "id": core_id, "cache_id": cache_id},
+            operations,
+        )
+
+
+def plan_desired_state(config, state, caches, cores, prune, recreate):
+    plan = DesiredStatePlan()
+
+    if prune:
+        plan_removals(
+            plan,
+            config,
+            state,
+            [cache[1] for cache in caches],
+            [(core[2], core[1]) for core in cores],
+        )
+
+    for cache_spec in caches:
+        plan_cache(plan, config, state, cache_spec, recreate)
+
+    for core_spec in cores:
+        plan_core(plan, config, state, core_spec, recreate)
+
+    return plan
+
+
+def desired_state(ops, config):
+    caches = [handle_cache_config(c) for c in config.get("caches") or []]
+    cores = [handle_core_config(c) for c in config.get("cores") or []]
+    prune = bool(config.get("prune"))
+    recreate = bool(config.get("recreate"))
+    parallel = bool(config.get("parallel"))
+
+    transaction = Transaction(ops)
+    opencas_config = transaction.read_config()
+
+    plan = plan_desired_state(
+        opencas_config, DevicesState.query(), caches, cores, prune, recreate
+    )
+    if plan.is_empty():
+        return (False, plan.entries)
+
+    try:
+        if plan.config_changed:
+            transaction.write_config(opencas_config)
+
+        if parallel:
+            # Stopped caches and removed cores may free devices used by other
+            # caches, so they are done before anything is started
+            for action in plan.get_actions(["remove", "restart"]):
+                action(transaction)
+            run_chains(
+                transaction,
+                plan.get_chains(["cache", "core"]),
+                int(config.get("max_workers") or 0),
+            )
+        else:
+            for action in plan.get_actions():
+                action(transaction)
+    except cas_util.casadm.CasadmError as e:
+        transaction.rollback()
+        raise Exception("Internal casadm error({0})".format(e.result.stderr))
+    except:
+        transaction.rollback()
+        raise
+
+    transaction.commit()
+
+    return (True, plan.entries)
+
+
+def get_ioclasses(cache_id):
+    """ Get IO classes loaded on cache as rows of casadm IO class listing """
+    result = cas_util.casadm.run_cmd(
+        [
+            cas_util.casadm.casadm_path,
+            "--io-class",
+            "--list",
+            "--cache-id",
+            str(cache_id),
+            "--output-format",
+            "csv",
+        ]
+    )
+
+    return list(
+        csv.DictReader(line for line in result.stdout.split("\n") if line)
+    )
+
+
+def load_ioclass_config(cache_id, ioclass_file):
+    cas_util.casadm.run_cmd(
+        [
+            cas_util.casadm.casadm_path,
+            "--io-class",
+            "--load-config",
+            "--cache-id",
+            str(cache_id),
+            "--file",
+            ioclass_file,
+        ]
+    )
+
+
+def get_ioclass_hash(ioclasses):
+    """
+    Hash IO classes (rows of IO class file or casadm IO class listing)
+    ignoring order and formatting differences of values
+    """
+
+    def normalize(value):
+        value = value.strip()
+        try:
+            return "{0:g}".format(float(value))
+        except ValueError:
+            return value
+
+    normalized = sorted(
+        [normalize(value) for value in list(row.values())[:4]]
+        for row in ioclasses
+    )
+
+    return hashlib.sha256(json.dumps(normalized).encode("utf-8")).hexdigest()
+
+
+def apply_io_class(ops, config):
+    try:
+        cache_id = int(config["cache_id"])
+        ioclass_file = IOCLASS_FILE_PATH.format(config["io_class"])
+    except:
+        raise Exception("Missing IO class config parameters")
+
+    # In check mode IO class file may not be copied yet and cache may not be
+    # started yet, loading IO classes is reported as planned then
+    new_hash = None
+    if not ops.check_mode or os.path.exists(ioclass_file):
+        with open(ioclass_file, "r") as f:
+            new_hash = get_ioclass_hash(csv.DictReader(f))
+
+    current_hash = None
+    if not ops.check_mode or cache_id in DevicesState.query().caches:
+        current_hash = get_ioclass_hash(get_ioclasses(cache_id))
+
+    if new_hash is not None and new_hash == current_hash:
+        return (False, current_hash)
+
+    transaction = Transaction(ops)
+    opencas_config = transaction.read_config()
+
+    try:
+        transaction.run(
+            "load io classification {0} on cache {1}".format(
+                ioclass_file, cache_id
+            ),
+            None,
+            load_ioclass_config,
+            cache_id,
+            ioclass_file,
+        )
+
+        # Keep IO class file used at boot in sync with running configuration
+        cache_config = opencas_config.caches.get(cache_id)
+        if (
+            cache_config
+            and cache_config.params.get("ioclass_file") != ioclass_file
+        ):
+            cache_config.params["ioclass_file"] = ioclass_file
+            transaction.write_config(opencas_config)
+    except:
+        transaction.rollback()
+        raise
+
+    transaction.commit()
+
+    return (True, new_hash)
+
+
+# Number of log2 bins of file size and access age histograms
+HISTOGRAM_BINS = 64
+
+
+def get_histogram_bin(value):
+    """ Index of log2 bin containing value, bin n holds (2^(n-1), 2^n] """
+    return min(max(int(value) - 1, 0).bit_length(), HISTOGRAM_BINS - 1)
+
+
+def scan_files(path, sample=1.0, max_files=None):
+    """
+    Walk filesystem mounted at path (without crossing mount points) and build
+    histogram of files as [size bin][age bin] = [files, bytes]. Only fraction
+    of files given by sample is accounted for, chosen by hash of file path
+    so consecutive scans see the same files.
+    """
+    histogram = [
+        [[0, 0] for age in range(HISTOGRAM_BINS)]
+        for size in range(HISTOGRAM_BINS)
+    ]
+    device = os.stat(path).st_dev
+    now = time.time()
+    threshold = int(sample * 0xFFFFFFFF)
+    scanned = 0
+
+    directories = [path]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.stat(follow_symlinks=False).st_dev == device:
+                            directories += [entry.path]
+                        continue
+
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+
+                    if (
+                        sample < 1
+                        and zlib.crc32(entry.path.encode("utf-8", "replace"))
+                        & 0xFFFFFFFF
+                        > threshold
+                    ):
+                        continue
+
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                cell = histogram[get_histogram_bin(st.st_size)][
+                    get_histogram_bin(max(now - st.st_atime, 0))
+                ]
+                cell[0] += 1
+                cell[1] += st.st_size
+
+                scanned += 1
+                if max_files and scanned >= max_files:
+                    return (histogram, scanned)
+
+    return (histogram, scanned)
+
+
+def get_size_buckets(histogram, buckets):
+    """
+    Split size bins into at most buckets ranges holding similar number of
+    files, returns list of (first bin, last bin)
+    """
+    counts = [sum(cell[0] for cell in ages) for ages in histogram]
+    total = sum(counts)
+    if total == 0:
+        return []
+
+    ranges = []
+    first = None
+    accumulated = 0
+    for size_bin, count in enumerate(counts):
+        if count == 0:
+            continue
+        if first is None:
+            first = size_bin
+
+        accumulated += count
+        if accumulated * buckets >= total * (len(ranges) + 1):
+            ranges += [(first, size_bin)]
+            first = None
+
+    if first is not None:
+        ranges += [(first, HISTOGRAM_BINS - 1)]
+
+    return ranges
+
+
+def get_hot_age_bin(histogram):
+    """ Age bin holding median access age of all files """
+    counts = [
+        sum(histogram[size][age][0] for size in range(HISTOGRAM_BINS))
+        for age in range(HISTOGRAM_BINS)
+    ]
+    accumulated = 0
+    for age_bin, count in enumerate(counts):
+        accumulated += count
+        if accumulated * 2 >= sum(counts):
+            return age_bin
+
+    return HISTOGRAM_BINS - 1
+
+
+def get_generated_ioclasses(histogram, buckets):
+    """
+    Build IO classes from files histogram. Each size range gets its own
+    class, ranges with larger share of recently accessed data in their bytes
+    (hit density) get higher priority.
+    """
+    hot_age_bin = get_hot_age_bin(histogram)
+
+    size_classes = []
+    ranges = get_size_buckets(histogram, buckets)
+    for i, (first, last) in enumerate(ranges):
+        cells = [
+            cell
+            for size_bin in range(first, last + 1)
+            for cell in histogram[size_bin]
+        ]
+        hot_cells = [
+            cell
+            for size_bin in range(first, last + 1)
+            for cell in histogram[size_bin][: hot_age_bin + 1]
+        ]
+        files = sum(cell[0] for cell in cells)
+        size = sum(cell[1] for cell in cells)
+        hot_size = sum(cell[1] for cell in hot_cells)
+        hot_files = sum(cell[0] for cell in hot_cells)
+
+        conditions = []
+        if i > 0:
+            conditions += ["file_size:gt:{0}".format(2 ** ranges[i - 1][1])]
+        if i < len(ranges) - 1 or len(ranges) == 1:
+            conditions += ["file_size:le:{0}".format(2 ** last)]
+        conditions += ["done"]
+
+        size_classes += [
+            {
+                "name": "&".join(conditions),
+                "files": files,
+                "bytes": size,
+                "hit_density": (
+                    float(hot_size) / size if size else float(hot_files) / files
+                ),
+            }
+        ]
+
+    ioclasses = [{"id": 0, "name": "unclassified"}]
+    ioclasses += [{"id": 1, "name": "metadata&done", "priority": 0}]
+    for i, ioclass in enumerate(size_classes):
+        ioclass["id"] = 11 + i
+
+    by_density = sorted(
+        size_classes, key=lambda c: (-c["hit_density"], c["id"])
+    )
+    for priority, ioclass in enumerate(by_density, 9):
+        ioclass["priority"] = priority
+        ioclass["hit_density"] = round(ioclass["hit_density"], 4)
+
+    ioclasses += size_classes
+    ioclasses += [
+        {
+            "id": 11 + len(size_classes),
+            "name": "direct&done",
+            "priority": 9 + len(size_classes),
+        }
+    ]
+    ioclasses[0]["priority"] = ioclasses[-1]["priority"] + 2
+
+    return ioclasses
+
+
+def write_io_class(ops, ioclass_file, contents):
+    try:
+        with open(ioclass_file, "r") as f:
+            current_contents = f.read()
+    except (IOError, OSError):
+        current_contents = ""
+
+    changed = current_contents != contents
+    if changed:
+        ops.write_file(ioclass_file, current_contents, contents)
+
+    return changed
+
+
+def generate_io_class(ops, config):
+    try:
+        ioclass_file = IOCLASS_FILE_PATH.format(config["io_class"])
+    except:
+        raise Exception("Missing IO class generator parameters")
+
+    # Contents generated by previous run and accepted by action plugin
+    if config.get("contents") is not None:
+        return (
+            write_io_class(ops, ioclass_file, config["contents"]),
+            {"file": ioclass_file, "contents": config["contents"]},
+        )
+
+    try:
+        path = config["path"]
+    except:
+        raise Exception("Missing IO class generator parameters")
+
+    try:
+        buckets = int(config.get("buckets") or 10)
+        sample = float(config.get("sample") or 1)
+        max_files = int(config.get("max_files") or 0)
+    except (TypeError, ValueError):
+        raise Exception("Invalid IO class generator parameters")
+
+    if not (0 < buckets <= 20):
+        raise Exception("Invalid buckets parameter ({0})".format(buckets))
+    if not (0 < sample <= 1):
+        raise Exception("Invalid sample parameter ({0})".format(sample))
+
+    histogram, scanned = scan_files(path, sample, max_files)
+    if scanned == 0:
+        raise Exception("No files found in {0}".format(path))
+
+    ioclasses = get_generated_ioclasses(histogram, buckets)
+    contents = "IO class id,IO class name,Eviction priority,Allocation\n"
+    contents += "".join(
+        "{0},{1},{2},1\n".format(c["id"], c["name"], c["priority"])
+        for c in sorted(ioclasses, key=lambda c: c["id"])
+    )
+
+    generated = {
+        "file": ioclass_file,
+        "contents": contents,
+        "scanned_files": scanned,
+        "classes": [c for c in ioclasses if "files" in c],
+    }
+    if not config.get("write", True):
+        return (False, generated)
+
+    return (write_io_class(ops, ioclass_file, contents), generated)
 
 
 argument_spec = {
     "gather_facts": {"type": "bool", "required": False},
+    "gather_stats": {"type": "bool", "required": False},
     "zap": {"type": "bool", "required": False},
     "stop": {"type": "dict", "required": False},
+    "flush": {"type": "bool", "required": False},
+    "flush_status": {"type": "bool", "required": False},
+    "drain": {"type": "dict", "required": False},
+    "stats_sample": {"type": "dict", "required": False},
+    "check_health": {"type": "dict", "required": False},
     "check_cache_config": {"type": "dict", "required": False},
     "configure_cache_device": {"type": "dict", "required": False},
     "check_core_config": {"type": "dict", "required": False},
     "configure_core_device": {"type": "dict", "required": False},
+    "configure_devices": {"type": "dict", "required": False},
+    "desired_state": {"type": "dict", "required": False},
+    "apply_io_class": {"type": "dict", "required": False},
+    "generate_io_class": {"type": "dict", "required": False},
+    "gather_ioclass_stats": {"type": "dict", "required": False},
 }
 
 
+def get_ioclass_stats(cache_id):
+    ioclasses = []
+    for row in get_ioclasses(cache_id):
+        ioclass_id, name, priority, allocation = list(row.values())[:4]
+        stats = get_stats(cache_id, io_class_id=int(ioclass_id))
+
+        occupancy = stats["occupancy_4kib_blocks"]
+        hits = stats["read_hits_requests"] + stats["write_hits_requests"]
+        total = stats["read_total_requests"] + stats["write_total_requests"]
+        ioclasses += [
+            {
+                "id": int(ioclass_id),
+                "name": name.strip(),
+                "priority": int(priority),
+                "allocation": allocation.strip(),
+                "occupancy_blocks": occupancy,
+                "occupancy_bytes": occupancy * CAS_BLOCK_SIZE,
+                "dirty_blocks": stats["dirty_4kib_blocks"],
+                "dirty_bytes": stats["dirty_4kib_blocks"] * CAS_BLOCK_SIZE,
+                "read_hits": stats["read_hits_requests"],
+                "write_hits": stats["write_hits_requests"],
+                "hits": hits,
+                "misses": total - hits,
+                "hit_ratio": get_hit_ratio(stats),
+                # Hits per occupied 4KiB block
+                "hit_density": (
+                    round(float(hits) / occupancy, 4) if occupancy else 0.0
+                ),
+            }
+        ]
+
+    return sorted(ioclasses, key=lambda c: c["id"])
+
+
+def gather_ioclass_stats(config):
+    cache_id = config.get("cache_id")
+    if cache_id is not None:
+        try:
+            cache_ids = [int(cache_id)]
+        except (TypeError, ValueError):
+            raise Exception("Invalid cache_id parameter ({0})".format(cache_id))
+    else:
+        cache_ids = sorted(DevicesState.query().caches.keys())
+
+    return {
+        "caches": [
+            {"id": cache_id, "io_classes": get_ioclass_stats(cache_id)}
+            for cache_id in cache_ids
+        ]
+    }
+
+
 def setup_module_object():
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=False)
+    module = AnsibleModule(
+        argument_spec=argument_spec, supports_check_mode=True
+    )
 
     return module
 
 
 def run_task(module):
     ret = {"changed": False, "failed": False, "ansible_facts": {}}
+    ops = Operations(module.check_mode, module._diff)
+
+    try:
+        ret.update(run_option(module, ops))
+    finally:
+        ops.unlock_config()
+    if ops.operations:
+        # Also operations rolling back journal left by interrupted run
+        ret["changed"] = True
+        ret["operations"] = ops.operations
+    if ops.timings:
+        ret["timings"] = ops.timings
+    if ops.diffs and module._diff:
+        ret["diff"] = ops.diffs
+
+    return ret
+
+
+def run_option(module, ops):
+    ret = {}
 
     arg_gather_facts = module.params["gather_facts"]
-    if arg_gather_facts:
+    arg_gather_stats = module.params["gather_stats"]
+    if arg_gather_facts or arg_gather_stats:
         ret["ansible_facts"] = gather_facts()
+        if arg_gather_stats and ret["ansible_facts"]["opencas_installed"]:
+            ret["ansible_facts"]["opencas_stats"] = gather_stats()
+        return ret
+
+    arg_gather_ioclass_stats = module.params["gather_ioclass_stats"]
+    if arg_gather_ioclass_stats:
+        ret["ansible_facts"] = {
+            "opencas_ioclass_stats": gather_ioclass_stats(
+                arg_gather_ioclass_stats
+            )
+        }
         return ret
 
     arg_zap = module.params["zap"]
     if arg_zap:
-        ret["changed"] = zap()
+        ret["changed"] = zap(ops)
         return ret
 
     arg_stop = module.params["stop"]
+    if arg_stop and arg_stop.get("parallel"):
+        ret["stopped_caches"] = stop_parallel(
+            ops, arg_stop["flush"], int(arg_stop.get("max_workers") or 0)
+        )
+        ret["changed"] = len(ret["stopped_caches"]) != 0
+        return ret
+
     if arg_stop:
-        ret["changed"] = ret["changed"] or stop(arg_stop["flush"])
+        ret["changed"] = stop(ops, arg_stop["flush"])
+        return ret
+
+    arg_flush = module.params["flush"]
+    if arg_flush:
+        ret["changed"] = flush(ops)
+        return ret
+
+    arg_flush_status = module.params["flush_status"]
+    if arg_flush_status:
+        ret["flush_status"] = flush_status()
+        return ret
+
+    arg_drain = module.params["drain"]
+    if arg_drain:
+        ret["drained_caches"] = drain(ops, arg_drain)
+        ret["changed"] = len(ret["drained_caches"]) != 0
+        return ret
+
+    arg_stats_sample = module.params["stats_sample"]
+    if arg_stats_sample:
+        ret["stats_sample"] = stats_sample(arg_stats_sample)
+        return ret
+
+    arg_check_health = module.params["check_health"]
+    if arg_check_health:
+        ret["health"] = check_health(arg_check_health)
         return ret
 
     arg_check_cache_config = module.params["check_cache_config"]
@@ -429,15 +3550,41 @@ def run_task(module):
 
     arg_configure_cache_device = module.params["configure_cache_device"]
     if arg_configure_cache_device:
-        ret["changed"] = ret["changed"] or configure_cache_device(
-            arg_configure_cache_device
+        changed, started_caches = configure_cache_device(
+            ops, arg_configure_cache_device
         )
+        ret["changed"] = changed
+        ret["started_caches"] = started_caches
         return ret
 
     arg_configure_core_device = module.params["configure_core_device"]
     if arg_configure_core_device:
-        ret["changed"] = ret["changed"] or configure_core_device(
-            arg_configure_core_device
+        ret["changed"] = configure_core_device(ops, arg_configure_core_device)
+        return ret
+
+    arg_configure_devices = module.params["configure_devices"]
+    if arg_configure_devices:
+        ret["changed"], ret["started_caches"] = configure_devices(
+            ops, arg_configure_devices
+        )
+        return ret
+
+    arg_desired_state = module.params["desired_state"]
+    if arg_desired_state:
+        ret["changed"], ret["plan"] = desired_state(ops, arg_desired_state)
+        return ret
+
+    arg_apply_io_class = module.params["apply_io_class"]
+    if arg_apply_io_class:
+        ret["changed"], ret["io_class_hash"] = apply_io_class(
+            ops, arg_apply_io_class
+        )
+        return ret
+
+    arg_generate_io_class = module.params["generate_io_class"]
+    if arg_generate_io_class:
+        ret["changed"], ret["generated_io_class"] = generate_io_class(
+            ops, arg_generate_io_class
         )
         return ret
 
@@ -455,7 +3602,12 @@ def main():
     module.exit_json(**ret)
 
 
-from ansible.module_utils.basic import AnsibleModule
+# cas.py is also used as a library by opencas-exporter collector, which runs
+# on hosts without Ansible installed
+try:
+    from ansible.module_utils.basic import AnsibleModule
+except ImportError:
+    AnsibleModule = None
 
 if __name__ == "__main__":
     main()
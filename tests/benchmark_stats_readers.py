@@ -0,0 +1,49 @@
+#
+# Copyright(c) 2012-2019 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+#
+
+"""
+Compare cost of reading IO counters of exported objects through casadm and
+through sysfs. Run as root on host with Open CAS installed and caches running:
+
+    python3 tests/benchmark_stats_readers.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../library"))
+
+import cas
+
+
+def casadm_cores_counters(cores):
+    return dict((core, cas.get_stats(core[0], core[1])) for core in cores)
+
+
+def sysfs_cores_counters(cores):
+    return cas.get_exported_objects_stats()
+
+
+def report(name, function, iterations, *args):
+    duration = timeit.timeit(lambda: function(*args), number=iterations)
+    print("{0:<32} {1:>10.3f} ms".format(name, 1000.0 * duration / iterations))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    cores = sorted(cas.DevicesState.query().cores.keys())
+
+    print(
+        "{0} iterations, {1} cores, mean time per iteration:".format(
+            iterations, len(cores)
+        )
+    )
+    report("core counters (casadm)", casadm_cores_counters, iterations, cores)
+    report("core counters (sysfs)", sysfs_cores_counters, iterations, cores)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@
 
 import sys
 import os
+import pytest
 
 
 def pytest_configure(config):
@@ -13,3 +14,30 @@ def pytest_configure(config):
         os.path.join(os.path.dirname(__file__), "open-cas-linux/utils/")
     )
     sys.path.append(os.path.join(os.path.dirname(__file__), "../library"))
+
+
+@pytest.fixture(autouse=True)
+def sysfs(tmp_path, monkeypatch):
+    """ Fake sysfs tree with Open CAS kernel module loaded """
+    import cas
+
+    sysfs_path = tmp_path / "sys"
+    (sysfs_path / "module" / "cas_cache").mkdir(parents=True)
+    (sysfs_path / "block").mkdir()
+    monkeypatch.setattr(cas, "SYSFS_PATH", str(sysfs_path))
+
+    return sysfs_path
+
+
+@pytest.fixture(autouse=True)
+def opencas_config(tmp_path, monkeypatch):
+    """ Keep opencas.conf (and its transaction journal) in tmp_path """
+    import opencas
+
+    config_path = tmp_path / "opencas.conf"
+    config_path.write_text("# original config\n")
+    monkeypatch.setattr(
+        opencas.cas_config, "default_location", str(config_path)
+    )
+
+    return config_path
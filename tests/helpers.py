@@ -105,3 +105,68 @@ class CopyableMock(mock.Mock):
         copy = mock.Mock(spec=self)
         self.copies += [copy]
         return copy
+
+
+def get_devices_list(devices):
+    """
+    Build list of devices as returned by opencas.get_caches_list()
+    from {cache_id: [core_id, ...]} dictionary
+    """
+    devices_list = []
+    for cache_id, core_ids in sorted(devices.items()):
+        devices_list += [
+            {
+                "type": "cache",
+                "id": str(cache_id),
+                "disk": "/dev/dummy{0}".format(cache_id),
+                "status": "Running",
+                "write policy": "wt",
+                "device": "-",
+            }
+        ]
+        for core_id in core_ids:
+            devices_list += [
+                {
+                    "type": "core",
+                    "id": str(core_id),
+                    "disk": "/dev/dummycore{0}-{1}".format(cache_id, core_id),
+                    "status": "Active",
+                    "write policy": "-",
+                    "device": "/dev/cas{0}-{1}".format(cache_id, core_id),
+                }
+            ]
+
+    return devices_list
+
+
+def get_stats_csv(stats):
+    """ Build casadm --stats CSV output from {column name: value} dict """
+    header = ",".join(stats.keys())
+    values = ",".join(str(v) for v in stats.values())
+
+    return "{0}\n{1}\n".format(header, values)
+
+
+def write_block_stat(sysfs, device, stat):
+    """ Create /sys/block/<device>/stat in fake sysfs from list of values """
+    (sysfs / "block" / device).mkdir()
+    (sysfs / "block" / device / "stat").write_text(
+        " ".join(str(v) for v in stat) + "\n"
+    )
+
+
+def write_config(config, path):
+    """ Simplified cas_config.write() listing configured caches and cores """
+    with open(path, "w") as f:
+        for cache in config.caches.values():
+            f.write(
+                "cache {0} {1} {2}\n".format(
+                    cache.cache_id, cache.device, cache.cache_mode
+                )
+            )
+        for core in config.cores:
+            f.write(
+                "core {0} {1} {2}\n".format(
+                    core.cache_id, core.core_id, core.device
+                )
+            )
@@ -0,0 +1,546 @@
+#
+# Copyright(c) 2012-2019 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+#
+
+import pytest
+from unittest.mock import patch, Mock
+import importlib.util
+import json
+import csv
+import os
+
+from ansible.errors import AnsibleError
+
+# Action plugin has the same name as cas module, so it's loaded from its path
+spec = importlib.util.spec_from_file_location(
+    "cas_action",
+    os.path.join(os.path.dirname(__file__), "../action_plugins/cas.py"),
+)
+cas_action = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cas_action)
+
+default_ioclass_file = os.path.join(
+    os.path.dirname(__file__), "../roles/opencas-deploy/files/default.csv"
+)
+
+
+def get_ioclass_contents(*ioclasses):
+    """ IO class file from (id, rule, priority) tuples """
+    return "IO class id,IO class name,Eviction priority,Allocation\n" + "".join(
+        "{0},{1},{2},1\n".format(id, rule, priority)
+        for id, rule, priority in ioclasses
+    )
+
+
+def test_validate_ioclass_default_file():
+    with open(default_ioclass_file, "r") as f:
+        cas_action.validate_ioclass(f.read(), "default.csv")
+
+
+@pytest.mark.parametrize(
+    "rule",
+    [
+        "metadata&done",
+        "directory:/var/lib/mysql&done",
+        "extension:log|extension:txt",
+        "file_size:ge:4096&file_size:lt:8192&done",
+        "io_direction:read&done",
+        "io_direction:write&request_size:le:4096",
+        "pid:ne:1",
+    ],
+)
+def test_validate_ioclass_valid_rule(rule):
+    cas_action.validate_ioclass(
+        get_ioclass_contents((0, "unclassified", 22), (1, rule, 1)), "test.csv"
+    )
+
+
+@pytest.mark.parametrize(
+    "rule,message,position",
+    [
+        ("done:1", "condition 'done' doesn't take arguments", 6),
+        (
+            "metadata&file_size",
+            "condition 'file_size' requires an argument",
+            20,
+        ),
+        ("directory:tmp", "directory 'tmp' isn't an absolute path", 11),
+        ("io_direction:eq:1", "unknown IO direction 'eq:1'", 14),
+        ("file_size:lq:1&done", "unknown operator 'lq'", 11),
+        ("file_size:le:4k", "invalid numeric value '4k'", 14),
+        ("lba:le:18446744073709551616", "invalid numeric value", 8),
+        ("metadata&", "missing condition", 10),
+        ("metadata||done", "missing condition", 10),
+        ("unclassified&done", "'unclassified' can't be combined", 1),
+    ],
+)
+def test_validate_ioclass_invalid_rule(rule, message, position):
+    with pytest.raises(AnsibleError) as e:
+        cas_action.validate_ioclass(
+            get_ioclass_contents((1, rule, 1)), "test.csv"
+        )
+
+    assert e.value.message.startswith(
+        "Invalid IO-class rule({0}) found in test.csv: {1}".format(
+            rule, message
+        )
+    )
+    assert e.value.message.endswith(
+        "at position {0}\n  {1}\n  {2}^".format(
+            position, rule, " " * (position - 1)
+        )
+    )
+
+
+def test_validate_ioclass_unknown_condition():
+    # Unknown condition is left for Open CAS to check, only warning is issued
+    warnings = cas_action.validate_ioclass(
+        get_ioclass_contents((1, "metadata&foo:1", 1)), "test.csv"
+    )
+
+    assert warnings == [
+        "Unknown condition 'foo' in IO-class rule(metadata&foo:1) found in "
+        "test.csv, it's left for Open CAS to check"
+    ]
+
+
+@pytest.mark.parametrize(
+    "rule",
+    [
+        "file_size:gt:4096&file_size:lt:1024&done",
+        "file_size:lt:0",
+        "lba:eq:10&lba:eq:20",
+    ],
+)
+def test_validate_ioclass_never_matches(rule):
+    with pytest.raises(AnsibleError) as e:
+        cas_action.validate_ioclass(
+            get_ioclass_contents((1, rule, 1)), "test.csv"
+        )
+
+    assert e.value.message == (
+        "IO-class rule({0}) of IO class 1 never matches in test.csv".format(
+            rule
+        )
+    )
+
+
+def test_validate_ioclass_shadowed():
+    with pytest.raises(AnsibleError) as e:
+        cas_action.validate_ioclass(
+            get_ioclass_contents(
+                (1, "file_size:le:4096&done", 1),
+                (2, "file_size:le:1024&extension:log&done", 2),
+            ),
+            "test.csv",
+        )
+
+    assert e.value.message == (
+        "IO-class rule(file_size:le:1024&extension:log&done) of IO class 2 "
+        "is unreachable, it's shadowed by rule(file_size:le:4096&done) of IO "
+        "class 1 with higher priority in test.csv"
+    )
+
+
+def test_validate_ioclass_shadowed_equal_priority():
+    # Order of classes with equal priority is up to Open CAS, so it's only
+    # reported with warning
+    warnings = cas_action.validate_ioclass(
+        get_ioclass_contents(
+            (2, "file_size:le:50&done", 3),
+            (1, "file_size:le:100&done", 3),
+        ),
+        "test.csv",
+    )
+
+    assert warnings == [
+        "IO-class rule(file_size:le:50&done) of IO class 2 may be "
+        "unreachable, it's covered by rule(file_size:le:100&done) of IO "
+        "class 1 with the same priority in test.csv"
+    ]
+
+
+@pytest.mark.parametrize(
+    "ioclasses",
+    [
+        # Narrower rule evaluated first
+        [(1, "file_size:le:4096&done", 2), (2, "file_size:le:1024&done", 1)],
+        # Classification continues after rule without done
+        [(1, "file_size:le:4096", 1), (2, "file_size:le:1024&done", 2)],
+        # Overlapping, but not covering ranges
+        [(1, "file_size:le:4096&done", 1), (2, "file_size:ge:1024&done", 2)],
+        # Rule with other conditions doesn't cover rule without them
+        [
+            (1, "file_size:le:4096&extension:log&done", 1),
+            (2, "file_size:le:1024&done", 2),
+        ],
+        # Rules with '|' aren't analyzed
+        [(1, "metadata|direct&done", 1), (2, "metadata&done", 2)],
+    ],
+)
+def test_validate_ioclass_not_shadowed(ioclasses):
+    warnings = cas_action.validate_ioclass(
+        get_ioclass_contents(*ioclasses), "test.csv"
+    )
+
+    assert warnings == []
+
+
+@pytest.mark.parametrize(
+    "option,arg",
+    [
+        ("check_cache_config", {"id": 1, "io_class": "a.csv"}),
+        ("configure_cache_device", {"id": 1, "io_class": "a.csv"}),
+        (
+            "configure_devices",
+            {"caches": [{"id": 1, "io_class": "a.csv"}, {"id": 2}]},
+        ),
+        (
+            "desired_state",
+            {"caches": [{"id": 1, "io_class": "a.csv"}, {"id": 2}]},
+        ),
+        ("apply_io_class", {"cache_id": 1, "io_class": "a.csv"}),
+    ],
+)
+def test_action_ioclass_configs(option, arg):
+    action = cas_action.ActionModule.__new__(cas_action.ActionModule)
+    action._task = Mock(args={option: arg})
+
+    configs = list(action.get_ioclass_configs())
+
+    assert [(o, c["io_class"]) for o, c in configs] == [(option, "a.csv")]
+
+
+@pytest.fixture
+def validation_cache(tmp_path, monkeypatch):
+    """ Empty in-memory validation results and path of file keeping them """
+    monkeypatch.setattr(cas_action, "ioclass_validation_cache", {})
+
+    return str(tmp_path / "validation.json")
+
+
+def validate_in_new_run(monkeypatch, file_path, cache_file):
+    """
+    Validate file with results loaded only from cache_file, returns mock of
+    validate_ioclass() and validation error message (None if file is valid)
+    """
+    monkeypatch.setattr(cas_action, "ioclass_validation_cache", {})
+    with patch.object(
+        cas_action, "validate_ioclass", side_effect=cas_action.validate_ioclass
+    ) as mock_validate:
+        try:
+            cas_action.validate_ioclass_file(file_path, "test.csv", cache_file)
+        except AnsibleError as e:
+            return (mock_validate, e.message)
+
+    return (mock_validate, None)
+
+
+def test_validate_ioclass_file_cache_hit(
+    validation_cache, monkeypatch, tmp_path
+):
+    ioclass_file = tmp_path / "test.csv"
+    ioclass_file.write_text(get_ioclass_contents((1, "metadata&done", 1)))
+    cas_action.validate_ioclass_file(
+        str(ioclass_file), "test.csv", validation_cache
+    )
+
+    mock_validate, error = validate_in_new_run(
+        monkeypatch, str(ioclass_file), validation_cache
+    )
+
+    mock_validate.assert_not_called()
+    assert error is None
+
+
+def test_validate_ioclass_file_cache_miss_after_change(
+    validation_cache, monkeypatch, tmp_path
+):
+    ioclass_file = tmp_path / "test.csv"
+    ioclass_file.write_text(get_ioclass_contents((1, "metadata&done", 1)))
+    cas_action.validate_ioclass_file(
+        str(ioclass_file), "test.csv", validation_cache
+    )
+    ioclass_file.write_text(get_ioclass_contents((1, "direct&done", 1)))
+
+    mock_validate, error = validate_in_new_run(
+        monkeypatch, str(ioclass_file), validation_cache
+    )
+
+    mock_validate.assert_called_once()
+    assert error is None
+
+
+def test_validate_ioclass_file_cached_error(
+    validation_cache, monkeypatch, tmp_path
+):
+    ioclass_file = tmp_path / "test.csv"
+    ioclass_file.write_text(get_ioclass_contents((1, "file_size:lq:1&done", 1)))
+    with pytest.raises(AnsibleError) as first:
+        cas_action.validate_ioclass_file(
+            str(ioclass_file), "test.csv", validation_cache
+        )
+
+    mock_validate, error = validate_in_new_run(
+        monkeypatch, str(ioclass_file), validation_cache
+    )
+
+    mock_validate.assert_not_called()
+    assert error == first.value.message
+    first.match("unknown operator 'lq'")
+
+
+def test_validate_ioclass_file_cached_warnings(
+    validation_cache, monkeypatch, tmp_path
+):
+    ioclass_file = tmp_path / "test.csv"
+    ioclass_file.write_text(get_ioclass_contents((1, "foo&done", 1)))
+    warnings = cas_action.validate_ioclass_file(
+        str(ioclass_file), "test.csv", validation_cache
+    )
+
+    monkeypatch.setattr(cas_action, "ioclass_validation_cache", {})
+    with patch.object(cas_action, "validate_ioclass") as mock_validate:
+        cached_warnings = cas_action.validate_ioclass_file(
+            str(ioclass_file), "test.csv", validation_cache
+        )
+
+    mock_validate.assert_not_called()
+    assert len(warnings) == 1
+    assert cached_warnings == warnings
+
+
+def test_validate_ioclass_file_other_validator_version(
+    validation_cache, monkeypatch, tmp_path
+):
+    ioclass_file = tmp_path / "test.csv"
+    ioclass_file.write_text(get_ioclass_contents((1, "metadata&done", 1)))
+    cas_action.validate_ioclass_file(
+        str(ioclass_file), "test.csv", validation_cache
+    )
+
+    # Results of validator with different checks aren't reused
+    monkeypatch.setattr(cas_action, "IOCLASS_VALIDATOR_VERSION", "newer")
+    monkeypatch.setattr(cas_action, "ioclass_validation_cache", {})
+    mock_validate = Mock(side_effect=cas_action.validate_ioclass)
+    monkeypatch.setattr(cas_action, "validate_ioclass", mock_validate)
+    cas_action.validate_ioclass_file(
+        str(ioclass_file), "test.csv", validation_cache
+    )
+
+    mock_validate.assert_called_once()
+    with open(validation_cache, "r") as f:
+        assert [key.split(":")[0] for key in json.load(f)] == ["newer"]
+
+
+def get_generate_action(generated_contents, **args):
+    """ Action plugin running generate_io_class, target generates contents """
+    action = cas_action.ActionModule.__new__(cas_action.ActionModule)
+    action._task = Mock(
+        args={"generate_io_class": dict(args, path="/mnt", io_class="a.csv")}
+    )
+
+    def execute_module(module_args, tmp, task_vars):
+        args = module_args["generate_io_class"]
+        generated = {
+            "file": "/etc/opencas/ansible/a.csv",
+            "contents": args.get("contents", generated_contents),
+        }
+        if "contents" not in args:
+            generated["scanned_files"] = 10
+
+        return {
+            "changed": args.get("write", True),
+            "generated_io_class": generated,
+        }
+
+    action._execute_module = Mock(side_effect=execute_module)
+
+    return action
+
+
+def test_action_generate_io_class_valid():
+    contents = get_ioclass_contents(
+        (0, "unclassified", 22), (1, "direct&done", 1)
+    )
+    action = get_generate_action(contents)
+
+    results = action.run_generate_io_class(None, {})
+
+    assert results["changed"] == True
+    assert results["generated_io_class"] == {
+        "file": "/etc/opencas/ansible/a.csv",
+        "contents": contents,
+        "scanned_files": 10,
+    }
+    # Contents are written only after they are validated
+    assert [
+        c[1]["module_args"]["generate_io_class"]
+        for c in action._execute_module.call_args_list
+    ] == [
+        {"path": "/mnt", "io_class": "a.csv", "write": False},
+        {"path": "/mnt", "io_class": "a.csv", "contents": contents},
+    ]
+
+
+def test_action_generate_io_class_invalid():
+    action = get_generate_action(get_ioclass_contents((1, "file_size:lq:1&done", 1)))
+
+    results = action.run_generate_io_class(None, {})
+
+    assert results["failed"] == True
+    assert "unknown operator 'lq'" in results["msg"]
+    assert "/etc/opencas/ansible/a.csv" in results["msg"]
+    action._execute_module.assert_called_once()
+
+
+def test_action_generate_io_class_warnings():
+    contents = get_ioclass_contents((0, "unclassified", 22), (1, "foo&done", 1))
+    action = get_generate_action(contents)
+
+    results = action.run_generate_io_class(None, {})
+
+    assert results["changed"] == True
+    assert len(results["warnings"]) == 1
+    assert "Unknown condition 'foo'" in results["warnings"][0]
+
+
+def test_action_generate_io_class_given_contents_invalid():
+    action = get_generate_action(
+        None, contents=get_ioclass_contents((1, "file_size:lq:1&done", 1))
+    )
+
+    results = action.run_generate_io_class(None, {})
+
+    assert results["failed"] == True
+    action._execute_module.assert_not_called()
+
+
+def get_ioclass_stats(*ioclasses):
+    """ IO class statistics from (id, rule, priority, hit density) tuples """
+    return [
+        {
+            "id": id,
+            "name": rule,
+            "priority": priority,
+            "allocation": "1.00",
+            "hit_density": hit_density,
+        }
+        for id, rule, priority, hit_density in ioclasses
+    ]
+
+
+def get_recommended_priorities(recommendation):
+    return dict(
+        (c["id"], c["recommended_priority"])
+        for c in recommendation["io_classes"]
+    )
+
+
+def test_recommend_ioclass_priorities_by_hit_density():
+    recommendation = cas_action.recommend_ioclass_priorities(
+        get_ioclass_stats(
+            (0, "unclassified", 22, 0.5),
+            (1, "metadata&done", 0, 0.1),
+            (11, "extension:log&done", 9, 0.2),
+            (12, "extension:db&done", 10, 4.0),
+            (13, "extension:tmp&done", 11, 1.0),
+        ),
+        1,
+    )
+
+    assert recommendation["changed"] == True
+    # Unclassified and priority 0 classes are kept, the rest ordered by
+    # hit density reuse the same priorities
+    assert get_recommended_priorities(recommendation) == {
+        0: 22,
+        1: 0,
+        11: 11,
+        12: 9,
+        13: 10,
+    }
+    assert recommendation["contents"] == (
+        "IO class id,IO class name,Eviction priority,Allocation\n"
+        "0,unclassified,22,1\n"
+        "1,metadata&done,0,1\n"
+        "11,extension:log&done,11,1\n"
+        "12,extension:db&done,9,1\n"
+        "13,extension:tmp&done,10,1\n"
+    )
+    assert "error" not in recommendation
+
+
+def test_recommend_ioclass_priorities_not_changed():
+    recommendation = cas_action.recommend_ioclass_priorities(
+        get_ioclass_stats(
+            (11, "extension:db&done", 9, 4.0),
+            (12, "extension:log&done", 10, 0.2),
+        ),
+        1,
+    )
+
+    assert recommendation["changed"] == False
+    assert get_recommended_priorities(recommendation) == {11: 9, 12: 10}
+
+
+def test_recommend_ioclass_priorities_covering_done():
+    # Wider rule has the highest hit density, but moving it before narrower
+    # one would shadow it, so unrelated class goes first
+    recommendation = cas_action.recommend_ioclass_priorities(
+        get_ioclass_stats(
+            (11, "file_size:le:1024&done", 9, 0.1),
+            (12, "file_size:le:4096&done", 10, 2.0),
+            (13, "extension:db&done", 11, 1.0),
+        ),
+        1,
+    )
+
+    assert get_recommended_priorities(recommendation) == {
+        11: 10,
+        12: 11,
+        13: 9,
+    }
+    assert "error" not in recommendation
+
+
+def test_recommend_ioclass_priorities_rule_without_done():
+    # Classification continues after rule without done, so it doesn't shadow
+    recommendation = cas_action.recommend_ioclass_priorities(
+        get_ioclass_stats(
+            (11, "file_size:le:1024&done", 9, 0.1),
+            (12, "file_size:le:4096", 10, 2.0),
+        ),
+        1,
+    )
+
+    assert get_recommended_priorities(recommendation) == {11: 10, 12: 9}
+
+
+def test_recommend_ioclass_priorities_default_file_valid():
+    with open(default_ioclass_file, "r") as f:
+        rows = list(csv.DictReader(f))
+
+    # Hit density grows with IO class id, so it favors larger files
+    ioclasses = get_ioclass_stats(
+        *[
+            (
+                int(row["IO class id"]),
+                row["IO class name"],
+                int(row["Eviction priority"]),
+                float(row["IO class id"]),
+            )
+            for row in rows
+        ]
+    )
+    recommendation = cas_action.recommend_ioclass_priorities(ioclasses, 1)
+
+    assert recommendation["changed"] == True
+    assert "error" not in recommendation
+    cas_action.validate_ioclass(recommendation["contents"], "recommendation")
+
+    # Size ranges covering each other keep their order
+    priorities = get_recommended_priorities(recommendation)
+    assert priorities[22] == 9
+    assert priorities[21] == 10
+    assert [priorities[id] for id in range(11, 21)] == list(range(11, 21))
@@ -8,6 +8,12 @@ from unittest.mock import patch, Mock
 import helpers as h
 from os import strerror
 from errno import ENOENT
+from copy import deepcopy
+import json
+import fcntl
+import os
+import time
+import threading
 
 import cas
 import opencas
@@ -23,6 +29,8 @@ class AnsibleExitJson(Exception):
 
 class MockAnsibleModule(object):
     def __init__(self, arg_spec):
+        self.check_mode = False
+        self._diff = False
         self.params = {}
         for key, value in arg_spec.items():
             if value["type"] == "bool":
@@ -83,6 +91,178 @@ def test_module_get_facts_installed(
     e.match("03.08.00.01131011")
 
 
+def get_full_stats(cache_id, occupancy, dirty, read, write):
+    """ casadm --stats output for cache with read/write (hits, total) """
+    return {
+        "Cache Id": cache_id,
+        "Occupancy [4KiB Blocks]": occupancy,
+        "Occupancy [%]": 50.0,
+        "Dirty [4KiB Blocks]": dirty,
+        "Dirty [%]": 1,
+        "Read hits [Requests]": read[0],
+        "Read total [Requests]": read[1],
+        "Write hits [Requests]": write[0],
+        "Write total [Requests]": write[1],
+        "Pass-Through reads [Requests]": 3,
+        "Pass-Through writes [Requests]": 2,
+        "Serviced requests [Requests]": read[1] + write[1],
+        "Total requests [Requests]": read[1] + write[1] + 5,
+        "Reads from core(s) [4KiB Blocks]": 10,
+        "Writes to core(s) [4KiB Blocks]": 20,
+        "Reads from cache [4KiB Blocks]": 30,
+        "Writes to cache [4KiB Blocks]": 40,
+        "Reads from exported object(s) [4KiB Blocks]": 50,
+        "Writes to exported object(s) [4KiB Blocks]": 60,
+    }
+
+
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.cas_config.from_file")
+@patch("opencas.get_cas_version")
+@patch("opencas.get_caches_list")
+@patch("cas.setup_module_object")
+def test_module_get_facts_with_stats(
+    mock_setup_module,
+    mock_get_caches_list,
+    mock_get_version,
+    mock_from_file,
+    mock_run_cmd,
+):
+    mock_get_version.return_value = {
+        "Open CAS CLI Utility": "03.08.00.01131011"
+    }
+    mock_get_caches_list.return_value = h.get_devices_list({1: [1, 2]})
+    mock_setup_module.return_value = setup_module_with_params(
+        gather_facts=True, gather_stats=True
+    )
+
+    def run_cmd(cmd):
+        result = Mock()
+        if "--core-id" in cmd:
+            core_id = int(cmd[cmd.index("--core-id") + 1])
+            result.stdout = h.get_stats_csv(
+                get_full_stats(1, 10 * core_id, core_id, (1, 2), (0, 0))
+            )
+        else:
+            result.stdout = h.get_stats_csv(
+                get_full_stats(1, 30, 3, (6, 8), (1, 2))
+            )
+        return result
+
+    mock_run_cmd.side_effect = run_cmd
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    facts = e.value.args[0]["ansible_facts"]
+    assert facts["opencas_installed"] == True
+    assert len(facts["opencas_stats"]["caches"]) == 1
+
+    cache = facts["opencas_stats"]["caches"][0]
+    assert cache["id"] == 1
+    assert cache["occupancy_bytes"] == 30 * 4096
+    assert cache["occupancy_percent"] == 50.0
+    assert cache["dirty_blocks"] == 3
+    assert cache["dirty_percent"] == 1.0
+    assert type(cache["dirty_percent"]) is float
+    assert cache["hit_ratio"] == 70.0
+    assert cache["read_hit_ratio"] == 75.0
+    assert cache["write_hit_ratio"] == 50.0
+    assert cache["serviced_requests"] == 10
+    assert cache["total_requests"] == 15
+    assert cache["pass_through_requests"] == 5
+    assert cache["blocks"] == {
+        "reads_from_core": 10,
+        "writes_to_core": 20,
+        "reads_from_cache": 30,
+        "writes_to_cache": 40,
+        "reads_from_exported_object": 50,
+        "writes_to_exported_object": 60,
+    }
+
+    assert [c["id"] for c in cache["cores"]] == [1, 2]
+    assert cache["cores"][1]["occupancy_blocks"] == 20
+    assert cache["cores"][1]["write_hit_ratio"] == 0.0
+    assert "io" not in cache["cores"][0]
+
+
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.cas_config.from_file")
+@patch("opencas.get_cas_version")
+@patch("opencas.get_caches_list")
+@patch("cas.setup_module_object")
+def test_module_get_facts_with_stats_sysfs(
+    mock_setup_module,
+    mock_get_caches_list,
+    mock_get_version,
+    mock_from_file,
+    mock_run_cmd,
+    sysfs,
+):
+    mock_get_caches_list.return_value = h.get_devices_list({1: [1]})
+    mock_setup_module.return_value = setup_module_with_params(gather_stats=True)
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {1: get_full_stats(1, 30, 3, (6, 8), (1, 2))}
+    )
+    h.write_block_stat(
+        sysfs, "cas1-1", [100, 0, 800, 7, 50, 1, 400, 3, 2, 9, 10]
+    )
+    h.write_block_stat(sysfs, "cas2-1", [1] * 11)
+    h.write_block_stat(sysfs, "sda", [1] * 11)
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    cache = e.value.args[0]["ansible_facts"]["opencas_stats"]["caches"][0]
+    assert cache["cores"][0]["io"] == {
+        "reads": 100,
+        "writes": 50,
+        "read_bytes": 800 * 512,
+        "write_bytes": 400 * 512,
+        "in_flight": 2,
+        "io_time_ms": 9,
+    }
+
+
+@patch("opencas.cas_config.from_file")
+@patch("opencas.get_cas_version")
+@patch("opencas.get_caches_list")
+@patch("cas.setup_module_object")
+def test_module_get_facts_module_not_loaded(
+    mock_setup_module,
+    mock_get_caches_list,
+    mock_get_version,
+    mock_from_file,
+    sysfs,
+):
+    (sysfs / "module" / "cas_cache").rmdir()
+    mock_setup_module.return_value = setup_module_with_params(gather_facts=True)
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    assert e.value.args[0]["ansible_facts"]["opencas_devices_started"] == False
+    mock_get_caches_list.assert_not_called()
+
+
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_cas_version")
+@patch("cas.setup_module_object")
+def test_module_get_facts_with_stats_not_installed(
+    mock_setup_module, mock_get_version, mock_run_cmd
+):
+    mock_get_version.side_effect = FileNotFoundError(
+        ENOENT, strerror(ENOENT), "/sbin/casadm"
+    )
+    mock_setup_module.return_value = setup_module_with_params(gather_stats=True)
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    assert "opencas_stats" not in e.value.args[0]["ansible_facts"]
+    mock_run_cmd.assert_not_called()
+
+
 @patch("opencas.cas_config.from_file")
 @patch("cas.setup_module_object")
 def test_module_zap_no_file(mock_setup_module, mock_config_from_file):
@@ -119,10 +299,11 @@ mock_config_file = opencas.cas_config(
 @patch("opencas.cas_config")
 @patch("cas.setup_module_object")
 def test_module_zap_config(
-    mock_setup_module, mock_new_config, mock_config_from_file
+    mock_setup_module, mock_new_config, mock_config_from_file, opencas_config
 ):
     mock_setup_module.return_value = setup_module_with_params(zap=True)
     mock_config_from_file.return_value = mock_config_file
+    mock_new_config.default_location = str(opencas_config)
     new_config = Mock()
     mock_new_config.return_value = new_config
 
@@ -281,11 +462,15 @@ def test_module_check_cache_device_missing_params(
     e.match("'failed': True")
 
 
+@patch("cas.has_cache_metadata")
 @patch("cas.setup_module_object")
 @patch("opencas.cas_config.cache_config")
 def test_module_check_cache_device(
-    mock_cache_config, mock_setup_module,
+    mock_cache_config,
+    mock_setup_module,
+    mock_has_metadata,
 ):
+    mock_has_metadata.return_value = False
     mock_setup_module.return_value = setup_module_with_params(
         check_cache_config={
             "id": "1000",
@@ -312,11 +497,15 @@ def test_module_check_cache_device(
     )
 
 
+@patch("cas.has_cache_metadata")
 @patch("opencas.cas_config.cache_config.validate_config")
 @patch("cas.setup_module_object")
 def test_module_check_cache_device_validate_failed(
-    mock_setup_module, mock_validate
+    mock_setup_module,
+    mock_validate,
+    mock_has_metadata,
 ):
+    mock_has_metadata.return_value = False
     mock_setup_module.return_value = setup_module_with_params(
         check_cache_config={
             "id": "1",
@@ -377,11 +566,11 @@ def test_modlue_configure_cache_insert_failed(
 
 
 @patch("opencas.start_cache")
-@patch("opencas.is_cache_started")
+@patch("opencas.get_caches_list")
 @patch("opencas.cas_config.from_file")
 @patch("cas.setup_module_object")
 def test_modlue_configure_cache_already_configured_and_started(
-    mock_setup_module, mock_from_file, mock_cache_started, mock_start_cache
+    mock_setup_module, mock_from_file, mock_get_list, mock_start_cache
 ):
     mock_setup_module.return_value = setup_module_with_params(
         configure_cache_device={
@@ -396,7 +585,7 @@ def test_modlue_configure_cache_already_configured_and_started(
         opencas.cas_config.AlreadyConfiguredException()
     )
     mock_from_file.return_value = mock_config
-    mock_cache_started.return_value = True
+    mock_get_list.return_value = h.get_devices_list({1: []})
 
     with pytest.raises(AnsibleExitJson) as e:
         cas.main()
@@ -405,7 +594,8 @@ def test_modlue_configure_cache_already_configured_and_started(
     mock_start_cache.assert_not_called()
 
 
-@patch("opencas.is_cache_started")
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
 @patch("opencas.start_cache")
 @patch("opencas.configure_cache")
 @patch("opencas.cas_config.from_file")
@@ -415,8 +605,10 @@ def test_modlue_configure_cache_not_configured_not_started(
     mock_from_file,
     mock_configure_cache,
     mock_start_cache,
-    mock_cache_started,
+    mock_get_list,
+    mock_has_metadata,
 ):
+    mock_has_metadata.return_value = False
     mock_setup_module.return_value = setup_module_with_params(
         configure_cache_device={
             "id": "1",
@@ -427,7 +619,7 @@ def test_modlue_configure_cache_not_configured_not_started(
     mock_config = h.CopyableMock()
     mock_config.mock_add_spec(opencas.cas_config)
     mock_from_file.return_value = mock_config
-    mock_cache_started.return_value = False
+    mock_get_list.return_value = []
 
     with pytest.raises(AnsibleExitJson) as e:
         cas.main()
@@ -451,7 +643,8 @@ def test_modlue_configure_cache_not_configured_not_started(
     assert args[0] == cache_arg
 
 
-@patch("opencas.is_cache_started")
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
 @patch("opencas.start_cache")
 @patch("opencas.configure_cache")
 @patch("opencas.cas_config.from_file")
@@ -461,8 +654,10 @@ def test_modlue_configure_cache_configured_not_started(
     mock_from_file,
     mock_configure_cache,
     mock_start_cache,
-    mock_cache_started,
+    mock_get_list,
+    mock_has_metadata,
 ):
+    mock_has_metadata.return_value = False
     mock_setup_module.return_value = setup_module_with_params(
         configure_cache_device={
             "id": "1",
@@ -476,7 +671,7 @@ def test_modlue_configure_cache_configured_not_started(
         opencas.cas_config.AlreadyConfiguredException()
     )
     mock_from_file.return_value = mock_config
-    mock_cache_started.return_value = False
+    mock_get_list.return_value = []
 
     with pytest.raises(AnsibleExitJson) as e:
         cas.main()
@@ -500,7 +695,13 @@ def test_modlue_configure_cache_configured_not_started(
     assert args[0] == cache_arg
 
 
-@patch("opencas.is_cache_started")
+def write_changed_config(path):
+    with open(path, "w") as f:
+        f.write("# changed config\n")
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
 @patch("opencas.start_cache")
 @patch("opencas.configure_cache")
 @patch("opencas.cas_config.from_file")
@@ -510,8 +711,11 @@ def test_modlue_configure_cache_not_configured_not_started_start_failed(
     mock_from_file,
     mock_configure_cache,
     mock_start_cache,
-    mock_cache_started,
+    mock_get_list,
+    mock_has_metadata,
+    opencas_config,
 ):
+    mock_has_metadata.return_value = False
     mock_setup_module.return_value = setup_module_with_params(
         configure_cache_device={
             "id": "1",
@@ -521,8 +725,9 @@ def test_modlue_configure_cache_not_configured_not_started_start_failed(
     )
     mock_config = h.CopyableMock()
     mock_config.mock_add_spec(opencas.cas_config)
+    mock_config.write.side_effect = write_changed_config
     mock_from_file.return_value = mock_config
-    mock_cache_started.return_value = False
+    mock_get_list.return_value = []
     mock_start_cache.side_effect = Exception()
 
     with pytest.raises(AnsibleFailJson) as e:
@@ -534,8 +739,8 @@ def test_modlue_configure_cache_not_configured_not_started_start_failed(
 
     e.match("'failed': True")
     mock_configure_cache.assert_not_called()
-    assert len(mock_config.copies) == 1
-    mock_config.copies[0].write.assert_called_once()
+    assert opencas_config.read_text() == "# original config\n"
+    assert not os.path.exists(str(opencas_config) + ".journal")
 
 
 @pytest.mark.parametrize(
@@ -627,11 +832,11 @@ def test_modlue_configure_core_insert_failed(mock_setup_module, mock_from_file):
 
 
 @patch("opencas.add_core")
-@patch("opencas.is_core_added")
+@patch("opencas.get_caches_list")
 @patch("opencas.cas_config.from_file")
 @patch("cas.setup_module_object")
 def test_modlue_configure_core_already_added(
-    mock_setup_module, mock_from_file, mock_core_added, mock_add_core
+    mock_setup_module, mock_from_file, mock_get_list, mock_add_core
 ):
     mock_setup_module.return_value = setup_module_with_params(
         configure_core_device={
@@ -646,7 +851,7 @@ def test_modlue_configure_core_already_added(
         opencas.cas_config.AlreadyConfiguredException()
     )
     mock_from_file.return_value = mock_config
-    mock_core_added.return_value = True
+    mock_get_list.return_value = h.get_devices_list({1: [1]})
 
     with pytest.raises(AnsibleExitJson) as e:
         cas.main()
@@ -677,12 +882,12 @@ def test_modlue_configure_core_insert_failed(mock_setup_module, mock_from_file):
     e.match("'failed': True")
 
 
-@patch("opencas.is_core_added")
+@patch("opencas.get_caches_list")
 @patch("opencas.add_core")
 @patch("opencas.cas_config.from_file")
 @patch("cas.setup_module_object")
 def test_modlue_configure_core_not_configured_not_added(
-    mock_setup_module, mock_from_file, mock_add_core, mock_core_added
+    mock_setup_module, mock_from_file, mock_add_core, mock_get_list
 ):
     mock_setup_module.return_value = setup_module_with_params(
         configure_core_device={
@@ -694,7 +899,7 @@ def test_modlue_configure_core_not_configured_not_added(
     mock_config = h.CopyableMock()
     mock_config.mock_add_spec(opencas.cas_config)
     mock_from_file.return_value = mock_config
-    mock_core_added.return_value = False
+    mock_get_list.return_value = []
 
     with pytest.raises(AnsibleExitJson) as e:
         cas.main()
@@ -712,12 +917,12 @@ def test_modlue_configure_core_not_configured_not_added(
     assert core_arg.device == "/dev/dummy"
 
 
-@patch("opencas.is_core_added")
+@patch("opencas.get_caches_list")
 @patch("opencas.add_core")
 @patch("opencas.cas_config.from_file")
 @patch("cas.setup_module_object")
 def test_modlue_configure_core_configured_not_added(
-    mock_setup_module, mock_from_file, mock_add_core, mock_core_added
+    mock_setup_module, mock_from_file, mock_add_core, mock_get_list
 ):
     mock_setup_module.return_value = setup_module_with_params(
         configure_core_device={
@@ -732,7 +937,7 @@ def test_modlue_configure_core_configured_not_added(
         opencas.cas_config.AlreadyConfiguredException()
     )
     mock_from_file.return_value = mock_config
-    mock_core_added.return_value = False
+    mock_get_list.return_value = []
 
     with pytest.raises(AnsibleExitJson) as e:
         cas.main()
@@ -750,12 +955,16 @@ def test_modlue_configure_core_configured_not_added(
     assert core_arg.device == "/dev/dummy"
 
 
-@patch("opencas.is_core_added")
+@patch("opencas.get_caches_list")
 @patch("opencas.add_core")
 @patch("opencas.cas_config.from_file")
 @patch("cas.setup_module_object")
 def test_modlue_configure_core_not_configured_not_added_add_failed(
-    mock_setup_module, mock_from_file, mock_add_core, mock_core_added
+    mock_setup_module,
+    mock_from_file,
+    mock_add_core,
+    mock_get_list,
+    opencas_config,
 ):
     mock_setup_module.return_value = setup_module_with_params(
         configure_core_device={
@@ -766,8 +975,9 @@ def test_modlue_configure_core_not_configured_not_added_add_failed(
     )
     mock_config = h.CopyableMock()
     mock_config.mock_add_spec(opencas.cas_config)
+    mock_config.write.side_effect = write_changed_config
     mock_from_file.return_value = mock_config
-    mock_core_added.return_value = False
+    mock_get_list.return_value = []
     mock_add_core.side_effect = Exception()
 
     with pytest.raises(AnsibleFailJson) as e:
@@ -778,5 +988,2559 @@ def test_modlue_configure_core_not_configured_not_added_add_failed(
     mock_add_core.assert_called_once()
     e.match("'failed': True")
 
-    assert len(mock_config.copies) == 1
-    mock_config.copies[0].write.assert_called_once()
+    assert opencas_config.read_text() == "# original config\n"
+
+
+devices_config = {
+    "caches": [
+        {"id": "1", "cache_device": "/dev/dummy1", "cache_mode": "WT"},
+        {"id": "2", "cache_device": "/dev/dummy2", "cache_mode": "WB"},
+    ],
+    "cores": [
+        {"id": "1", "cache_id": "1", "cached_volume": "/dev/dummycore1"},
+        {"id": "2", "cache_id": "1", "cached_volume": "/dev/dummycore2"},
+        {"id": "1", "cache_id": "2", "cached_volume": "/dev/dummycore3"},
+    ],
+}
+
+
+@pytest.mark.parametrize(
+    "devices_params",
+    [
+        {"caches": [{"id": "1"}]},
+        {"cores": [{"id": "1", "cache_id": "1"}]},
+        {"caches": [{"cache_device": "/dev/dummy", "cache_mode": "WT"}]},
+    ],
+)
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_missing_params(
+    mock_setup_module, mock_from_file, devices_params
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=devices_params
+    )
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    mock_from_file.assert_not_called()
+    e.match("Missing")
+    e.match("'failed': True")
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_not_configured_not_started(
+    mock_setup_module,
+    mock_from_file,
+    mock_configure_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+    mock_has_metadata,
+):
+    mock_has_metadata.return_value = False
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=devices_config
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    mock_from_file.return_value = mock_config
+    mock_get_list.return_value = []
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+
+    mock_from_file.assert_called_once()
+    mock_get_list.assert_called_once()
+    assert mock_config.insert_cache.call_count == 2
+    assert mock_config.insert_core.call_count == 3
+    mock_config.write.assert_called_once()
+
+    assert mock_start_cache.call_count == 2
+    assert mock_configure_cache.call_count == 2
+    assert [
+        args[0].cache_id for args, _ in mock_start_cache.call_args_list
+    ] == [1, 2]
+
+    assert mock_add_core.call_count == 3
+    assert [
+        (args[0].cache_id, args[0].core_id)
+        for args, _ in mock_add_core.call_args_list
+    ] == [(1, 1), (1, 2), (2, 1)]
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_configured_and_started(
+    mock_setup_module,
+    mock_from_file,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=devices_config
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    mock_config.insert_cache.side_effect = (
+        opencas.cas_config.AlreadyConfiguredException()
+    )
+    mock_config.insert_core.side_effect = (
+        opencas.cas_config.AlreadyConfiguredException()
+    )
+    mock_from_file.return_value = mock_config
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2], 2: [1]})
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': False")
+
+    mock_config.write.assert_not_called()
+    mock_start_cache.assert_not_called()
+    mock_add_core.assert_not_called()
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_add_core_failed(
+    mock_setup_module,
+    mock_from_file,
+    mock_configure_cache,
+    mock_stop_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+    mock_has_metadata,
+    opencas_config,
+):
+    mock_has_metadata.return_value = False
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=devices_config
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    mock_config.write.side_effect = write_changed_config
+    mock_from_file.return_value = mock_config
+    mock_get_list.return_value = []
+    mock_add_core.side_effect = Exception()
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("'failed': True")
+
+    mock_config.write.assert_called_once()
+    mock_add_core.assert_called_once()
+
+    # Caches started before failure are stopped in reverse order
+    assert [
+        kwargs["cache_id"] for _, kwargs in mock_stop_cache.call_args_list
+    ] == [2, 1]
+    assert opencas_config.read_text() == "# original config\n"
+    assert not os.path.exists(str(opencas_config) + ".journal")
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_parallel(
+    mock_setup_module,
+    mock_from_file,
+    mock_configure_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+    mock_has_metadata,
+):
+    mock_has_metadata.return_value = False
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=dict(devices_config, parallel=True, max_workers=2)
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    mock_from_file.return_value = mock_config
+    mock_get_list.return_value = []
+
+    # Cache 1 start finishes only after core of cache 2 was added, which
+    # happens only if caches are started concurrently and cores are added
+    # without waiting for all caches to start
+    core_added = threading.Event()
+
+    def start_cache(cache_config, **kwargs):
+        if cache_config.cache_id == 1:
+            assert core_added.wait(5)
+
+    def add_core(core_config, try_add):
+        if core_config.cache_id == 2:
+            core_added.set()
+
+    mock_start_cache.side_effect = start_cache
+    mock_add_core.side_effect = add_core
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    ret = e.value.args[0]
+    assert [c["id"] for c in ret["started_caches"]] == [1, 2]
+
+    # Cores of each cache are added after cache is started, in order
+    operations = ret["operations"]
+    for cache_id, cores in [(1, [1, 2]), (2, [1])]:
+        cache_index = operations.index("configure cache {0}".format(cache_id))
+        core_indexes = [
+            i
+            for i, o in enumerate(operations)
+            if o.startswith("add core") and o.endswith(str(cache_id))
+        ]
+        assert len(core_indexes) == len(cores)
+        assert cache_index < min(core_indexes)
+    assert operations.index("add core 1 (/dev/dummycore3) to cache 2") < (
+        operations.index("configure cache 1")
+    )
+
+    assert sorted(t["operation"] for t in ret["timings"]) == sorted(operations)
+    for timing in ret["timings"]:
+        assert timing["start"] >= 0
+        assert timing["duration"] >= 0
+
+
+def mock_casadm_load(mock_start_cache, mock_add_core, mock_get_list, cores):
+    """
+    Keep list of running devices, cache started with load attaches its
+    cores recorded in metadata ({cache_id: [(core_id, path), ...]}) and
+    adding core which is already attached fails
+    """
+    running = []
+
+    def start_cache(cache_config, load, force):
+        devices = [
+            {
+                "type": "cache",
+                "id": str(cache_config.cache_id),
+                "disk": cache_config.device,
+            }
+        ]
+        for core_id, path in (
+            cores.get(cache_config.cache_id, []) if load else []
+        ):
+            devices += [{"type": "core", "id": str(core_id), "disk": path}]
+        running.extend(devices)
+
+    def add_core(core_config, try_add):
+        state = cas.DevicesState(list(running))
+        if (core_config.cache_id, core_config.core_id) in state.cores:
+            result = Mock()
+            result.stderr = "Core already added"
+            raise opencas.casadm.CasadmError(result)
+
+    mock_start_cache.side_effect = start_cache
+    mock_add_core.side_effect = add_core
+    mock_get_list.side_effect = lambda: list(running)
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_load_attaches_cores(
+    mock_setup_module,
+    mock_from_file,
+    mock_configure_cache,
+    mock_stop_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+    mock_has_metadata,
+    parallel,
+):
+    mock_has_metadata.return_value = True
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=dict(devices_config, parallel=parallel)
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    mock_config.insert_cache.side_effect = (
+        opencas.cas_config.AlreadyConfiguredException()
+    )
+    mock_config.insert_core.side_effect = (
+        opencas.cas_config.AlreadyConfiguredException()
+    )
+    mock_from_file.return_value = mock_config
+    # Cores of cache 1 are recorded in its metadata, core of cache 2 isn't
+    mock_casadm_load(
+        mock_start_cache,
+        mock_add_core,
+        mock_get_list,
+        {1: [(1, "/dev/dummycore1"), (2, "/dev/dummycore2")]},
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    ret = e.value.args[0]
+    assert sorted((c["id"], c["start"]) for c in ret["started_caches"]) == [
+        (1, "load"),
+        (2, "load"),
+    ]
+    assert [
+        kwargs["load"] for _, kwargs in mock_start_cache.call_args_list
+    ] == [
+        True,
+        True,
+    ]
+    assert [
+        (args[0].cache_id, args[0].core_id)
+        for args, _ in mock_add_core.call_args_list
+    ] == [(2, 1)]
+    mock_stop_cache.assert_not_called()
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.configure_cache")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_parallel_start_failed(
+    mock_setup_module,
+    mock_from_file,
+    mock_configure_cache,
+    mock_run_cmd,
+    mock_stop_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+    mock_has_metadata,
+    opencas_config,
+):
+    mock_has_metadata.return_value = False
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=dict(devices_config, parallel=True)
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    mock_config.write.side_effect = write_changed_config
+    mock_from_file.return_value = mock_config
+    mock_get_list.return_value = []
+
+    # Cache 2 fails to start once cores of cache 1 are added
+    cores_added = threading.Event()
+
+    def start_cache(cache_config, **kwargs):
+        if cache_config.cache_id == 2:
+            assert cores_added.wait(5)
+            raise Exception("device busy")
+
+    def add_core(core_config, try_add):
+        if core_config.core_id == 2:
+            cores_added.set()
+
+    mock_start_cache.side_effect = start_cache
+    mock_add_core.side_effect = add_core
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("'failed': True")
+    e.match("device busy")
+
+    # Cores of cache 1 are removed before it is stopped, cache 2 wasn't
+    # started so there is nothing to undo
+    removed = [
+        args[0][args[0].index("--core-id") + 1]
+        for args, _ in mock_run_cmd.call_args_list
+        if "--remove-core" in args[0]
+    ]
+    assert removed == ["2", "1"]
+    assert [
+        kwargs["cache_id"] for _, kwargs in mock_stop_cache.call_args_list
+    ] == [1]
+    assert opencas_config.read_text() == "# original config\n"
+    assert not os.path.exists(str(opencas_config) + ".journal")
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_core_device_used_by_other_core(
+    mock_setup_module,
+    mock_from_file,
+    mock_add_core,
+    mock_get_list,
+    opencas_config,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_core_device={
+            "id": "3",
+            "cache_id": "1",
+            "cached_volume": "/dev/dummycore1-1",
+        }
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    mock_config.write.side_effect = write_changed_config
+    mock_from_file.return_value = mock_config
+    mock_get_list.return_value = h.get_devices_list({1: [1]})
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("already used by Open CAS as core 1")
+    mock_add_core.assert_not_called()
+    assert opencas_config.read_text() == "# original config\n"
+
+
+def mock_casadm_run_cmd(stats):
+    """ Return casadm --stats output from {cache_id: stats} dict """
+
+    def run_cmd(cmd):
+        result = Mock()
+        result.stdout = ""
+        if "--stats" in cmd:
+            cache_id = int(cmd[cmd.index("--cache-id") + 1])
+            result.stdout = h.get_stats_csv(stats[cache_id])
+
+        return result
+
+    return run_cmd
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_stop_parallel_flush(
+    mock_setup_module, mock_run_cmd, mock_stop_cache, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        stop={"flush": True, "parallel": True, "max_workers": 2}
+    )
+    mock_get_list.side_effect = [h.get_devices_list({1: [1], 2: [], 3: []}), []]
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {
+            1: {"Cache Id": 1, "Dirty [4KiB Blocks]": 10},
+            2: {"Cache Id": 2, "Dirty [4KiB Blocks]": 0},
+            3: {"Cache Id": 3, "Dirty [4KiB Blocks]": 256},
+        }
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    stopped_caches = e.value.args[0]["stopped_caches"]
+    assert [c["id"] for c in stopped_caches] == [1, 2, 3]
+    assert [c["bytes_flushed"] for c in stopped_caches] == [
+        10 * 4096,
+        0,
+        256 * 4096,
+    ]
+
+    flushed = [
+        args[0][args[0].index("--cache-id") + 1]
+        for args, _ in mock_run_cmd.call_args_list
+        if "--flush-cache" in args[0]
+    ]
+    assert sorted(flushed) == ["1", "2", "3"]
+
+    assert mock_stop_cache.call_count == 3
+    for _, kwargs in mock_stop_cache.call_args_list:
+        assert kwargs["no_flush"] == False
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_stop_parallel_no_devices(
+    mock_setup_module, mock_run_cmd, mock_stop_cache, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        stop={"flush": True, "parallel": True}
+    )
+    mock_get_list.return_value = []
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': False")
+    mock_run_cmd.assert_not_called()
+    mock_stop_cache.assert_not_called()
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_stop_parallel_one_failed(
+    mock_setup_module, mock_run_cmd, mock_stop_cache, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        stop={"flush": False, "parallel": True}
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [], 2: []})
+    mock_stop_cache.side_effect = [None, Exception("busy")]
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("'failed': True")
+    e.match("busy")
+    mock_run_cmd.assert_not_called()
+    assert mock_stop_cache.call_count == 2
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.subprocess.Popen")
+@patch("cas.setup_module_object")
+def test_module_flush_started(
+    mock_setup_module, mock_popen, mock_run_cmd, mock_get_list, tmp_path
+):
+    mock_setup_module.return_value = setup_module_with_params(flush=True)
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: [1]})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {
+            1: {"Cache Id": 1, "Dirty [4KiB Blocks]": 100},
+            2: {"Cache Id": 2, "Dirty [4KiB Blocks]": 0},
+        }
+    )
+    mock_popen.return_value.pid = 1234
+    state_file = tmp_path / "flush.json"
+
+    with patch("cas.FLUSH_STATE_FILE", str(state_file)):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+
+    mock_popen.assert_called_once()
+    (args, kwargs) = mock_popen.call_args
+    assert "--flush-cache" in args[0]
+    assert args[0][args[0].index("--cache-id") + 1] == "1"
+
+    flush_state = json.loads(state_file.read_text())
+    assert flush_state["caches"]["1"]["pid"] == 1234
+    assert flush_state["caches"]["1"]["dirty_blocks"] == 100
+    assert "2" not in flush_state["caches"]
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.subprocess.Popen")
+@patch("cas.setup_module_object")
+def test_module_flush_already_clean(
+    mock_setup_module, mock_popen, mock_run_cmd, mock_get_list, tmp_path
+):
+    mock_setup_module.return_value = setup_module_with_params(flush=True)
+    mock_get_list.return_value = h.get_devices_list({1: [1]})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {1: {"Cache Id": 1, "Dirty [4KiB Blocks]": 0}}
+    )
+
+    with patch("cas.FLUSH_STATE_FILE", str(tmp_path / "flush.json")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': False")
+    mock_popen.assert_not_called()
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.is_flush_running")
+@patch("cas.setup_module_object")
+def test_module_flush_status(
+    mock_setup_module, mock_flush_running, mock_run_cmd, mock_get_list, tmp_path
+):
+    mock_setup_module.return_value = setup_module_with_params(flush_status=True)
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: []})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {
+            1: {"Cache Id": 1, "Dirty [4KiB Blocks]": 25},
+            2: {"Cache Id": 2, "Dirty [4KiB Blocks]": 0},
+        }
+    )
+    mock_flush_running.return_value = True
+    state_file = tmp_path / "flush.json"
+    state_file.write_text(
+        json.dumps(
+            {
+                "caches": {
+                    "1": {"pid": 1234, "dirty_blocks": 100, "cores": {"1": 100}}
+                }
+            }
+        )
+    )
+
+    with patch("cas.FLUSH_STATE_FILE", str(state_file)):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    status = e.value.args[0]["flush_status"]
+    assert status["dirty_blocks"] == 25
+    assert status["flushing"] == True
+    assert status["percent_complete"] == 75.0
+
+    assert [c["id"] for c in status["caches"]] == [1, 2]
+    assert status["caches"][0]["dirty_bytes"] == 25 * 4096
+    assert status["caches"][0]["percent_complete"] == 75.0
+    assert status["caches"][0]["cores"][0]["dirty_blocks"] == 25
+    assert status["caches"][1]["percent_complete"] == 100.0
+    assert status["caches"][1]["flushing"] == False
+
+
+def mock_casadm_drain_run_cmd(dirty_sequence, set_param_calls):
+    """ Return dirty data stats from dirty_sequence on consecutive calls """
+    params = {
+        "cleaning": "Parameter name,Value\nCleaning policy type,acp\n",
+        "cleaning-alru": (
+            "Parameter name,Value\n"
+            "Wake up time [s],20\n"
+            "Stale buffer time [s],120\n"
+            "Flush max buffers,100\n"
+            "Activity threshold [ms],10000\n"
+        ),
+    }
+
+    def run_cmd(cmd):
+        result = Mock()
+        result.stdout = ""
+        if "--stats" in cmd:
+            dirty_percent, dirty_blocks = dirty_sequence.pop(0)
+            result.stdout = h.get_stats_csv(
+                {
+                    "Cache Id": 1,
+                    "Dirty [4KiB Blocks]": dirty_blocks,
+                    "Dirty [%]": dirty_percent,
+                }
+            )
+        elif "--get-param" in cmd:
+            result.stdout = params[cmd[cmd.index("--name") + 1]]
+        elif "--set-param" in cmd:
+            set_param_calls.append(cmd[cmd.index("--name") :])
+
+        return result
+
+    return run_cmd
+
+
+@patch("cas.time.sleep")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_drain(mock_setup_module, mock_run_cmd, mock_sleep):
+    mock_setup_module.return_value = setup_module_with_params(
+        drain={"cache_id": 1, "target_percent": 1}
+    )
+    set_param_calls = []
+    mock_run_cmd.side_effect = mock_casadm_drain_run_cmd(
+        [(50.0, 5000), (20.0, 2000), (0.5, 50)], set_param_calls
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    assert mock_sleep.call_count == 1
+
+    drained = e.value.args[0]["drained_caches"]
+    assert drained[0]["initial_dirty_bytes"] == 5000 * 4096
+    assert drained[0]["dirty_bytes"] == 50 * 4096
+
+    assert " ".join(set_param_calls[0]) == (
+        "--name cleaning --cache-id 1 --policy alru"
+    )
+    assert "--wake-up" in set_param_calls[1]
+    assert set_param_calls[1][set_param_calls[1].index("--wake-up") + 1] == "0"
+
+    # original settings restored
+    assert set_param_calls[2][set_param_calls[2].index("--wake-up") + 1] == "20"
+    assert " ".join(set_param_calls[3]) == (
+        "--name cleaning --cache-id 1 --policy acp"
+    )
+
+
+@patch("cas.time.sleep")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_drain_already_drained(
+    mock_setup_module, mock_run_cmd, mock_sleep
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        drain={"cache_id": 1, "target_bytes": 4096 * 100}
+    )
+    set_param_calls = []
+    mock_run_cmd.side_effect = mock_casadm_drain_run_cmd(
+        [(0.0, 0)], set_param_calls
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': False")
+    assert set_param_calls == []
+    mock_sleep.assert_not_called()
+
+
+@patch("cas.time.time")
+@patch("cas.time.sleep")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_drain_timeout(
+    mock_setup_module, mock_run_cmd, mock_sleep, mock_time
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        drain={"cache_id": 1, "target_percent": 1, "timeout": 10}
+    )
+    set_param_calls = []
+    mock_run_cmd.side_effect = mock_casadm_drain_run_cmd(
+        [(50.0, 5000), (40.0, 4000)], set_param_calls
+    )
+    mock_time.side_effect = [0, 11, 11]
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("Timed out")
+    assert " ".join(set_param_calls[-1]) == (
+        "--name cleaning --cache-id 1 --policy acp"
+    )
+
+
+@pytest.mark.parametrize(
+    "load,has_metadata,configured,force,expected_load",
+    [
+        ("auto", True, True, False, True),
+        ("auto", False, True, False, False),
+        # Metadata left by other cache (e.g. after teardown) isn't loaded
+        ("auto", True, False, False, False),
+        ("auto", True, True, True, False),
+        ("always", False, False, False, True),
+        ("never", True, True, False, False),
+    ],
+)
+@patch("opencas.get_caches_list")
+@patch("opencas.start_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_modlue_configure_cache_load(
+    mock_setup_module,
+    mock_from_file,
+    mock_run_cmd,
+    mock_configure_cache,
+    mock_start_cache,
+    mock_get_list,
+    load,
+    has_metadata,
+    configured,
+    force,
+    expected_load,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_cache_device={
+            "id": "1",
+            "cache_device": "/dev/dummy",
+            "cache_mode": "WT",
+            "load": load,
+            "force": force,
+        }
+    )
+    mock_config = h.CopyableMock()
+    mock_config.mock_add_spec(opencas.cas_config)
+    if configured:
+        mock_config.insert_cache.side_effect = (
+            opencas.cas_config.AlreadyConfiguredException()
+        )
+    mock_from_file.return_value = mock_config
+    mock_get_list.return_value = []
+    mock_run_cmd.return_value.stdout = (
+        "Is cache,Clean Shutdown,Cache dirty\n"
+        "{0},yes,no\n".format("yes" if has_metadata else "no")
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+
+    (args, kwargs) = mock_start_cache.call_args
+    assert kwargs["load"] == expected_load
+    assert kwargs["force"] == (force and not expected_load)
+    assert mock_run_cmd.called == (
+        load == "auto" and configured and not force
+    )
+    mock_configure_cache.assert_called_once()
+
+    started_caches = e.value.args[0]["started_caches"]
+    assert started_caches == [
+        {
+            "id": 1,
+            "device": "/dev/dummy",
+            "start": "load" if expected_load else "init",
+        }
+    ]
+
+
+@pytest.mark.parametrize(
+    "load,configured,force,expected_force",
+    [
+        ("auto", True, False, True),
+        # Metadata which won't be loaded by start isn't expected either
+        ("auto", False, False, False),
+        ("auto", True, True, True),
+        ("always", False, False, True),
+        ("never", True, False, False),
+    ],
+)
+@patch("opencas.cas_config.cache_config.validate_config")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_check_cache_device_with_metadata(
+    mock_setup_module,
+    mock_from_file,
+    mock_run_cmd,
+    mock_validate,
+    load,
+    configured,
+    force,
+    expected_force,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        check_cache_config={
+            "id": "1",
+            "cache_device": "/dev/dummy",
+            "cache_mode": "WT",
+            "load": load,
+            "force": force,
+        }
+    )
+    mock_from_file.return_value = opencas.cas_config(
+        caches={1: opencas.cas_config.cache_config(1, "/dev/dummy", "WT")}
+        if configured
+        else {},
+        cores=[],
+    )
+    mock_run_cmd.return_value.stdout = (
+        "Is cache,Clean Shutdown,Cache dirty\nyes,yes,no\n"
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    mock_validate.assert_called_once_with(expected_force)
+
+
+@patch("cas.setup_module_object")
+def test_module_check_cache_device_invalid_load(mock_setup_module):
+    mock_setup_module.return_value = setup_module_with_params(
+        check_cache_config={
+            "id": "1",
+            "cache_device": "/dev/dummy",
+            "cache_mode": "WT",
+            "load": "sometimes",
+        }
+    )
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("Invalid load parameter")
+
+
+health_config_file = opencas.cas_config(
+    caches={
+        1: opencas.cas_config.cache_config(1, "/dev/dummy1", "WT"),
+        2: opencas.cas_config.cache_config(2, "/dev/dummy2", "WT"),
+    },
+    cores=[
+        opencas.cas_config.core_config(1, 1, "/dev/dummycore1-1"),
+        opencas.cas_config.core_config(2, 1, "/dev/dummycore2-1"),
+    ],
+)
+
+
+def get_requests_stats(read_hits, read_total, write_hits, write_total):
+    return {
+        "Read hits [Requests]": read_hits,
+        "Read total [Requests]": read_total,
+        "Write hits [Requests]": write_hits,
+        "Write total [Requests]": write_total,
+    }
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_check_health(
+    mock_setup_module, mock_from_file, mock_run_cmd, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        check_health={"min_hit_ratio": 50}
+    )
+    mock_from_file.return_value = health_config_file
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: [1]})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {
+            1: get_requests_stats(60, 100, 20, 20),
+            2: get_requests_stats(1, 2, 0, 0),
+        }
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    health = e.value.args[0]["health"]
+    assert health["healthy"] == True
+    assert [c["hit_ratio"] for c in health["caches"]] == [66.67, 50.0]
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_check_health_low_hit_ratio(
+    mock_setup_module, mock_from_file, mock_run_cmd, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        check_health={"min_hit_ratio": 50}
+    )
+    mock_from_file.return_value = health_config_file
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: [1]})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {
+            1: get_requests_stats(60, 100, 20, 20),
+            2: get_requests_stats(0, 0, 0, 0),
+        }
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    health = e.value.args[0]["health"]
+    assert health["healthy"] == False
+    assert [c["healthy"] for c in health["caches"]] == [True, False]
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_check_health_device_missing(
+    mock_setup_module, mock_from_file, mock_run_cmd, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        check_health={"min_hit_ratio": 0}
+    )
+    mock_from_file.return_value = health_config_file
+    mock_get_list.return_value = h.get_devices_list({1: []})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {1: get_requests_stats(0, 0, 0, 0)}
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    health = e.value.args[0]["health"]
+    assert health["healthy"] == False
+    assert health["caches"][0]["cores"][0]["status"] == "Not added"
+    assert health["caches"][1]["status"] == "Not running"
+
+
+ioclass_file_contents = (
+    "IO class id,IO class name,Eviction priority,Allocation\n"
+    "0,unclassified,22,1\n"
+    "1,metadata&done,0,1\n"
+)
+
+
+def mock_casadm_ioclass_run_cmd(loaded_ioclasses):
+    """ Return casadm --io-class --list output with given IO classes """
+
+    def run_cmd(cmd):
+        result = Mock()
+        result.stdout = ""
+        if "--list" in cmd:
+            result.stdout = (
+                "IO class ID,IO class name,Eviction priority,Allocation\n"
+                + loaded_ioclasses
+            )
+
+        return result
+
+    return run_cmd
+
+
+@patch("opencas.cas_config.from_file")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_apply_io_class_changed(
+    mock_setup_module, mock_run_cmd, mock_from_file, tmp_path
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        apply_io_class={"cache_id": 1, "io_class": "default.csv"}
+    )
+    (tmp_path / "default.csv").write_text(ioclass_file_contents)
+    mock_run_cmd.side_effect = mock_casadm_ioclass_run_cmd(
+        "0,unclassified,22,1.00\n"
+    )
+    mock_config = Mock()
+    mock_config.caches = {
+        1: opencas.cas_config.cache_config(1, "/dev/dummy1", "WT")
+    }
+    mock_from_file.return_value = mock_config
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+    assert mock_run_cmd.call_count == 2
+    load_cmd = mock_run_cmd.call_args_list[1][0][0]
+    assert "--load-config" in load_cmd
+    assert load_cmd[-1] == str(tmp_path / "default.csv")
+    assert mock_config.caches[1].params["ioclass_file"] == str(
+        tmp_path / "default.csv"
+    )
+    mock_config.write.assert_called_once()
+
+
+@patch("opencas.cas_config.from_file")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_apply_io_class_not_changed(
+    mock_setup_module, mock_run_cmd, mock_from_file, tmp_path
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        apply_io_class={"cache_id": 1, "io_class": "default.csv"}
+    )
+    (tmp_path / "default.csv").write_text(ioclass_file_contents)
+    mock_run_cmd.side_effect = mock_casadm_ioclass_run_cmd(
+        "1,metadata&done,0,1.00\n0,unclassified,22,1.00\n"
+    )
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': False")
+    mock_run_cmd.assert_called_once()
+    mock_from_file.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "ioclass_params", [{"cache_id": 1}, {"io_class": "default.csv"}]
+)
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_apply_io_class_missing_params(
+    mock_setup_module, mock_run_cmd, ioclass_params
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        apply_io_class=ioclass_params
+    )
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("Missing IO class config parameters")
+    mock_run_cmd.assert_not_called()
+
+
+@patch("cas.setup_module_object")
+def test_module_generate_io_class(mock_setup_module, tmp_path):
+    data = tmp_path / "data"
+    (data / "archive").mkdir(parents=True)
+    now = time.time()
+    for i in range(4):
+        small = data / "small{0}".format(i)
+        small.write_bytes(b"x" * 100)
+        os.utime(str(small), (now, now))
+        large = data / "archive" / "large{0}".format(i)
+        large.write_bytes(b"x" * 100000)
+        os.utime(str(large), (now - 1000000, now - 1000000))
+
+    mock_setup_module.return_value = setup_module_with_params(
+        generate_io_class={
+            "path": str(data),
+            "io_class": "generated.csv",
+            "buckets": 2,
+        }
+    )
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+    generated = e.value.args[0]["generated_io_class"]
+    assert generated["scanned_files"] == 8
+    assert generated["contents"] == (
+        "IO class id,IO class name,Eviction priority,Allocation\n"
+        "0,unclassified,13,1\n"
+        "1,metadata&done,0,1\n"
+        "11,file_size:le:128&done,9,1\n"
+        "12,file_size:gt:128&done,10,1\n"
+        "13,direct&done,11,1\n"
+    )
+    assert (tmp_path / "generated.csv").read_text() == generated["contents"]
+    assert [c["hit_density"] for c in generated["classes"]] == [1.0, 0.0]
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': False")
+
+
+@patch("cas.setup_module_object")
+def test_module_generate_io_class_write_disabled(mock_setup_module, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "file").write_bytes(b"x" * 100)
+
+    mock_setup_module.return_value = setup_module_with_params(
+        generate_io_class={
+            "path": str(data),
+            "io_class": "generated.csv",
+            "write": False,
+        }
+    )
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': False")
+    assert e.value.args[0]["generated_io_class"]["scanned_files"] == 1
+    assert not (tmp_path / "generated.csv").exists()
+
+
+@patch("cas.scan_files")
+@patch("cas.setup_module_object")
+def test_module_generate_io_class_contents(
+    mock_setup_module, mock_scan_files, tmp_path
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        generate_io_class={
+            "io_class": "generated.csv",
+            "contents": ioclass_file_contents,
+        }
+    )
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+    mock_scan_files.assert_not_called()
+    assert (tmp_path / "generated.csv").read_text() == ioclass_file_contents
+
+
+@pytest.mark.parametrize(
+    "generator_params,error",
+    [
+        ({"path": "/mnt"}, "Missing IO class generator parameters"),
+        ({"io_class": "a.csv"}, "Missing IO class generator parameters"),
+        (
+            {"path": "/mnt", "io_class": "a.csv", "buckets": 21},
+            "Invalid buckets parameter",
+        ),
+        (
+            {"path": "/mnt", "io_class": "a.csv", "sample": 2},
+            "Invalid sample parameter",
+        ),
+    ],
+)
+@patch("cas.scan_files")
+@patch("cas.setup_module_object")
+def test_module_generate_io_class_invalid_params(
+    mock_setup_module, mock_scan_files, generator_params, error
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        generate_io_class=generator_params
+    )
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match(error)
+    mock_scan_files.assert_not_called()
+
+
+def mock_casadm_ioclass_stats_run_cmd(ioclasses, stats):
+    """ Return IO class listing and {(cache_id, io_class_id): stats} """
+
+    def run_cmd(cmd):
+        result = Mock()
+        cache_id = int(cmd[cmd.index("--cache-id") + 1])
+        if "--list" in cmd:
+            result.stdout = (
+                "IO class ID,IO class name,Eviction priority,Allocation\n"
+                + ioclasses[cache_id]
+            )
+        else:
+            io_class_id = int(cmd[cmd.index("--io-class-id") + 1])
+            result.stdout = h.get_stats_csv(stats[(cache_id, io_class_id)])
+
+        return result
+
+    return run_cmd
+
+
+def get_ioclass_stats(occupancy, dirty, read_hits, read_total):
+    stats = get_requests_stats(read_hits, read_total, 0, 0)
+    stats["Occupancy [4KiB Blocks]"] = occupancy
+    stats["Dirty [4KiB Blocks]"] = dirty
+    return stats
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_gather_ioclass_stats(
+    mock_setup_module, mock_run_cmd, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        gather_ioclass_stats={"recommend": False}
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: []})
+    mock_run_cmd.side_effect = mock_casadm_ioclass_stats_run_cmd(
+        {
+            1: "1,metadata&done,0,1.00\n0,unclassified,22,1.00\n",
+            2: "0,unclassified,22,1.00\n",
+        },
+        {
+            (1, 0): get_ioclass_stats(100, 10, 50, 200),
+            (1, 1): get_ioclass_stats(0, 0, 0, 0),
+            (2, 0): get_ioclass_stats(4, 0, 10, 10),
+        },
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': False")
+    stats = e.value.args[0]["ansible_facts"]["opencas_ioclass_stats"]
+    assert [c["id"] for c in stats["caches"]] == [1, 2]
+
+    ioclasses = stats["caches"][0]["io_classes"]
+    assert [c["id"] for c in ioclasses] == [0, 1]
+    assert ioclasses[0]["name"] == "unclassified"
+    assert ioclasses[0]["priority"] == 22
+    assert ioclasses[0]["occupancy_bytes"] == 100 * 4096
+    assert ioclasses[0]["dirty_blocks"] == 10
+    assert ioclasses[0]["hits"] == 50
+    assert ioclasses[0]["misses"] == 150
+    assert ioclasses[0]["hit_ratio"] == 25.0
+    assert ioclasses[0]["hit_density"] == 0.5
+    assert ioclasses[1]["hit_density"] == 0.0
+
+    assert stats["caches"][1]["io_classes"][0]["hit_density"] == 2.5
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_gather_ioclass_stats_single_cache(
+    mock_setup_module, mock_run_cmd, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        gather_ioclass_stats={"cache_id": 2}
+    )
+    mock_run_cmd.side_effect = mock_casadm_ioclass_stats_run_cmd(
+        {2: "0,unclassified,22,1.00\n"},
+        {(2, 0): get_ioclass_stats(4, 0, 10, 10)},
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    stats = e.value.args[0]["ansible_facts"]["opencas_ioclass_stats"]
+    assert [c["id"] for c in stats["caches"]] == [2]
+    mock_get_list.assert_not_called()
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.time.time")
+@patch("cas.time.sleep")
+@patch("cas.setup_module_object")
+def test_module_stats_sample(
+    mock_setup_module,
+    mock_sleep,
+    mock_time,
+    mock_run_cmd,
+    mock_get_list,
+    sysfs,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        stats_sample={"interval": 2, "count": 2}
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2]})
+    mock_time.side_effect = [100.0, 102.0, 104.0]
+
+    cache_stats = [
+        get_full_stats(1, 30, 10, (0, 0), (0, 0)),
+        get_full_stats(1, 30, 30, (80, 100), (20, 100)),
+        get_full_stats(1, 30, 20, (80, 100), (60, 300)),
+    ]
+    mock_run_cmd.side_effect = [
+        Mock(stdout=h.get_stats_csv(stats)) for stats in cache_stats
+    ]
+
+    core_stats = [[0] * 11, [100] * 11, [300] * 11]
+    h.write_block_stat(sysfs, "cas1-1", core_stats[0])
+
+    def sleep(interval):
+        stat = core_stats[mock_sleep.call_count]
+        (sysfs / "block" / "cas1-1" / "stat").write_text(
+            " ".join(str(v) for v in stat)
+        )
+
+    mock_sleep.side_effect = sleep
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': False")
+    assert mock_sleep.call_count == 2
+    assert mock_run_cmd.call_count == 3
+
+    sample = e.value.args[0]["stats_sample"]
+    assert sample["duration"] == 4.0
+    assert len(sample["samples"]) == 2
+
+    cache = sample["caches"][0]
+    assert cache["id"] == 1
+    assert cache["read_iops"] == 25.0
+    assert cache["write_iops"] == 75.0
+    assert cache["iops"] == 100.0
+    assert cache["hit_ratio"] == 35.0
+    assert cache["dirty_growth_rate"] == 10 * 4096 / 4.0
+
+    assert [c["id"] for c in cache["cores"]] == [1]
+    assert cache["cores"][0]["read_iops"] == 75.0
+    assert cache["cores"][0]["iops"] == 150.0
+    assert cache["cores"][0]["write_throughput"] == 300 * 512 / 4.0
+
+    first, second = [s["caches"][0] for s in sample["samples"]]
+    assert first["hit_ratio"] == 50.0
+    assert first["dirty_growth_rate"] == 20 * 4096 / 2.0
+    assert second["hit_ratio"] == 20.0
+    assert second["dirty_growth_rate"] == -10 * 4096 / 2.0
+    assert second["cores"][0]["read_iops"] == 100.0
+
+
+@pytest.mark.parametrize(
+    "sample_params", [{"interval": -1}, {"count": -2}, {"interval": "a"}]
+)
+@patch("opencas.get_caches_list")
+@patch("cas.setup_module_object")
+def test_module_stats_sample_invalid_params(
+    mock_setup_module, mock_get_list, sample_params
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        stats_sample=sample_params
+    )
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("Invalid stats sampling parameters")
+    mock_get_list.assert_not_called()
+
+
+def get_desired_state_config(cache_mode="WT", **params):
+    return opencas.cas_config(
+        caches={
+            1: opencas.cas_config.cache_config(
+                1, "/dev/dummy1", cache_mode, **params
+            )
+        },
+        cores=[
+            opencas.cas_config.core_config(1, 1, "/dev/dummycore1-1"),
+            opencas.cas_config.core_config(1, 2, "/dev/dummycore1-2"),
+        ],
+    )
+
+
+desired_state_spec = {
+    "caches": [
+        {
+            "id": 1,
+            "cache_device": "/dev/dummy1",
+            "cache_mode": "WT",
+            "cleaning_policy": "alru",
+        }
+    ],
+    "cores": [
+        {"id": 1, "cache_id": 1, "cached_volume": "/dev/dummycore1-1"},
+        {"id": 2, "cache_id": 1, "cached_volume": "/dev/dummycore1-2"},
+    ],
+}
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_converged(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_run_cmd,
+    mock_start_cache,
+    mock_add_core,
+    mock_stop_cache,
+    mock_has_metadata,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=dict(desired_state_spec, prune=True)
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="alru"
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2]})
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': False")
+    plan = e.value.args[0]["plan"]
+    assert [(p["type"], p["id"]) for p in plan["noop"]] == [
+        ("cache", 1),
+        ("core", 1),
+        ("core", 2),
+    ]
+    assert plan["create"] == plan["change"] == plan["remove"] == []
+
+    mock_get_list.assert_called_once()
+    mock_write.assert_not_called()
+    mock_run_cmd.assert_not_called()
+    mock_start_cache.assert_not_called()
+    mock_add_core.assert_not_called()
+    mock_stop_cache.assert_not_called()
+    mock_has_metadata.assert_not_called()
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.configure_cache")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_create(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_start_cache,
+    mock_add_core,
+    mock_configure_cache,
+    mock_has_metadata,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=desired_state_spec
+    )
+    mock_from_file.return_value = opencas.cas_config(caches={}, cores=[])
+    mock_get_list.return_value = []
+    mock_has_metadata.return_value = False
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    plan = e.value.args[0]["plan"]
+    assert [(p["type"], p["id"]) for p in plan["create"]] == [
+        ("cache", 1),
+        ("core", 1),
+        ("core", 2),
+    ]
+    assert plan["create"][0]["operations"] == ["start cache 1 (/dev/dummy1)"]
+
+    mock_write.assert_called_once()
+    config = mock_from_file.return_value
+    assert config.caches[1].params["cleaning_policy"] == "alru"
+    assert len(config.cores) == 2
+
+    mock_start_cache.assert_called_once()
+    assert mock_add_core.call_count == 2
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+@patch("cas.has_cache_metadata")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_load_attaches_cores(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_start_cache,
+    mock_add_core,
+    mock_configure_cache,
+    mock_stop_cache,
+    mock_has_metadata,
+    parallel,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=dict(desired_state_spec, parallel=parallel)
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="alru"
+    )
+    mock_has_metadata.return_value = True
+    # Only core 1 is recorded in metadata of cache 1
+    mock_casadm_load(
+        mock_start_cache,
+        mock_add_core,
+        mock_get_list,
+        {1: [(1, "/dev/dummycore1-1")]},
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    args, kwargs = mock_start_cache.call_args
+    assert kwargs["load"] == True
+    assert [
+        (args[0].cache_id, args[0].core_id)
+        for args, _ in mock_add_core.call_args_list
+    ] == [(1, 2)]
+    mock_stop_cache.assert_not_called()
+
+
+def mock_casadm_policy_run_cmd(cleaning_policy, set_param_error=None):
+    """ Return cleaning policy for --get-param, fail --set-param if set """
+
+    def run_cmd(cmd):
+        result = Mock()
+        result.stdout = ""
+        if "--get-param" in cmd:
+            result.stdout = (
+                "Parameter name,Value\n"
+                "Cleaning policy type,{0}\n".format(cleaning_policy)
+            )
+        elif "--set-param" in cmd and set_param_error:
+            result.stderr = set_param_error
+            raise opencas.casadm.CasadmError(result)
+
+        return result
+
+    return run_cmd
+
+
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_change_params(
+    mock_setup_module, mock_from_file, mock_write, mock_get_list, mock_run_cmd
+):
+    spec = deepcopy(desired_state_spec)
+    spec["caches"][0]["cache_mode"] = "WB"
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=spec
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="acp"
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2]})
+    mock_run_cmd.side_effect = mock_casadm_policy_run_cmd("acp")
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    plan = e.value.args[0]["plan"]
+    assert [(p["type"], p["id"]) for p in plan["change"]] == [("cache", 1)]
+    assert plan["change"][0]["changes"] == {
+        "cache_mode": {"from": "wt", "to": "wb"},
+        "cleaning_policy": {"from": "acp", "to": "alru"},
+    }
+
+    mock_write.assert_called_once()
+    commands = [
+        " ".join(args[0][1:])
+        for args, _ in mock_run_cmd.call_args_list
+        if "--get-param" not in args[0]
+    ]
+    assert commands == [
+        "--set-cache-mode --cache-mode WB --cache-id 1 --flush-cache yes",
+        "--set-param --name cleaning --cache-id 1 --policy alru",
+    ]
+
+
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write", autospec=True)
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_rollback(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_run_cmd,
+    opencas_config,
+):
+    spec = deepcopy(desired_state_spec)
+    spec["caches"][0]["cache_mode"] = "WB"
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=spec
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="acp"
+    )
+    mock_write.side_effect = h.write_config
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2]})
+    mock_run_cmd.side_effect = mock_casadm_policy_run_cmd(
+        "acp", "Invalid policy"
+    )
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("Invalid policy")
+    commands = [
+        " ".join(args[0][1:])
+        for args, _ in mock_run_cmd.call_args_list
+        if "--get-param" not in args[0]
+    ]
+    assert commands == [
+        "--set-cache-mode --cache-mode WB --cache-id 1 --flush-cache yes",
+        "--set-param --name cleaning --cache-id 1 --policy alru",
+        "--set-cache-mode --cache-mode wt --cache-id 1 --flush-cache yes",
+    ]
+    assert opencas_config.read_text() == "# original config\n"
+    assert not os.path.exists(str(opencas_config) + ".journal")
+
+
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_prune(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_run_cmd,
+    mock_stop_cache,
+):
+    spec = deepcopy(desired_state_spec)
+    spec["cores"] = spec["cores"][:1]
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="alru"
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2], 3: [1]})
+
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=spec
+    )
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': False")
+    mock_run_cmd.assert_not_called()
+
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=dict(spec, prune=True)
+    )
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    plan = e.value.args[0]["plan"]
+    assert [(p["type"], p["id"]) for p in plan["remove"]] == [
+        ("cache", 3),
+        ("core", 2),
+    ]
+
+    mock_stop_cache.assert_called_once_with(cache_id=3, no_flush=False)
+    mock_run_cmd.assert_called_once()
+    assert " ".join(mock_run_cmd.call_args[0][0][1:]) == (
+        "--remove-core --cache-id 1 --core-id 2"
+    )
+    assert len(mock_from_file.return_value.cores) == 1
+
+
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_recreate_not_allowed(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_stop_cache,
+):
+    spec = deepcopy(desired_state_spec)
+    spec["caches"][0]["line_size"] = 64
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=spec
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="alru"
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2]})
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("Cache 1 has to be restarted to apply changes of cache_line_size")
+    mock_write.assert_not_called()
+    mock_stop_cache.assert_not_called()
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.configure_cache")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_recreate(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_stop_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_configure_cache,
+    mock_has_metadata,
+):
+    spec = deepcopy(desired_state_spec)
+    spec["caches"][0]["line_size"] = 64
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=dict(spec, recreate=True)
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="alru"
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2]})
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    plan = e.value.args[0]["plan"]
+    assert plan["change"][0]["operations"] == [
+        "stop cache 1",
+        "start cache 1 (/dev/dummy1)",
+    ]
+    assert [p["id"] for p in plan["create"]] == [1, 2]
+
+    mock_stop_cache.assert_called_once_with(cache_id=1, no_flush=False)
+    args, kwargs = mock_start_cache.call_args
+    assert args[0].params["cache_line_size"] == "64"
+    assert kwargs == {"load": False, "force": True}
+    assert mock_add_core.call_count == 2
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.configure_cache")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_parallel(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_stop_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_configure_cache,
+    mock_has_metadata,
+):
+    spec = deepcopy(desired_state_spec)
+    spec["caches"][0]["line_size"] = 64
+    spec["caches"] += [
+        {"id": 2, "cache_device": "/dev/dummy2", "cache_mode": "WB"}
+    ]
+    spec["cores"] += [
+        {"id": 1, "cache_id": 2, "cached_volume": "/dev/dummycore2-1"}
+    ]
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=dict(spec, recreate=True, prune=True, parallel=True)
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="alru"
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1, 2], 3: []})
+    mock_has_metadata.return_value = False
+
+    # Cache 1 restart finishes only after core of new cache 2 was added
+    core_added = threading.Event()
+
+    def start_cache(cache_config, **kwargs):
+        if cache_config.cache_id == 1:
+            assert core_added.wait(5)
+
+    def add_core(core_config, try_add):
+        if core_config.cache_id == 2:
+            core_added.set()
+
+    mock_start_cache.side_effect = start_cache
+    mock_add_core.side_effect = add_core
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    ret = e.value.args[0]
+
+    # Caches are stopped before anything is started
+    operations = ret["operations"]
+    assert operations[:2] == ["stop cache 3", "stop cache 1"]
+    assert operations.index("add core 1 (/dev/dummycore2-1) to cache 2") < (
+        operations.index("configure cache 1")
+    )
+    assert operations.index("configure cache 1") < (
+        operations.index("add core 1 (/dev/dummycore1-1) to cache 1")
+    )
+
+    assert mock_start_cache.call_count == 2
+    assert mock_add_core.call_count == 3
+    assert len(ret["timings"]) == len(operations)
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_add_core_failed(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_start_cache,
+    mock_add_core,
+    mock_configure_cache,
+    mock_stop_cache,
+    mock_has_metadata,
+    opencas_config,
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        desired_state=desired_state_spec
+    )
+    mock_from_file.return_value = opencas.cas_config(caches={}, cores=[])
+    mock_get_list.return_value = []
+    mock_has_metadata.return_value = False
+    mock_add_core.side_effect = Exception("add core failed")
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("add core failed")
+    mock_write.assert_called_once()
+    mock_stop_cache.assert_called_once_with(cache_id=1, no_flush=False)
+    assert opencas_config.read_text() == "# original config\n"
+
+
+def setup_module_in_check_mode(diff=False, **params):
+    mock_module = setup_module_with_params(**params)
+    mock_module.check_mode = True
+    mock_module._diff = diff
+
+    return mock_module
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.cas_config.write", autospec=True)
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_check_mode(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_configure_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+    mock_has_metadata,
+    opencas_config,
+):
+    # Only metadata of cache already in opencas.conf is loaded
+    mock_has_metadata.return_value = True
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        diff=True, configure_devices=devices_config
+    )
+    mock_from_file.return_value = opencas.cas_config(
+        caches={
+            2: opencas.cas_config.cache_config(2, "/dev/dummy2", "WT"),
+        },
+        cores=[opencas.cas_config.core_config(2, 1, "/dev/dummycore3")],
+    )
+    mock_write.side_effect = h.write_config
+    mock_get_list.return_value = []
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    result = e.value.args[0]
+    assert result["operations"] == [
+        "start cache 1 (/dev/dummy1) initializing metadata",
+        "configure cache 1",
+        "start cache 2 (/dev/dummy2) loading metadata",
+        "configure cache 2",
+        "add core 1 (/dev/dummycore1) to cache 1",
+        "add core 2 (/dev/dummycore2) to cache 1",
+        "add core 1 (/dev/dummycore3) to cache 2",
+    ]
+    assert [c["start"] for c in result["started_caches"]] == ["init", "load"]
+
+    mock_start_cache.assert_not_called()
+    mock_configure_cache.assert_not_called()
+    mock_add_core.assert_not_called()
+    assert opencas_config.read_text() == "# original config\n"
+
+    assert len(result["diff"]) == 1
+    diff = result["diff"][0]
+    assert diff["before_header"] == opencas.cas_config.default_location
+    assert diff["before"] == (
+        "cache 2 /dev/dummy2 WT\ncore 2 1 /dev/dummycore3\n"
+    )
+    assert "cache 1 /dev/dummy1 WT\n" in diff["after"]
+    assert "core 1 2 /dev/dummycore2\n" in diff["after"]
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.stop")
+@patch("cas.setup_module_object")
+def test_module_stop_check_mode(mock_setup_module, mock_stop, mock_get_list):
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        stop={"flush": True}
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: []})
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    assert e.value.args[0]["operations"] == [
+        "stop caches 1, 2 (flush dirty data)"
+    ]
+    mock_stop.assert_not_called()
+    mock_get_list.assert_called_once()
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_stop_parallel_check_mode(
+    mock_setup_module, mock_run_cmd, mock_stop_cache, mock_get_list
+):
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        stop={"flush": True, "parallel": True, "max_workers": 1}
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: []})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {
+            1: {"Cache Id": 1, "Dirty [4KiB Blocks]": 10},
+            2: {"Cache Id": 2, "Dirty [4KiB Blocks]": 0},
+        }
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    result = e.value.args[0]
+    assert result["operations"] == [
+        "flush cache 1",
+        "stop cache 1",
+        "flush cache 2",
+        "stop cache 2",
+    ]
+    assert [c["bytes_flushed"] for c in result["stopped_caches"]] == [
+        10 * 4096,
+        0,
+    ]
+
+    mock_stop_cache.assert_not_called()
+    for args, _ in mock_run_cmd.call_args_list:
+        assert "--stats" in args[0]
+
+
+@patch("opencas.cas_config.write", autospec=True)
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_zap_check_mode(
+    mock_setup_module, mock_from_file, mock_write, opencas_config
+):
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        diff=True, zap=True
+    )
+    mock_from_file.return_value = opencas.cas_config(
+        caches={1: opencas.cas_config.cache_config(1, "/dev/dummy", "WT")},
+        cores=[],
+    )
+    mock_write.side_effect = h.write_config
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    assert e.value.args[0]["diff"][0]["before"] == "cache 1 /dev/dummy WT\n"
+    assert e.value.args[0]["diff"][0]["after"] == ""
+    assert opencas_config.read_text() == "# original config\n"
+    assert not os.path.exists(str(opencas_config) + ".lock")
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.subprocess.Popen")
+@patch("cas.setup_module_object")
+def test_module_flush_check_mode(
+    mock_setup_module, mock_popen, mock_run_cmd, mock_get_list, tmp_path
+):
+    mock_setup_module.return_value = setup_module_in_check_mode(flush=True)
+    mock_get_list.return_value = h.get_devices_list({1: [1], 2: [1]})
+    mock_run_cmd.side_effect = mock_casadm_run_cmd(
+        {
+            1: {"Cache Id": 1, "Dirty [4KiB Blocks]": 100},
+            2: {"Cache Id": 2, "Dirty [4KiB Blocks]": 0},
+        }
+    )
+    state_file = tmp_path / "flush.json"
+
+    with patch("cas.FLUSH_STATE_FILE", str(state_file)):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+    assert e.value.args[0]["operations"] == ["flush cache 1 in background"]
+    mock_popen.assert_not_called()
+    assert not state_file.exists()
+
+
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_drain_check_mode(mock_setup_module, mock_run_cmd):
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        drain={"cache_id": 1}
+    )
+    set_param_calls = []
+    mock_run_cmd.side_effect = mock_casadm_drain_run_cmd(
+        [(50.0, 5000)], set_param_calls
+    )
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    assert e.value.args[0]["operations"] == [
+        "set cleaning policy of cache 1 to alru",
+        "set aggressive alru parameters of cache 1",
+        "restore alru parameters of cache 1",
+        "set cleaning policy of cache 1 to acp",
+    ]
+    assert e.value.args[0]["drained_caches"][0]["dirty_bytes"] == 5000 * 4096
+    assert set_param_calls == []
+
+
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_desired_state_check_mode(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    mock_run_cmd,
+    opencas_config,
+):
+    spec = deepcopy(desired_state_spec)
+    spec["caches"][0]["cache_mode"] = "WB"
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        desired_state=spec
+    )
+    mock_from_file.return_value = get_desired_state_config(
+        cleaning_policy="alru"
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1]})
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    assert e.value.args[0]["operations"] == [
+        "set cache mode of cache 1 to wb",
+        "add core 2 (/dev/dummycore1-2) to cache 1",
+    ]
+    mock_run_cmd.assert_not_called()
+    assert opencas_config.read_text() == "# original config\n"
+
+
+@patch("cas.setup_module_object")
+def test_module_generate_io_class_check_mode(mock_setup_module, tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "file").write_bytes(b"x" * 100)
+
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        diff=True,
+        generate_io_class={"path": str(data), "io_class": "generated.csv"},
+    )
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+    result = e.value.args[0]
+    assert result["diff"][0]["before"] == ""
+    contents = result["generated_io_class"]["contents"]
+    assert result["diff"][0]["after"] == contents
+    assert not (tmp_path / "generated.csv").exists()
+
+
+@pytest.mark.parametrize(
+    "file_copied,cache_started", [(True, False), (False, True), (False, False)]
+)
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.from_file")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_apply_io_class_check_mode(
+    mock_setup_module,
+    mock_run_cmd,
+    mock_from_file,
+    mock_get_list,
+    tmp_path,
+    file_copied,
+    cache_started,
+):
+    mock_setup_module.return_value = setup_module_in_check_mode(
+        apply_io_class={"cache_id": 1, "io_class": "default.csv"}
+    )
+    if file_copied:
+        (tmp_path / "default.csv").write_text(ioclass_file_contents)
+    mock_get_list.return_value = h.get_devices_list(
+        {1: []} if cache_started else {}
+    )
+    mock_run_cmd.side_effect = mock_casadm_ioclass_run_cmd(
+        "0,unclassified,22,1.00\n"
+    )
+    mock_from_file.return_value = opencas.cas_config(
+        caches={1: opencas.cas_config.cache_config(1, "/dev/dummy1", "WT")},
+        cores=[],
+    )
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+    result = e.value.args[0]
+    assert result["operations"] == [
+        "load io classification {0} on cache 1".format(
+            tmp_path / "default.csv"
+        )
+    ]
+    assert (result["io_class_hash"] is None) == (not file_copied)
+    # IO classes are only listed, never loaded
+    assert mock_run_cmd.call_count == (1 if cache_started else 0)
+    for (cmd,), _ in mock_run_cmd.call_args_list:
+        assert "--load-config" not in cmd
+
+
+interrupted_journal = {
+    "config": "# config before interrupted run\n",
+    "steps": [
+        {
+            "operation": "start cache 1 (/dev/dummy1) initializing metadata",
+            "undo": ["stop_cache", 1],
+            "done": True,
+        },
+        {"operation": "configure cache 1", "undo": None, "done": True},
+        {
+            "operation": "add core 1 (/dev/dummycore1) to cache 1",
+            "undo": ["remove_core", 1, 1],
+            "done": False,
+        },
+    ],
+}
+
+
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_interrupted_journal(
+    mock_setup_module,
+    mock_from_file,
+    mock_get_list,
+    mock_run_cmd,
+    mock_stop_cache,
+    opencas_config,
+):
+    journal_path = str(opencas_config) + ".journal"
+    with open(journal_path, "w") as f:
+        json.dump(interrupted_journal, f)
+
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices={"caches": [], "cores": []}
+    )
+    mock_from_file.return_value = opencas.cas_config(caches={}, cores=[])
+    # Core wasn't added before run was interrupted
+    mock_get_list.side_effect = [h.get_devices_list({1: []}), []]
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    assert e.value.args[0]["operations"] == [
+        "roll back: start cache 1 (/dev/dummy1) initializing metadata",
+    ]
+    mock_run_cmd.assert_not_called()
+    mock_stop_cache.assert_called_once_with(cache_id=1, no_flush=False)
+    mock_from_file.assert_called_once()
+    assert opencas_config.read_text() == "# config before interrupted run\n"
+    assert not os.path.exists(journal_path)
+
+
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_interrupted_journal_devices_gone(
+    mock_setup_module,
+    mock_from_file,
+    mock_get_list,
+    mock_run_cmd,
+    mock_stop_cache,
+    opencas_config,
+):
+    journal_path = str(opencas_config) + ".journal"
+    with open(journal_path, "w") as f:
+        json.dump(interrupted_journal, f)
+
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices={"caches": [], "cores": []}
+    )
+    mock_from_file.return_value = opencas.cas_config(caches={}, cores=[])
+    # Caches were stopped (e.g. by teardown) after run was interrupted
+    mock_get_list.return_value = []
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    assert "operations" not in e.value.args[0]
+    mock_run_cmd.assert_not_called()
+    mock_stop_cache.assert_not_called()
+    assert opencas_config.read_text() == "# config before interrupted run\n"
+    assert not os.path.exists(journal_path)
+
+
+@patch("opencas.casadm.stop_cache")
+@patch("opencas.casadm.run_cmd")
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_interrupted_journal_rollback_failed(
+    mock_setup_module,
+    mock_from_file,
+    mock_get_list,
+    mock_run_cmd,
+    mock_stop_cache,
+    opencas_config,
+):
+    journal_path = str(opencas_config) + ".journal"
+    with open(journal_path, "w") as f:
+        json.dump(interrupted_journal, f)
+
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices={"caches": [], "cores": []}
+    )
+    mock_get_list.return_value = h.get_devices_list({1: [1]})
+    mock_stop_cache.side_effect = Exception("Device busy")
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("Couldn't roll back operations")
+    e.match("Device busy")
+    mock_from_file.assert_not_called()
+
+    with open(journal_path, "r") as f:
+        journal = json.load(f)
+    assert journal["steps"] == interrupted_journal["steps"][:1]
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write", autospec=True)
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_zap_interrupted_journal(
+    mock_setup_module, mock_from_file, mock_write, mock_get_list, opencas_config
+):
+    journal_path = str(opencas_config) + ".journal"
+    with open(journal_path, "w") as f:
+        json.dump(interrupted_journal, f)
+
+    mock_setup_module.return_value = setup_module_with_params(zap=True)
+    mock_from_file.return_value = opencas.cas_config(
+        caches={1: opencas.cas_config.cache_config(1, "/dev/dummy", "WT")},
+        cores=[],
+    )
+    mock_write.side_effect = h.write_config
+    mock_get_list.return_value = []
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    # Journal is rolled back before configuration is zapped, not after
+    e.match("'changed': True")
+    assert opencas_config.read_text() == ""
+    assert not os.path.exists(journal_path)
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.write", autospec=True)
+@patch("opencas.cas_config.from_file")
+@patch("opencas.casadm.run_cmd")
+@patch("cas.setup_module_object")
+def test_module_apply_io_class_interrupted_journal(
+    mock_setup_module,
+    mock_run_cmd,
+    mock_from_file,
+    mock_write,
+    mock_get_list,
+    opencas_config,
+    tmp_path,
+):
+    journal_path = str(opencas_config) + ".journal"
+    with open(journal_path, "w") as f:
+        json.dump(interrupted_journal, f)
+
+    mock_setup_module.return_value = setup_module_with_params(
+        apply_io_class={"cache_id": 1, "io_class": "default.csv"}
+    )
+    (tmp_path / "default.csv").write_text(ioclass_file_contents)
+    mock_run_cmd.side_effect = mock_casadm_ioclass_run_cmd(
+        "0,unclassified,22,1.00\n"
+    )
+    mock_from_file.return_value = opencas.cas_config(
+        caches={1: opencas.cas_config.cache_config(1, "/dev/dummy1", "WT")},
+        cores=[],
+    )
+    mock_write.side_effect = h.write_config
+    mock_get_list.return_value = []
+
+    with patch("cas.IOCLASS_FILE_PATH", str(tmp_path / "{0}")):
+        with pytest.raises(AnsibleExitJson) as e:
+            cas.main()
+
+    e.match("'changed': True")
+    mock_write.assert_called_once()
+    assert opencas_config.read_text() == "cache 1 /dev/dummy1 WT\n"
+    assert not os.path.exists(journal_path)
+
+
+@patch("cas.has_cache_metadata")
+@patch("opencas.get_caches_list")
+@patch("opencas.add_core")
+@patch("opencas.start_cache")
+@patch("opencas.configure_cache")
+@patch("opencas.cas_config.write", autospec=True)
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_config_written_atomically(
+    mock_setup_module,
+    mock_from_file,
+    mock_write,
+    mock_configure_cache,
+    mock_start_cache,
+    mock_add_core,
+    mock_get_list,
+    mock_has_metadata,
+    opencas_config,
+):
+    mock_has_metadata.return_value = False
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=devices_config
+    )
+    mock_from_file.return_value = opencas.cas_config(caches={}, cores=[])
+    mock_write.side_effect = h.write_config
+    mock_get_list.return_value = []
+    opencas_config.chmod(0o640)
+
+    with pytest.raises(AnsibleExitJson) as e:
+        cas.main()
+
+    e.match("'changed': True")
+    mock_write.assert_called_once()
+    assert mock_write.call_args[0][1] != str(opencas_config)
+    assert "cache 2 /dev/dummy2 WB\n" in opencas_config.read_text()
+    assert oct(opencas_config.stat().st_mode & 0o777) == oct(0o640)
+    assert sorted(os.listdir(str(opencas_config.parent))) == [
+        "opencas.conf",
+        "opencas.conf.lock",
+        "sys",
+    ]
+
+
+@patch("opencas.cas_config.write", autospec=True)
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_zap_write_interrupted(
+    mock_setup_module, mock_from_file, mock_write, opencas_config
+):
+    mock_setup_module.return_value = setup_module_with_params(zap=True)
+    mock_from_file.return_value = opencas.cas_config(
+        caches={1: opencas.cas_config.cache_config(1, "/dev/dummy", "WT")},
+        cores=[],
+    )
+
+    def write_partially(config, path):
+        with open(path, "w") as f:
+            f.write("# partial")
+        raise IOError("No space left on device")
+
+    mock_write.side_effect = write_partially
+
+    with pytest.raises(AnsibleFailJson) as e:
+        cas.main()
+
+    e.match("No space left on device")
+    assert opencas_config.read_text() == "# original config\n"
+    assert sorted(os.listdir(str(opencas_config.parent))) == [
+        "opencas.conf",
+        "opencas.conf.lock",
+        "sys",
+    ]
+
+
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_zap_config_locked(
+    mock_setup_module, mock_from_file, opencas_config
+):
+    mock_setup_module.return_value = setup_module_with_params(zap=True)
+    mock_from_file.return_value = mock_config_file
+
+    with open(str(opencas_config) + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with patch("cas.CONFIG_LOCK_TIMEOUT", 0.2):
+            with pytest.raises(AnsibleFailJson) as e:
+                cas.main()
+
+    e.match("Timed out waiting for lock")
+    mock_from_file.assert_not_called()
+    assert opencas_config.read_text() == "# original config\n"
+
+
+@patch("opencas.get_caches_list")
+@patch("opencas.cas_config.from_file")
+@patch("cas.setup_module_object")
+def test_module_configure_devices_config_locked(
+    mock_setup_module, mock_from_file, mock_get_list, opencas_config
+):
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices=devices_config
+    )
+
+    with open(str(opencas_config) + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with patch("cas.CONFIG_LOCK_TIMEOUT", 0.2):
+            with pytest.raises(AnsibleFailJson) as e:
+                cas.main()
+
+    e.match("Timed out waiting for lock")
+    mock_from_file.assert_not_called()
+
+    # Lock is released when module finishes
+    mock_from_file.return_value = opencas.cas_config(caches={}, cores=[])
+    mock_get_list.return_value = []
+    mock_setup_module.return_value = setup_module_with_params(
+        configure_devices={"caches": [], "cores": []}
+    )
+    with open(str(opencas_config) + ".lock", "a") as lock:
+        with pytest.raises(AnsibleExitJson):
+            cas.main()
+
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)